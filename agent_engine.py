@@ -0,0 +1,617 @@
+import copy
+import hashlib
+import json
+import math
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from generation_policy import CHARS_PER_TOKEN, DEFAULT_TURN_BUDGET, LENGTH_HINT, generation_policy, trim_to_sentence
+from memory_index import chat_memory, tokenize
+from usage_ledger import BUDGET_FALLBACK_MODEL, BudgetExceeded, degrade_messages, usage_ledger
+
+# ================== 生成配置 ==================
+DEFAULT_MODEL = "deepseek-chat"
+
+# 每次调用时至少带入的最近公共消息条数
+HISTORY_WINDOW = 40
+
+# 历史窗口按块滑动，块内请求的消息前缀保持不变，便于命中服务端的前缀缓存
+HISTORY_STEP = 20
+
+INTRO_INSTRUCTION = "请用两三句话向{user_role}做自我介绍，保持你的角色个性，不要替其他角色发言。"
+
+AI_TURN_INSTRUCTION = "轮到你发言了。请根据场景和之前的对话自然地接话，可以回应或询问其他角色。"
+
+# 历史超出窗口后，从更早的消息里检索带入的相关条数
+MEMORY_TOP_K = 4
+
+# 检索查询取窗口内最近的几条消息
+MEMORY_QUERY_MESSAGES = 3
+
+REPLY_INSTRUCTION = "请以你的角色回应{user_role}刚才说的话，可以接着前面角色的话说。"
+
+# 每条公共消息默认最多由几位角色回应
+DEFAULT_MAX_RESPONDERS = 2
+
+# 文本里直接提到角色名时的加分，高于任何个性描述的相关度
+NAME_SCORE = 10.0
+
+REGENERATE_INSTRUCTION = "轮到你发言了。请根据场景和之前的对话自然地接话，换一种和之前不同的说法。"
+
+
+# ================== 提示构建 ==================
+def compile_agent_prefix(agent_name, personality=""):
+    """编译角色的静态系统提示前缀，相同输入总是得到逐字节相同的结果"""
+    lines = [f"你正在参与一场沉浸式角色扮演。你扮演的角色是「{agent_name}」。"]
+    if personality:
+        lines.append(f"你的个性：{personality}")
+    lines.append(f"请始终以「{agent_name}」的身份、用第一人称说话。")
+    lines.append("只输出你自己的台词和动作描写，不要替其他角色发言，不要跳出角色。")
+    return "\n".join(lines)
+
+
+def agent_prompt_prefix(agent_name, data):
+    """返回角色已编译的前缀，只有个性变化后才重新编译"""
+    personality = data.get('personality', '')
+    if data.get('prompt_prefix') is None or data.get('prefix_source') != personality:
+        data['prompt_prefix'] = compile_agent_prefix(agent_name, personality)
+        data['prefix_source'] = personality
+    return data['prompt_prefix']
+
+
+def scene_prompt(context, avatar, other_agents, user_role="用户"):
+    """系统提示中随场景变化的部分，放在静态前缀之后"""
+    lines = [
+        f"场景设定：{context or '（未提供）'}",
+        f"你的形象：{avatar}",
+    ]
+    if other_agents:
+        lines.append(f"同场的其他角色：{'、'.join(other_agents)}。")
+    lines.append(f"对话的中心是{user_role}。")
+    return "\n".join(lines)
+
+
+def generate_agent_prompt(context, agent_name, avatar, other_agents, user_role="用户", personality=""):
+    """为代理创建系统提示"""
+    return compile_agent_prefix(agent_name, personality) + "\n\n" + scene_prompt(context, avatar, other_agents, user_role)
+
+
+def agent_system_prompt(chat, agent_name):
+    """返回角色的系统提示，优先使用自定义的 system_prompt"""
+    agents = chat.get('agents', {})
+    data = agents.get(agent_name, {})
+    if data.get('system_prompt'):
+        return data['system_prompt']
+    others = [name for name in agents if name != agent_name]
+    return agent_prompt_prefix(agent_name, data) + "\n\n" + scene_prompt(
+        chat.get('scenario', ''),
+        data.get('avatar', '👤'),
+        others,
+        chat.get('user_role', '用户'),
+    )
+
+
+def history_window(history, offset=0):
+    """返回带入请求的历史片段，起点按完整记录中的位置对 HISTORY_STEP 对齐
+
+    offset 是内存中第一条消息在完整记录里的位置（只加载了尾部时大于 0）。
+    """
+    start = max(0, offset + len(history) - HISTORY_WINDOW)
+    return history[max(0, start - start % HISTORY_STEP - offset):]
+
+
+def recall_messages(chat, agent_name, window, window_start):
+    """从窗口之前的历史里检索与最近对话相关的消息，整理成一条提示"""
+    if window_start <= 0 and not chat.get('private_history', {}).get(agent_name):
+        return None
+    query = "\n".join(msg[2] for msg in window[-MEMORY_QUERY_MESSAGES:])
+    if not query:
+        return None
+    recalled = chat_memory.search(chat, query, k=MEMORY_TOP_K, before=window_start, agent_name=agent_name)
+    if not recalled:
+        return None
+    lines = ["以下是与当前话题相关的早期对话，供你回忆参考："]
+    lines.extend(f"- {speaker}：{text}" for speaker, text, _ in sorted(recalled, key=lambda r: r[2]))
+    return "\n".join(lines)
+
+
+def build_agent_messages(chat, agent_name, instruction=None):
+    """把公共聊天记录转换为某个角色视角的消息列表"""
+    messages = [{"role": "system", "content": agent_system_prompt(chat, agent_name)}]
+    history = chat.get('chat_history', [])
+    offset = chat.get('history_offset', 0)
+    window = history_window(history, offset)
+    for speaker, _, text, _ in window:
+        if speaker == agent_name:
+            messages.append({"role": "assistant", "content": text})
+        else:
+            messages.append({"role": "user", "content": f"{speaker}：{text}"})
+    # 检索到的记忆放在历史之后，不影响前面可以命中前缀缓存的部分
+    memory = recall_messages(chat, agent_name, window, offset + len(history) - len(window))
+    if memory:
+        messages.append({"role": "system", "content": memory})
+    if instruction:
+        messages.append({"role": "user", "content": instruction})
+    return messages
+
+
+# ================== 调用记录 ==================
+class CallLog:
+    """最近模型调用的 token 用量，包括服务端前缀缓存命中的部分"""
+
+    def __init__(self, maxlen=200):
+        self._entries = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, chat_id, label, response):
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        # DeepSeek 在 usage 中返回前缀缓存命中和未命中的 token 数
+        hit_tokens = getattr(usage, 'prompt_cache_hit_tokens', 0) or 0
+        with self._lock:
+            self._entries.append({
+                'chat_id': chat_id,
+                'label': label,
+                'time': time.strftime("%H:%M:%S"),
+                'prompt_tokens': prompt_tokens,
+                'cache_hit_tokens': hit_tokens,
+                'cache_miss_tokens': getattr(usage, 'prompt_cache_miss_tokens', prompt_tokens - hit_tokens) or 0,
+                'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+            })
+
+    def entries(self, chat_id=None):
+        """返回最近的调用记录，可按聊天过滤"""
+        with self._lock:
+            entries = list(self._entries)
+        if chat_id is not None:
+            entries = [e for e in entries if e['chat_id'] == chat_id]
+        return entries
+
+
+call_log = CallLog()
+
+
+def create_completion(client, chat, label, **kwargs):
+    """发起一次补全请求并记录用量
+
+    请求前检查预算：接近上限时缩短上下文并按配置换用备用模型，用尽后抛出 BudgetExceeded。
+    """
+    chat_id = chat.get('id')
+    decision = usage_ledger.check(chat_id)
+    if decision == 'refuse':
+        raise BudgetExceeded("预算已用尽，请在侧边栏调整预算")
+    if decision == 'degrade':
+        if BUDGET_FALLBACK_MODEL:
+            kwargs['model'] = BUDGET_FALLBACK_MODEL
+        kwargs['messages'] = degrade_messages(kwargs['messages'])
+    started = time.perf_counter()
+    response = client.chat.completions.create(**kwargs)
+    usage = getattr(response, 'usage', None)
+    # 磁带回放的耗时不代表接口速度，不计入生成策略
+    if not getattr(client, 'replayed', False):
+        generation_policy.observe(chat_id, label, time.perf_counter() - started,
+                                  getattr(usage, 'completion_tokens', 0) or 0)
+    call_log.record(chat_id, label, response)
+    usage_ledger.record(chat_id, label, kwargs.get('model'), usage)
+    return response
+
+
+# ================== 单角色生成 ==================
+def generate_agent_reply(client, chat, agent_name, instruction=None, model=DEFAULT_MODEL, deadline=None):
+    """让单个角色生成一条回复
+
+    输出长度按角色的生成策略限制在目标时长内，deadline 是本轮分给这个角色的秒数；
+    因为长度上限被截断时去掉最后半句话。
+    """
+    limits = generation_policy.limits(chat, agent_name, deadline)
+    if instruction and 'max_tokens' in limits:
+        instruction += LENGTH_HINT.format(chars=int(limits['max_tokens'] * CHARS_PER_TOKEN) // 10 * 10)
+    response = create_completion(
+        client,
+        chat,
+        agent_name,
+        model=model,
+        messages=build_agent_messages(chat, agent_name, instruction),
+        **limits,
+    )
+    choice = response.choices[0]
+    content = (choice.message.content or '').strip()
+    if getattr(choice, 'finish_reason', None) == 'length':
+        content = trim_to_sentence(content)
+    return content
+
+
+# ================== 批量自我介绍 ==================
+def build_batch_intro_messages(chat):
+    """构建一次性生成所有角色自我介绍的请求"""
+    agents = chat.get('agents', {})
+    user_role = chat.get('user_role', '用户')
+    roster = []
+    for name, data in agents.items():
+        line = f"- {name} {data.get('avatar', '👤')}"
+        if data.get('personality'):
+            line += f"：{data['personality']}"
+        roster.append(line)
+
+    system = "\n".join([
+        "你是一场多角色扮演的导演，需要同时为多个角色撰写台词。",
+        f"场景设定：{chat.get('scenario', '') or '（未提供）'}",
+        f"对话的中心是{user_role}。",
+        "角色列表：",
+        *roster,
+        "",
+        f"请为列表中的每个角色各写一段两三句话的自我介绍，对象是{user_role}，保持各自的个性。",
+        '只输出 JSON，格式为：{"introductions": [{"name": "角色名", "content": "介绍内容"}]}',
+        "name 必须与角色列表中的名字完全一致，每个角色恰好一条。",
+    ])
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": "请开始。"},
+    ]
+
+
+def parse_batch_introductions(raw, agent_names):
+    """解析并校验批量介绍的 JSON，只返回合法的条目"""
+    text = (raw or '').strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.startswith("json"):
+            text = text[4:]
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return {}
+
+    items = data.get('introductions') if isinstance(data, dict) else data
+    if isinstance(items, dict):
+        items = [{'name': name, 'content': content} for name, content in items.items()]
+    if not isinstance(items, list):
+        return {}
+
+    valid = set(agent_names)
+    intros = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        name = item.get('name')
+        content = item.get('content')
+        if name in valid and name not in intros and isinstance(content, str) and content.strip():
+            intros[name] = content.strip()
+    return intros
+
+
+def generate_introductions(client, chat, batch=True, model=DEFAULT_MODEL, cancel_event=None):
+    """生成所有角色的自我介绍，返回 [(角色名, 内容)]
+
+    批量模式下先用一次结构化请求生成全部介绍，解析失败或缺失的角色再逐个生成；
+    cancel_event 被设置后不再发起新的请求。
+    """
+    agent_names = list(chat.get('agents', {}).keys())
+    intros = {}
+
+    if batch and len(agent_names) > 1:
+        try:
+            response = create_completion(
+                client,
+                chat,
+                "批量介绍",
+                model=model,
+                messages=build_batch_intro_messages(chat),
+                response_format={"type": "json_object"},
+            )
+            intros = parse_batch_introductions(response.choices[0].message.content, agent_names)
+        except Exception:
+            intros = {}
+
+    instruction = INTRO_INSTRUCTION.format(user_role=chat.get('user_role', '用户'))
+    for name in agent_names:
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        if name not in intros:
+            intros[name] = generate_agent_reply(client, chat, name, instruction, model=model)
+
+    return [(name, intros[name]) for name in agent_names if name in intros]
+
+
+# ================== AI互动 ==================
+def next_speaker(chat):
+    """按轮流顺序返回下一个发言的角色"""
+    agent_names = list(chat.get('agents', {}).keys())
+    if not agent_names:
+        return None
+    for msg in reversed(chat.get('chat_history', [])):
+        if msg[0] in agent_names:
+            return agent_names[(agent_names.index(msg[0]) + 1) % len(agent_names)]
+    return agent_names[0]
+
+
+def generate_agent_turn(client, chat, agent_name, model=DEFAULT_MODEL):
+    """AI互动模式下让角色主动发言一轮"""
+    return generate_agent_reply(client, chat, agent_name, AI_TURN_INSTRUCTION, model=model)
+
+
+# ================== 重新生成 ==================
+def chat_snapshot(chat, index=None):
+    """聊天的快照，指定 index 时截到第 index 条消息之前；后台线程只读快照"""
+    snapshot = {k: v for k, v in chat.items() if k != 'chat_history'}
+    snapshot['agents'] = copy.deepcopy(chat.get('agents', {}))
+    history = chat.get('chat_history', [])
+    if index is not None:
+        history = history[:max(0, index - chat.get('history_offset', 0))]
+    snapshot['chat_history'] = [list(msg) for msg in history]
+    return snapshot
+
+
+def regenerate_reply(client, snapshot, agent_name, model=DEFAULT_MODEL):
+    """在 chat_snapshot 截取的快照上让角色重新发言一次"""
+    return generate_agent_reply(client, snapshot, agent_name, REGENERATE_INSTRUCTION, model=model)
+
+
+# ================== 回应路由 ==================
+def parse_mentions(text, agent_names):
+    """按出现顺序返回 @角色名 提到的角色"""
+    found = []
+    for name in agent_names:
+        position = text.find(f"@{name}")
+        if position >= 0:
+            found.append((position, name))
+    return [name for _, name in sorted(found)]
+
+
+def relevance_scores(chat, text):
+    """消息与每个角色（名字和个性）的本地相关度，只在角色之间比较"""
+    agents = chat.get('agents', {})
+    profiles = {
+        name: set(tokenize(f"{name} {data.get('personality', '')}"))
+        for name, data in agents.items()
+    }
+    query = set(tokenize(text))
+    scores = {}
+    for name, profile in profiles.items():
+        score = NAME_SCORE if name in text else 0.0
+        for term in query & profile:
+            # 只有少数角色才有的词更能说明是在对谁说话
+            df = sum(1 for other in profiles.values() if term in other)
+            score += math.log(1 + len(profiles) / df)
+        scores[name] = score
+    return scores
+
+
+def route_responders(chat, text, max_responders=DEFAULT_MAX_RESPONDERS):
+    """决定哪些角色回应这条公共消息
+
+    有 @ 提及时只让被提到的角色回应；否则按相关度挑选；都不相关时由轮到的角色接话，场面不会冷掉。
+    """
+    agent_names = list(chat.get('agents', {}).keys())
+    if not agent_names or max_responders <= 0:
+        return []
+    mentioned = parse_mentions(text, agent_names)
+    if mentioned:
+        return mentioned[:max_responders]
+    scores = relevance_scores(chat, text)
+    ranked = sorted((name for name in agent_names if scores[name] > 0), key=lambda n: -scores[n])
+    return ranked[:max_responders] or [next_speaker(chat)]
+
+
+def generate_responses(client, chat, agent_names, model=DEFAULT_MODEL, cancel_event=None,
+                       turn_budget=DEFAULT_TURN_BUDGET):
+    """让选中的角色依次回应，后面的角色能看到前面的回应，返回 [(角色名, 内容)]
+
+    turn_budget 是这一轮的总秒数（0 表示不限），剩余时间平均分给还没发言的角色。
+    """
+    snapshot = chat_snapshot(chat)
+    instruction = REPLY_INSTRUCTION.format(user_role=chat.get('user_role', '用户'))
+    replies = []
+    finish_by = time.perf_counter() + turn_budget if turn_budget else None
+    for i, name in enumerate(agent_names):
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        deadline = None
+        if finish_by is not None:
+            deadline = max(finish_by - time.perf_counter(), 0) / (len(agent_names) - i)
+        content = generate_agent_reply(client, snapshot, name, instruction, model=model, deadline=deadline)
+        replies.append((name, content))
+        snapshot['chat_history'].append([name, snapshot['agents'].get(name, {}).get('avatar', '👤'), content, ''])
+    return replies
+
+
+# ================== 预生成缓存 ==================
+def history_fingerprint(chat):
+    """场景和聊天记录的指纹，任何变化都会让预生成结果失效"""
+    history = chat.get('chat_history', [])
+    # 只取用户可编辑的字段，编译缓存之类的派生字段不影响指纹
+    agents = {
+        name: [data.get('avatar'), data.get('personality', ''), data.get('system_prompt', '')]
+        for name, data in chat.get('agents', {}).items()
+    }
+    payload = [
+        chat.get('branch'),
+        chat.get('scenario', ''),
+        chat.get('user_role', ''),
+        agents,
+        chat.get('history_offset', 0) + len(history),
+        history[-1] if history else None,
+    ]
+    return hashlib.sha1(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SpeculativeCache:
+    """在用户输入期间预先生成下一位角色的发言
+
+    每个聊天最多保留一条预生成结果，取用时若记录已变化或超过 ttl 秒则丢弃。
+    """
+
+    def __init__(self, ttl=120, max_workers=2):
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative")
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _expired(self, entry):
+        return time.monotonic() - entry['created'] > self.ttl
+
+    def prefetch(self, client, chat, model=DEFAULT_MODEL):
+        """在后台生成下一位角色的发言"""
+        agent_name = next_speaker(chat)
+        if agent_name is None:
+            return
+        chat_id = chat.get('id')
+        # 预生成的结果可能用不上，接近预算时不再预取
+        if usage_ledger.check(chat_id) != 'ok':
+            return
+        fingerprint = history_fingerprint(chat)
+
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if self._expired(e)]:
+                self._entries.pop(key)['future'].cancel()
+
+            entry = self._entries.get(chat_id)
+            if entry and entry['fingerprint'] == fingerprint and entry['agent'] == agent_name:
+                return
+            if entry:
+                entry['future'].cancel()
+
+            # 后台线程只接触快照，不读写会话状态
+            snapshot = chat_snapshot(chat)
+            self._entries[chat_id] = {
+                'fingerprint': fingerprint,
+                'agent': agent_name,
+                'future': self._executor.submit(generate_agent_turn, client, snapshot, agent_name, model),
+                'created': time.monotonic(),
+            }
+
+    def take(self, chat, agent_name, timeout=None):
+        """取出与当前记录匹配的预生成结果，没有可用结果时返回 None"""
+        with self._lock:
+            entry = self._entries.pop(chat.get('id'), None)
+        if entry is None:
+            return None
+        if (entry['fingerprint'] != history_fingerprint(chat)
+                or entry['agent'] != agent_name
+                or self._expired(entry)):
+            entry['future'].cancel()
+            return None
+        try:
+            return entry['future'].result(timeout=timeout)
+        except Exception:
+            return None
+
+    def discard(self, chat_id):
+        """丢弃某个聊天的预生成结果"""
+        with self._lock:
+            entry = self._entries.pop(chat_id, None)
+        if entry:
+            entry['future'].cancel()
+
+
+# ================== 后台生成 ==================
+# 完成后超过这么多秒仍没有被取回的任务直接丢弃（关掉的标签页不会再来轮询）
+FINISHED_JOB_TTL = 600
+
+
+class GenerationWorker:
+    """在脚本重跑之外执行模型生成的线程池
+
+    任务归属于提交它的会话（owner）和聊天，同一会话对同一聊天的同一 key 同时只有一个任务，
+    重复点击不会叠加请求。界面轮询 collect 取回结果，cancel 之后结果直接丢弃。
+    任务函数需要接受 cancel_event 参数，多步任务在每步之间检查它。
+    完成后 job_ttl 秒内没有被取回的任务在下次提交或取回时清理。
+    """
+
+    def __init__(self, max_workers=4, job_ttl=FINISHED_JOB_TTL):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generation")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.job_ttl = job_ttl
+
+    def _prune(self):
+        """丢弃完成太久、一直没有被取回的任务，调用方持有锁"""
+        expired = time.monotonic() - self.job_ttl
+        for job_id, job in list(self._jobs.items()):
+            if job['future'].done() and job.get('finished', expired) < expired:
+                del self._jobs[job_id]
+
+    def submit(self, owner, chat_id, key, label, fn, *args, context=None, **kwargs):
+        """提交任务并返回任务ID，相同的任务已在进行时返回已有任务的ID"""
+        with self._lock:
+            self._prune()
+            for job in self._jobs.values():
+                if (job['owner'], job['chat_id'], job['key']) == (owner, chat_id, key) and not job['cancel'].is_set():
+                    return job['id']
+            cancel = threading.Event()
+            job_id = uuid.uuid4().hex[:12]
+            self._jobs[job_id] = {
+                'id': job_id,
+                'owner': owner,
+                'chat_id': chat_id,
+                'key': key,
+                'label': label,
+                'context': context or {},
+                'cancel': cancel,
+                'created': time.monotonic(),
+                'future': self._executor.submit(self._run, fn, cancel, args, kwargs),
+            }
+            job = self._jobs[job_id]
+
+        def mark_finished(_):
+            job['finished'] = time.monotonic()
+
+        job['future'].add_done_callback(mark_finished)
+        return job_id
+
+    @staticmethod
+    def _run(fn, cancel, args, kwargs):
+        if cancel.is_set():
+            return None
+        return fn(*args, cancel_event=cancel, **kwargs)
+
+    def pending(self, owner, chat_id=None):
+        """尚未完成的任务"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [
+            job for job in jobs
+            if job['owner'] == owner and (chat_id is None or job['chat_id'] == chat_id)
+            and not job['future'].done() and not job['cancel'].is_set()
+        ]
+
+    def has_jobs(self, owner):
+        """会话是否有未取消、未取回的任务"""
+        with self._lock:
+            return any(job['owner'] == owner and not job['cancel'].is_set() for job in self._jobs.values())
+
+    def collect(self, owner):
+        """取出已完成的任务，返回 [(任务, 结果, 异常)]，已取消的任务直接丢弃"""
+        finished = []
+        with self._lock:
+            self._prune()
+            for job_id, job in list(self._jobs.items()):
+                if job['owner'] != owner:
+                    continue
+                if job['cancel'].is_set():
+                    if job['future'].done():
+                        del self._jobs[job_id]
+                    continue
+                if job['future'].done():
+                    del self._jobs[job_id]
+                    finished.append(job)
+        results = []
+        for job in finished:
+            error = job['future'].exception()
+            results.append((job, None if error else job['future'].result(), error))
+        return results
+
+    def cancel(self, job_id):
+        """取消任务：未开始的不再执行，执行中的在下一步之前停下，结果不再交付"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job['cancel'].set()
+        job['future'].cancel()
+        return True
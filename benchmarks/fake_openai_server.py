@@ -0,0 +1,145 @@
+"""本地的 OpenAI chat-completions 接口桩，用于压测和离线调试
+
+用法：
+    python benchmarks/fake_openai_server.py --port 8765 --latency 0.5 --chunk-delay 0.02
+
+然后以 DEEPSEEK_BASE_URL=http://127.0.0.1:8765 启动应用。
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_reply(body):
+    """根据请求内容编造一条回复"""
+    messages = body.get('messages', [])
+    if (body.get('response_format') or {}).get('type') == 'json_object':
+        # 批量介绍：从系统提示的角色列表中取出角色名
+        system = messages[0]['content'] if messages else ''
+        names = [line[2:].split(' ')[0] for line in system.splitlines() if line.startswith('- ')]
+        return json.dumps(
+            {"introductions": [{"name": name, "content": f"你好，我是{name}。"} for name in names]},
+            ensure_ascii=False,
+        )
+    last = messages[-1]['content'] if messages else ''
+    return f"（压测回复）收到：{last[:30]}"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    latency = 0.2
+    chunk_delay = 0.01
+    chunk_size = 8
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+
+        content = fake_reply(body)
+        prompt_tokens = sum(len(m.get('content') or '') for m in body.get('messages', []))
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': len(content),
+            'total_tokens': prompt_tokens + len(content),
+            'prompt_cache_hit_tokens': prompt_tokens // 2,
+            'prompt_cache_miss_tokens': prompt_tokens - prompt_tokens // 2,
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get('model', 'deepseek-chat')
+
+        time.sleep(self.latency)
+        if body.get('stream'):
+            self._stream(completion_id, model, content, usage)
+        else:
+            self._respond(completion_id, model, content, usage)
+
+    def _respond(self, completion_id, model, content, usage):
+        payload = json.dumps({
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': usage,
+        }, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _stream(self, completion_id, model, content, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for start in range(0, len(content), self.chunk_size):
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'delta': {'content': content[start:start + self.chunk_size]},
+                    'finish_reason': None,
+                }],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(self.chunk_delay)
+        final = {
+            'id': completion_id,
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        }
+        self.wfile.write(f"data: {json.dumps(final, ensure_ascii=False)}\n\n".encode('utf-8'))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_server(host="127.0.0.1", port=0, latency=0.2, chunk_delay=0.01):
+    """在后台线程启动接口桩，返回 (server, base_url)"""
+    handler = type('ConfiguredHandler', (FakeOpenAIHandler,), {
+        'latency': latency,
+        'chunk_delay': chunk_delay,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI chat-completions 接口桩")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2, help="首个 token 前的延迟（秒）")
+    parser.add_argument('--chunk-delay', type=float, default=0.01, help="流式输出时每块之间的延迟（秒）")
+    args = parser.parse_args()
+
+    server, base_url = start_server(args.host, args.port, args.latency, args.chunk_delay)
+    print(f"接口桩已启动：{base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""用 Streamlit AppTest 模拟多个并发会话压测聊天应用
+
+每个会话依次执行：创建场景、添加角色、开始角色扮演、角色介绍、发送公共消息、
+AI互动、保存和刷新聊天列表。模型请求全部发往本地接口桩，或者从录制的磁带回放。
+
+用法：
+    python benchmarks/load_test.py --sessions 8 --iterations 3 --latency 0.3
+    python benchmarks/load_test.py --cassette runs/deepseek.jsonl --cassette-mode replay --cassette-speed 1
+
+AppTest 会修改进程级的全局状态，不能在线程间并发使用，因此每个会话运行在
+独立的进程里；RSS 按会话进程分别采样，同时报告合计值。
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from fake_openai_server import start_server
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from model_cassette import CASSETTE_ENV, CASSETTE_MODE_ENV, CASSETTE_SPEED_ENV, MODES  # noqa: E402
+
+APP_PATH = Path(__file__).resolve().parent.parent / "ultimate_chat_manager.py"
+
+
+def current_rss():
+    """当前进程的常驻内存（字节）"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 以字节为单位，Linux 以 KB 为单位
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RssSampler:
+    """后台采样 RSS，记录起始值和峰值"""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.start = current_rss()
+        self.peak = self.start
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.end = current_rss()
+        self.peak = max(self.peak, self.end)
+
+
+def find_by_label(elements, label):
+    for element in elements:
+        if element.label == label:
+            return element
+    raise LookupError(label)
+
+
+def run_session(session_idx, iterations, timeout):
+    """在子进程中执行一个会话的完整流程，返回步骤耗时和内存占用"""
+    with RssSampler() as rss:
+        timings = _run_flows(session_idx, iterations, timeout)
+    return {'timings': timings, 'rss_start': rss.start, 'rss_peak': rss.peak}
+
+
+def _run_flows(session_idx, iterations, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    timings = []
+
+    def step(name, at, wait=False):
+        start = time.perf_counter()
+        at.run(timeout=timeout)
+        # 模型请求在后台执行，等到结果写回聊天再计时结束
+        while wait and not at.exception and any(b.key and b.key.startswith("cancel_gen_") for b in at.button):
+            time.sleep(0.02)
+            at.run(timeout=timeout)
+        timings.append((name, time.perf_counter() - start))
+        if at.exception:
+            raise RuntimeError(f"会话 {session_idx} 在「{name}」出错：{at.exception[0].message}")
+
+    at = AppTest.from_file(str(APP_PATH), default_timeout=timeout)
+    step("bootstrap", at)
+
+    for iteration in range(iterations):
+        at.button(key="new_chat_btn").click()
+        step("create_scene", at)
+
+        find_by_label(at.text_input, "🎭 场景名称:").input(f"压测场景 {session_idx}-{iteration}")
+        at.text_area[0].input("一个用于压测的场景：几位角色在酒馆里闲聊。")
+        find_by_label(at.text_input, "批量添加角色 (用逗号分隔):").input("酒馆老板, 吟游诗人, 佣兵")
+        at.button(key="quick_add").click()
+        step("add_agents", at)
+
+        at.button(key="start_roleplay").click()
+        step("start_roleplay", at)
+
+        at.button(key="start_intro_btn").click()
+        step("introductions", at, wait=True)
+
+        at.text_area(key="public_input").input("大家好，今晚有什么新鲜事？")
+        at.button(key="send_public").click()
+        step("send_public", at, wait=True)
+
+        at.button(key="ai_interact_btn").click()
+        step("ai_interact", at, wait=True)
+
+        at.button(key="save_btn").click()
+        step("save", at)
+
+        at.button(key="refresh_btn").click()
+        step("list_chats", at)
+
+    return timings
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean_ms': round(statistics.fmean(values) * 1000, 2),
+        'p50_ms': round(values[len(values) // 2] * 1000, 2),
+        'p95_ms': round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 2),
+        'max_ms': round(values[-1] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天应用的无头压测")
+    parser.add_argument('--sessions', type=int, default=4, help="并发会话数")
+    parser.add_argument('--iterations', type=int, default=2, help="每个会话执行完整流程的次数")
+    parser.add_argument('--latency', type=float, default=0.2, help="接口桩的响应延迟（秒）")
+    parser.add_argument('--chunk-delay', type=float, default=0.01, help="接口桩流式输出每块的延迟（秒）")
+    parser.add_argument('--timeout', type=float, default=60, help="单次重跑的超时（秒）")
+    parser.add_argument('--data-dir', default=None, help="运行目录，默认使用临时目录")
+    parser.add_argument('--output', default=None, help="把结果写入 JSON 文件")
+    parser.add_argument('--base-url', default=None, help="请求这个真实接口而不是接口桩，通常配合录制使用")
+    parser.add_argument('--cassette', default=None, help="模型调用磁带路径，配合 --cassette-mode 录制或回放")
+    parser.add_argument('--cassette-mode', default="replay", choices=MODES)
+    parser.add_argument('--cassette-speed', type=float, default=1.0, help="回放延迟的倍数，0 表示不等待")
+    args = parser.parse_args()
+
+    if args.cassette:
+        # 会话进程继承这些环境变量，在 get_ai_client 中包装客户端
+        os.environ[CASSETTE_ENV] = os.path.abspath(args.cassette)
+        os.environ[CASSETTE_MODE_ENV] = args.cassette_mode
+        os.environ[CASSETTE_SPEED_ENV] = str(args.cassette_speed)
+
+    # 指定了真实接口时直接请求它，只回放时不需要任何接口，其余情况使用接口桩
+    server = None
+    if args.base_url:
+        os.environ['DEEPSEEK_BASE_URL'] = args.base_url
+    elif not (args.cassette and args.cassette_mode == 'replay'):
+        server, base_url = start_server(latency=args.latency, chunk_delay=args.chunk_delay)
+        os.environ['DEEPSEEK_BASE_URL'] = base_url
+    os.environ.setdefault('DEEPSEEK_API_KEY', 'load-test')
+
+    output = os.path.abspath(args.output) if args.output else None
+
+    # 应用在当前目录下读写 chat_data
+    work_dir = args.data_dir or tempfile.mkdtemp(prefix="chat_load_test_")
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.sessions) as pool:
+        futures = [pool.submit(run_session, i, args.iterations, args.timeout) for i in range(args.sessions)]
+        results = [f.result() for f in futures]
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.shutdown()
+
+    all_timings = [t for session in results for t in session['timings']]
+    session_peaks = [session['rss_peak'] for session in results]
+    by_step = {}
+    for name, seconds in all_timings:
+        by_step.setdefault(name, []).append(seconds)
+
+    report = {
+        'sessions': args.sessions,
+        'iterations': args.iterations,
+        'model_latency_s': args.latency,
+        'elapsed_s': round(elapsed, 3),
+        'reruns': len(all_timings),
+        'reruns_per_s': round(len(all_timings) / elapsed, 2),
+        'flows_per_s': round(args.sessions * args.iterations / elapsed, 3),
+        'rerun_latency': summarize([s for _, s in all_timings]),
+        'steps': {name: summarize(values) for name, values in by_step.items()},
+        'rss_mb': {
+            'session_start': round(statistics.fmean(s['rss_start'] for s in results) / 2**20, 1),
+            'session_peak_max': round(max(session_peaks) / 2**20, 1),
+            'session_peak_mean': round(statistics.fmean(session_peaks) / 2**20, 1),
+            'total_peak': round(sum(session_peaks) / 2**20, 1),
+        },
+        'work_dir': work_dir,
+    }
+
+    print(f"{args.sessions} 个会话 × {args.iterations} 轮，用时 {report['elapsed_s']}s")
+    print(f"吞吐：{report['reruns_per_s']} 次重跑/秒，{report['flows_per_s']} 个流程/秒")
+    print(f"RSS：单会话峰值 {report['rss_mb']['session_peak_max']} MB，合计 {report['rss_mb']['total_peak']} MB")
+    print(f"{'步骤':<16}{'次数':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'max(ms)':>10}")
+    for name, s in report['steps'].items():
+        print(f"{name:<16}{s['count']:>6}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['max_ms']:>10}")
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
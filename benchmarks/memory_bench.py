@@ -0,0 +1,69 @@
+"""检索记忆（MemoryIndex）微基准
+
+用与 storage_bench 相同的合成中文语料建立索引，测量增量建索引的吞吐和 top-k 检索延迟，
+目标是 10 万条消息的聊天单次检索在 10 ms 以内。
+
+用法：
+    python benchmarks/memory_bench.py --messages 100000 --queries 200
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from memory_index import MemoryIndex  # noqa: E402
+from storage_bench import AGENTS, random_text  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检索记忆微基准")
+    parser.add_argument('--messages', type=int, default=100000, help="索引的消息条数")
+    parser.add_argument('--queries', type=int, default=200, help="检索次数")
+    parser.add_argument('--top-k', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None, help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    speakers = [name for name, _ in AGENTS] + ["旅人"]
+    texts = [random_text(rng) for _ in range(args.messages)]
+
+    index = MemoryIndex()
+    start = time.perf_counter()
+    for position, text in enumerate(texts):
+        index.add(rng.choice(speakers), text, position)
+    build_seconds = time.perf_counter() - start
+
+    # 查询和请求窗口一样取最近几条消息拼接
+    durations = []
+    for _ in range(args.queries):
+        query = "\n".join(random_text(rng) for _ in range(3))
+        start = time.perf_counter()
+        index.search(query, k=args.top_k, before=args.messages - 40)
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+
+    result = {
+        'messages': args.messages,
+        'build_s': round(build_seconds, 3),
+        'build_per_message_us': round(build_seconds / args.messages * 1e6, 1),
+        'search_p50_ms': round(statistics.median(durations) * 1000, 3),
+        'search_p95_ms': round(durations[int(len(durations) * 0.95) - 1] * 1000, 3),
+        'search_max_ms': round(durations[-1] * 1000, 3),
+    }
+    print(f"{args.messages} 条消息，建索引 {result['build_s']}s（每条 {result['build_per_message_us']} µs）")
+    print(f"检索 p50 {result['search_p50_ms']} ms，p95 {result['search_p95_ms']} ms，max {result['search_max_ms']} ms")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
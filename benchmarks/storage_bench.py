@@ -0,0 +1,296 @@
+"""ChatManager 存储微基准
+
+生成可复现的合成 chat_data 语料（以中文为主的文本），测量 get_all_chats、新会话启动、
+load_chat（完整、只取尾部和冷存储）、save_chat、rename_chat、delete_chat 的耗时、
+写入字节数和峰值内存，以及冷存储压缩前后的磁盘占用，结果输出为 JSON，便于在不同提交之间对比。
+
+用法：
+    python benchmarks/storage_bench.py --preset small --output before.json
+    python benchmarks/storage_bench.py --preset small --output after.json --compare before.json
+    python benchmarks/storage_bench.py --case 50000x20 --case 10x100000
+"""
+import argparse
+import json
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from chat_storage import ChatManager, append_public_message, new_stats  # noqa: E402
+
+# (聊天数, 每个聊天的消息数)
+PRESETS = {
+    'smoke': [(10, 10), (100, 100)],
+    'small': [(10, 10), (1000, 20), (10, 10000)],
+    'medium': [(10, 10), (10000, 20), (100, 1000), (10, 100000)],
+    'large': [(10, 10), (10000, 20), (50000, 20), (100, 10000), (10, 100000)],
+}
+
+CJK_TEXT = (
+    "雨夜的咖啡馆里灯光昏黄老板擦拭着杯子角落里的旅人低声说起远方的传闻"
+    "巫师抬起头看向窗外仿佛在等待某个早已注定的时刻商人打开箱子露出奇异的光芒"
+    "侦探默默记下每一个细节时空旅人不停地看表好像害怕错过什么重要的事情"
+)
+PUNCTUATION = "，。！？……“”"
+# load_tail 解码的最近消息条数，与界面打开聊天时一致
+TAIL = 60
+AGENTS = [("神秘巫师", "🧙"), ("咖啡馆老板", "👤"), ("时空旅人", "👽"), ("神秘商人", "🧚")]
+
+
+def random_text(rng, min_len=20, max_len=120):
+    """以中文为主、夹杂少量 ASCII 的随机文本"""
+    chars = []
+    for _ in range(rng.randint(min_len, max_len)):
+        roll = rng.random()
+        if roll < 0.85:
+            chars.append(rng.choice(CJK_TEXT))
+        elif roll < 0.95:
+            chars.append(rng.choice(PUNCTUATION))
+        else:
+            chars.append(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789 "))
+    return "".join(chars)
+
+
+def make_chat(rng, index, messages):
+    """生成一个合成聊天"""
+    chat = {
+        'title': f"合成场景 {index}",
+        'scenario': random_text(rng, 80, 200),
+        'user_role': "旅人",
+        'agents': {
+            name: {'avatar': avatar, 'system_prompt': '', 'personality': random_text(rng, 20, 60)}
+            for name, avatar in AGENTS
+        },
+        'chat_history': [],
+        'private_history': {},
+        'branch_stats': new_stats(),
+        'private_stats': new_stats(),
+        'created': datetime.now().isoformat(),
+    }
+    speakers = [("旅人", "👤")] + AGENTS
+    for _ in range(messages):
+        speaker, avatar = rng.choice(speakers)
+        append_public_message(chat, speaker, avatar, random_text(rng), "12:00")
+    return chat
+
+
+def build_corpus(manager, rng, chats, messages):
+    """写入合成语料，返回聊天ID列表"""
+    # 长历史的聊天共用同一份模板，只改标题，避免生成时间远大于测量时间
+    template = make_chat(rng, 0, messages)
+    chat_ids = []
+    for index in range(chats):
+        chat = dict(template, title=f"合成场景 {index}")
+        chat_ids.append(manager.save_chat(chat))
+    return chat_ids
+
+
+def disk_usage(path):
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+
+def bytes_written():
+    """进程累计写出的字节数（仅 Linux），其他平台返回 None"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure(fn, args_list):
+    """依次执行 fn(*args)，返回耗时统计和平均写入字节数"""
+    durations = []
+    written = []
+    for args in args_list:
+        before = bytes_written()
+        start = time.perf_counter()
+        fn(*args)
+        durations.append(time.perf_counter() - start)
+        after = bytes_written()
+        if before is not None and after is not None:
+            written.append(after - before)
+
+    return {
+        'runs': len(durations),
+        'min_ms': round(min(durations) * 1000, 3),
+        'p50_ms': round(statistics.median(durations) * 1000, 3),
+        'mean_ms': round(statistics.fmean(durations) * 1000, 3),
+        'max_ms': round(max(durations) * 1000, 3),
+        'bytes_written': round(statistics.fmean(written)) if written else None,
+    }
+
+
+def peak_memory(fn, *args):
+    """在 tracemalloc 下单独执行一次，返回峰值内存（KB）"""
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+def run_case(chats, messages, repeat, seed, work_dir):
+    """对一种语料规模执行全部测量"""
+    rng = random.Random(seed)
+    data_dir = Path(work_dir) / f"chat_data_{chats}x{messages}"
+    manager = ChatManager(data_dir)
+
+    start = time.perf_counter()
+    chat_ids = build_corpus(manager, rng, chats, messages)
+    build_seconds = time.perf_counter() - start
+
+    sample = [rng.choice(chat_ids) for _ in range(repeat)]
+    list_repeat = max(1, min(repeat, 3 if chats >= 10000 else repeat))
+
+    def save_one(chat_id):
+        chat = manager.load_chat(chat_id)
+        append_public_message(chat, "旅人", "👤", random_text(rng), "12:01")
+        manager.save_chat(chat, chat_id)
+
+    # append_and_save 包含一次加载，save_chat 只测纯写入
+    loaded = {chat_id: manager.load_chat(chat_id) for chat_id in set(sample)}
+
+    ops = {}
+    ops['get_all_chats'] = measure(manager.get_all_chats, [()] * list_repeat)
+    ops['get_all_chats']['peak_kb'] = peak_memory(manager.get_all_chats)
+
+    # 新会话启动：打开最新的聊天，再取侧边栏第一页，每次都用新的实例，不借助已缓存的列表
+    def bootstrap():
+        fresh = ChatManager(data_dir)
+        fresh.load_chat(fresh.latest_chat_id(), tail=TAIL)
+
+    ops['bootstrap'] = measure(bootstrap, [()] * list_repeat)
+    ops['list_first_page'] = measure(lambda: ChatManager(data_dir).list_chats(limit=10), [()] * list_repeat)
+    ops['load_chat'] = measure(manager.load_chat, [(i,) for i in sample])
+    ops['load_chat']['peak_kb'] = peak_memory(manager.load_chat, sample[0])
+    ops['load_tail'] = measure(lambda i: manager.load_chat(i, tail=TAIL), [(i,) for i in sample])
+    ops['load_tail']['peak_kb'] = peak_memory(manager.load_chat, sample[0], TAIL)
+    ops['save_chat'] = measure(lambda i: manager.save_chat(loaded[i], i), [(i,) for i in sample])
+    ops['save_chat']['peak_kb'] = peak_memory(manager.save_chat, loaded[sample[0]], sample[0])
+    ops['append_and_save'] = measure(save_one, [(i,) for i in sample])
+    ops['rename_chat'] = measure(manager.rename_chat, [(i, f"重命名 {n}") for n, i in enumerate(sample)])
+    ops['rename_chat']['peak_kb'] = peak_memory(manager.rename_chat, sample[0], "重命名")
+
+    # 全部转入冷存储，测量压缩收益和冷读取的额外开销
+    disk_hot = disk_usage(data_dir)
+    start = time.perf_counter()
+    tiering = manager.compress_inactive(days=0)
+    tiering['seconds'] = round(time.perf_counter() - start, 3)
+    tiering['disk_bytes'] = disk_usage(data_dir)
+    ops['load_cold'] = measure(manager.load_chat, [(i,) for i in sample])
+    ops['load_cold']['peak_kb'] = peak_memory(manager.load_chat, sample[0])
+
+    victims = chat_ids[:min(repeat, len(chat_ids))]
+    ops['delete_chat'] = measure(manager.delete_chat, [(i,) for i in victims])
+
+    result = {
+        'chats': chats,
+        'messages': messages,
+        'build_s': round(build_seconds, 3),
+        'disk_bytes': disk_hot,
+        'tiering': tiering,
+        'ops': ops,
+    }
+    shutil.rmtree(data_dir, ignore_errors=True)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_case(value):
+    chats, messages = value.lower().split("x")
+    return int(chats), int(messages)
+
+
+def compare(results, baseline_path):
+    """打印与基线结果的 p50 比值"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    base_cases = {(c['chats'], c['messages']): c for c in baseline['cases']}
+    print(f"\n对比基线 {baseline['meta'].get('commit')}（比值 < 1 表示更快）")
+    for case in results['cases']:
+        base = base_cases.get((case['chats'], case['messages']))
+        if base is None:
+            continue
+        print(f"  {case['chats']}x{case['messages']}")
+        for op, stats in case['ops'].items():
+            base_stats = base['ops'].get(op)
+            if base_stats and base_stats['p50_ms']:
+                ratio = stats['p50_ms'] / base_stats['p50_ms']
+                print(f"    {op:<16}{base_stats['p50_ms']:>12.3f} → {stats['p50_ms']:>10.3f} ms  ×{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ChatManager 存储微基准")
+    parser.add_argument('--preset', choices=PRESETS, default='small')
+    parser.add_argument('--case', action='append', type=parse_case, default=None,
+                        help="自定义规模，格式为 聊天数x消息数，可重复")
+    parser.add_argument('--repeat', type=int, default=20, help="每项操作的重复次数")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--work-dir', default=None, help="语料目录，默认使用临时目录")
+    parser.add_argument('--output', default=None, help="把结果写入 JSON 文件")
+    parser.add_argument('--compare', default=None, help="与之前输出的 JSON 结果对比")
+    args = parser.parse_args()
+
+    cases = args.case or PRESETS[args.preset]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="chat_storage_bench_")
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+        },
+        'cases': [],
+    }
+    try:
+        for chats, messages in cases:
+            print(f"测量 {chats} 个聊天 × {messages} 条消息 ...", flush=True)
+            case = run_case(chats, messages, args.repeat, args.seed, work_dir)
+            results['cases'].append(case)
+            tiering = case['tiering']
+            print(f"  冷存储：{case['disk_bytes']} → {tiering['disk_bytes']} 字节，"
+                  f"压缩 {tiering['chats']} 个聊天用时 {tiering['seconds']}s")
+            for op, stats in case['ops'].items():
+                print(f"  {op:<16}p50 {stats['p50_ms']:>10.3f} ms  max {stats['max_ms']:>10.3f} ms"
+                      f"  写入 {stats['bytes_written']}  峰值 {stats.get('peak_kb', '-')} KB")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
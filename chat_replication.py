@@ -0,0 +1,461 @@
+"""chat_data 的增量备份和快照恢复
+
+读取 ChatManager 的变更日志，只复制保存或删除过的聊天。文件切成固定大小的块，按内容哈希存放，
+相同的块只存一份；记录文件只会在末尾追加，未变的前缀块不会重新读取和上传。
+每次复制生成一个快照，只记录相对上一个快照变化的聊天，恢复时沿快照链合并。
+副本可以是本地目录，也可以是 S3 兼容的对象存储（如本地的 MinIO，需要安装 boto3）。
+
+用法：
+    python chat_replication.py replicate --target backups/chat_data
+    python chat_replication.py watch --target backups/chat_data --interval 30
+    python chat_replication.py replicate --s3-bucket chat-backup --s3-endpoint http://127.0.0.1:9000
+    python chat_replication.py list --target backups/chat_data
+    python chat_replication.py restore 20261019-120000-000 --target backups/chat_data --into restored_chat_data
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from chat_storage import CHAT_FILE, COLD_FILE, OFFSET_SIZE, VERSIONS_FILE, ChatManager
+
+logger = logging.getLogger(__name__)
+
+# 本地的复制进度（变更日志读到的位置、每个聊天最近一次复制的清单）
+STATE_DIR = ".replication"
+
+# 文件按这个大小切块，追加写入的记录文件只有最后的块会变化
+BLOCK_SIZE = 1 << 20
+
+# 每隔这么多个增量快照写一次完整快照，恢复时不必沿很长的链回溯
+FULL_SNAPSHOT_EVERY = 50
+
+
+# ================== 副本存储 ==================
+class LocalStore:
+    """本地目录作为副本存储"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def exists(self, key):
+        return (self.root / key).exists()
+
+    def put(self, key, data):
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        with open(self.root / key, 'rb') as f:
+            return f.read()
+
+    def list(self, prefix):
+        directory = self.root / prefix
+        if not directory.is_dir():
+            return []
+        return sorted(f"{prefix}/{path.name}" for path in directory.iterdir() if not path.name.startswith('.'))
+
+
+class S3Store:
+    """S3 兼容的对象存储作为副本存储，endpoint_url 指向 MinIO 等本地服务"""
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, **client_kwargs):
+        import boto3
+        from botocore.exceptions import ClientError
+        self._client_error = ClientError
+        self._s3 = boto3.client('s3', endpoint_url=endpoint_url, **client_kwargs)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ""
+
+    def exists(self, key):
+        try:
+            self._s3.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self._client_error as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def put(self, key, data):
+        self._s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def get(self, key):
+        return self._s3.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+
+    def list(self, prefix):
+        keys = []
+        paginator = self._s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}{prefix}/"):
+            keys.extend(item['Key'][len(self.prefix):] for item in page.get('Contents', []))
+        return sorted(keys)
+
+
+# ================== 复制 ==================
+def _block_key(digest):
+    return f"blocks/{digest[:2]}/{digest}"
+
+
+def _snapshot_key(snapshot_id):
+    return f"snapshots/{snapshot_id}.json"
+
+
+class Replicator:
+    """把 chat_data 的变化增量复制到副本存储"""
+
+    def __init__(self, chat_manager, store, block_size=BLOCK_SIZE):
+        self.chat_manager = chat_manager
+        self.store = store
+        self.block_size = block_size
+        self.state_dir = chat_manager.data_dir / STATE_DIR
+        self.state_dir.mkdir(exist_ok=True)
+        self._lock = threading.Lock()
+        # 后台复制的状态，供界面显示
+        self.last_success = None
+        self.last_error = None
+        self.last_error_at = None
+
+    # ---------- 本地进度 ----------
+    def _read_state(self, name, default):
+        try:
+            with open(self.state_dir / name, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def _write_state(self, name, value):
+        path = self.state_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _chat_state(self, chat_id):
+        return f"chats/{chat_id}.json"
+
+    # ---------- 变更来源 ----------
+    def _changed_chats(self, cursor):
+        """返回 (变化的聊天ID集合, 新的日志位置)；日志被轮换或第一次运行时返回 None，需要全量比对"""
+        journal_path = self.chat_manager.journal_path
+        try:
+            stat = os.stat(journal_path)
+        except FileNotFoundError:
+            return (set() if cursor else None), None
+        if not cursor or cursor['inode'] != stat.st_ino or cursor['offset'] > stat.st_size:
+            return None, {'inode': stat.st_ino, 'offset': stat.st_size}
+        with open(journal_path, 'rb') as f:
+            f.seek(cursor['offset'])
+            chunk = f.read(stat.st_size - cursor['offset'])
+        complete = chunk[:chunk.rfind(b"\n") + 1]
+        changed = set()
+        for line in complete.decode('utf-8').splitlines():
+            try:
+                chat_id = json.loads(line).get('id')
+            except ValueError:
+                continue
+            if chat_id:
+                changed.add(chat_id)
+        return changed, {'inode': stat.st_ino, 'offset': cursor['offset'] + len(complete)}
+
+    def _all_chat_ids(self):
+        """现有的聊天加上复制过、可能已被删除的聊天"""
+        ids = set(self.chat_manager.chat_ids())
+        ids.update(path.stem for path in (self.state_dir / "chats").glob("*.json"))
+        return ids
+
+    # ---------- 单个聊天 ----------
+    def _file_blocks(self, path, previous, valid=None):
+        """按块哈希文件并上传缺少的块，返回文件清单；与上次相比只在末尾追加时复用前面的块
+
+        valid 是头部引用到的有效长度，之后的字节可能是中断写入的残余，下次追加时会被截掉重写。
+        """
+        stat = os.stat(path)
+        if previous and (previous['ino'], previous['size'], previous['mtime']) == (stat.st_ino, stat.st_size, stat.st_mtime):
+            return previous, 0
+        blocks = []
+        start = 0
+        if previous and previous['ino'] == stat.st_ino and previous['size'] <= stat.st_size:
+            # 只复用完全落在上次有效长度之内的块：最后一个不满的块可能被追加过，
+            # 有效长度之后的残余会被原地重写，包含上次有效末尾的块都要重新哈希
+            keep = min(previous['size'], previous.get('valid', previous['size'])) // self.block_size
+            blocks = previous['blocks'][:keep]
+            start = keep * self.block_size
+        uploaded = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while True:
+                data = f.read(self.block_size)
+                if not data:
+                    break
+                digest = hashlib.sha256(data).hexdigest()
+                if not self.store.exists(_block_key(digest)):
+                    self.store.put(_block_key(digest), data)
+                    uploaded += len(data)
+                blocks.append(digest)
+        manifest = {'ino': stat.st_ino, 'size': stat.st_size, 'mtime': stat.st_mtime, 'blocks': blocks}
+        manifest['valid'] = stat.st_size if valid is None else min(valid, stat.st_size)
+        return manifest, uploaded
+
+    def _header_files(self, chat_id, filepath, data):
+        """头部引用的其他文件：各分支的记录文件和候选版本文件，返回 (目录, [(文件名, 有效长度)])
+
+        记录文件的有效长度按头部的消息数从偏移索引读出；候选版本文件只追加，整个文件都有效。
+        """
+        chat_dir = self.chat_manager._chat_dir(chat_id)
+        names = []
+        if filepath.name == CHAT_FILE and filepath.parent == chat_dir:
+            header = json.loads(data)
+            for info in header.get('branches', {}).values():
+                if info.get('history_file'):
+                    count = info['history_count'] - info.get('fork_at', 0)
+                    _, idx_path = self.chat_manager._history_paths(chat_id, info['history_file'])
+                    end = self.chat_manager._read_offsets(idx_path, count, count)[0]
+                    names += [(f"{info['history_file']}.jsonl", end), (f"{info['history_file']}.idx", count * OFFSET_SIZE)]
+        if (chat_dir / VERSIONS_FILE).exists():
+            names.append((VERSIONS_FILE, None))
+        return chat_dir, names
+
+    def _replicate_chat(self, chat_id, previous):
+        """复制一个聊天，返回 (清单, 上传字节数)；聊天已删除时清单为 None
+
+        文件在读取期间反复被重写，重试几次仍读不完整时抛出 FileNotFoundError。
+        """
+        previous_files = (previous or {}).get('files', {})
+        error = None
+        for _ in range(3):
+            filepath = self.chat_manager._find_chat_file(chat_id)
+            if filepath is None:
+                return None, 0
+            try:
+                # 先读头部，再读它引用的文件；记录文件在头部之后追加的内容读者会忽略
+                data = filepath.read_bytes()
+                name = COLD_FILE if filepath.name == COLD_FILE else CHAT_FILE
+                digest = hashlib.sha256(data).hexdigest()
+                uploaded = 0
+                if not self.store.exists(_block_key(digest)):
+                    self.store.put(_block_key(digest), data)
+                    uploaded += len(data)
+                files = {name: {'size': len(data), 'blocks': [digest]}}
+                chat_dir, names = self._header_files(chat_id, filepath, data)
+                for other, valid in names:
+                    files[other], size = self._file_blocks(chat_dir / other, previous_files.get(other), valid)
+                    uploaded += size
+                return {'files': files}, uploaded
+            except FileNotFoundError as e:
+                # 读取期间被重写、压缩或迁移，重新读一次头部
+                error = e
+        raise error
+
+    # ---------- 快照 ----------
+    def snapshots(self):
+        """副本中的快照ID，按时间排序"""
+        return [Path(key).stem for key in self.store.list("snapshots")]
+
+    def replicate(self, full=False):
+        """复制上次之后变化的聊天并生成快照，没有变化时不生成，返回复制报告"""
+        with self._lock, self._process_lock() as acquired:
+            if not acquired:
+                return None
+            cursor = self._read_state("cursor.json", None)
+            changed, new_cursor = self._changed_chats(None if full else cursor)
+            if changed is None:
+                changed = self._all_chat_ids()
+
+            report = {'snapshot': None, 'chats': 0, 'deleted': 0, 'failed': [], 'bytes_uploaded': 0}
+            changes = {}
+            for chat_id in sorted(changed):
+                previous = self._read_state(self._chat_state(chat_id), None)
+                try:
+                    manifest, uploaded = self._replicate_chat(chat_id, previous)
+                except FileNotFoundError:
+                    report['failed'].append(chat_id)
+                    continue
+                report['bytes_uploaded'] += uploaded
+                if manifest == previous:
+                    continue
+                changes[chat_id] = manifest
+                if manifest is None:
+                    (self.state_dir / self._chat_state(chat_id)).unlink(missing_ok=True)
+                    report['deleted'] += 1
+                else:
+                    self._write_state(self._chat_state(chat_id), manifest)
+                    report['chats'] += 1
+
+            meta = self._read_state("snapshot.json", {'last': None, 'depth': 0})
+            if changes or full:
+                if full or meta['last'] is None or meta['depth'] + 1 >= FULL_SNAPSHOT_EVERY:
+                    # 完整快照：当前所有聊天的清单
+                    base, depth = None, 0
+                    changes = {
+                        path.stem: self._read_state(f"chats/{path.name}", None)
+                        for path in (self.state_dir / "chats").glob("*.json")
+                    }
+                else:
+                    base, depth = meta['last'], meta['depth'] + 1
+                snapshot_id = datetime.now().strftime("%Y%m%d-%H%M%S-%f")[:-3]
+                self.store.put(_snapshot_key(snapshot_id), json.dumps({
+                    'id': snapshot_id,
+                    'created': datetime.now().isoformat(),
+                    'base': base,
+                    'changes': {k: ({'files': {n: {'size': f['size'], 'blocks': f['blocks']} for n, f in v['files'].items()}}
+                                    if v else None) for k, v in changes.items()},
+                }, ensure_ascii=False).encode('utf-8'))
+                self._write_state("snapshot.json", {'last': snapshot_id, 'depth': depth})
+                report['snapshot'] = snapshot_id
+            # 有聊天没复制成功时不推进日志位置，下次从同一位置重读，这些聊天的变化不会丢
+            if new_cursor is not None and not report['failed']:
+                self._write_state("cursor.json", new_cursor)
+            return report
+
+    def _process_lock(self):
+        """同一数据目录同时只有一个进程在复制"""
+        return _FileLock(self.state_dir / "lock")
+
+    # ---------- 恢复 ----------
+    def resolve(self, snapshot_id):
+        """合并快照链，返回该时间点每个聊天的文件清单"""
+        chain = []
+        while snapshot_id is not None:
+            snapshot = json.loads(self.store.get(_snapshot_key(snapshot_id)))
+            chain.append(snapshot)
+            snapshot_id = snapshot['base']
+        chats = {}
+        for snapshot in reversed(chain):
+            for chat_id, manifest in snapshot['changes'].items():
+                if manifest is None:
+                    chats.pop(chat_id, None)
+                else:
+                    chats[chat_id] = manifest
+        return chats
+
+    def restore(self, snapshot_id, target_dir):
+        """把快照恢复到一个新的数据目录，返回恢复的聊天数"""
+        target = ChatManager(target_dir)
+        if target.chat_ids():
+            raise FileExistsError(f"{target_dir} 里已经有聊天，请恢复到空目录")
+        chats = self.resolve(snapshot_id)
+        for chat_id, manifest in chats.items():
+            chat_dir = target._chat_dir(chat_id)
+            chat_dir.mkdir(parents=True, exist_ok=True)
+            for name, entry in manifest['files'].items():
+                with open(chat_dir / name, 'wb') as f:
+                    for digest in entry['blocks']:
+                        f.write(self.store.get(_block_key(digest)))
+        return len(chats)
+
+    # ---------- 后台复制 ----------
+    def start(self, interval=30):
+        """在后台线程中定期复制，失败时记录日志并保留最近的错误"""
+        def loop():
+            while True:
+                try:
+                    report = self.replicate()
+                except Exception as e:
+                    logger.exception("复制 chat_data 失败")
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    self.last_error_at = time.time()
+                else:
+                    if report is not None and report['failed']:
+                        self.last_error = f"{len(report['failed'])} 个聊天读取期间反复被改写，下次重试"
+                        self.last_error_at = time.time()
+                    elif report is not None:
+                        self.last_success = time.time()
+                time.sleep(interval)
+        threading.Thread(target=loop, daemon=True).start()
+
+
+class _FileLock:
+    """非阻塞的文件锁，拿不到时 __enter__ 返回 False"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return True
+        self._file = open(self.path, 'a')
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def store_from_args(args):
+    if args.s3_bucket:
+        return S3Store(args.s3_bucket, prefix=args.s3_prefix, endpoint_url=args.s3_endpoint)
+    return LocalStore(args.target)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chat_data 的增量备份和快照恢复")
+    parser.add_argument('command', choices=('replicate', 'watch', 'list', 'restore'))
+    parser.add_argument('snapshot', nargs='?', help="restore 使用的快照ID，默认为最新的快照")
+    parser.add_argument('--data-dir', default="chat_data")
+    parser.add_argument('--target', default="chat_backup", help="本地副本目录")
+    parser.add_argument('--s3-bucket', default=None, help="使用 S3 兼容存储的桶而不是本地目录")
+    parser.add_argument('--s3-prefix', default="chat_data")
+    parser.add_argument('--s3-endpoint', default=os.getenv("S3_ENDPOINT_URL"), help="例如 MinIO 的 http://127.0.0.1:9000")
+    parser.add_argument('--full', action='store_true', help="忽略变更日志，比对全部聊天并写完整快照")
+    parser.add_argument('--interval', type=float, default=30, help="watch 的复制间隔（秒）")
+    parser.add_argument('--into', default=None, help="restore 的目标数据目录")
+    args = parser.parse_args()
+
+    replicator = Replicator(ChatManager(args.data_dir), store_from_args(args))
+    if args.command == 'list':
+        for snapshot_id in replicator.snapshots():
+            print(snapshot_id)
+    elif args.command == 'restore':
+        if not args.into:
+            parser.error("restore 需要 --into")
+        snapshots = replicator.snapshots()
+        snapshot_id = args.snapshot or (snapshots[-1] if snapshots else None)
+        if snapshot_id is None:
+            print("副本中没有快照")
+            return 1
+        count = replicator.restore(snapshot_id, args.into)
+        print(f"已把快照 {snapshot_id} 的 {count} 个聊天恢复到 {args.into}")
+    else:
+        while True:
+            started = time.perf_counter()
+            report = replicator.replicate(full=args.full)
+            if report is None:
+                print("另一个进程正在复制，跳过")
+            elif report['failed']:
+                print(f"{len(report['failed'])} 个聊天读取期间反复被改写，下次重试")
+            if report and report['snapshot']:
+                print(f"快照 {report['snapshot']}：{report['chats']} 个聊天更新，{report['deleted']} 个删除，"
+                      f"上传 {report['bytes_uploaded']} 字节，用时 {time.perf_counter() - started:.2f}s")
+            if args.command != 'watch':
+                break
+            args.full = False
+            time.sleep(args.interval)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
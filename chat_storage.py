@@ -0,0 +1,1048 @@
+import gzip
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# ================== 聊天管理实用工具 ==================
+# 多个进程共享 chat_data 时，写入方把变化的聊天ID追加到变更日志，
+# 其他进程每次读取列表前只需 stat 一次日志文件，有新内容时只刷新对应的聊天。
+JOURNAL_NAME = ".changes.log"
+JOURNAL_MAX_BYTES = 1 << 20
+
+# 最近保存的聊天ID，新会话启动时只读这个小文件就能打开最新的聊天
+LATEST_NAME = ".latest"
+
+# 同一聊天的写入（保存、压缩、格式升级写回）互斥：进程内用可重入锁，跨进程对聊天目录下的锁文件加 flock
+LOCK_FILE = ".lock"
+
+# 每个聊天存放在 chat_data/ab/cd/<id>/ 下，单个目录里的条目数不会随聊天数增长。
+# 旧版本的平铺文件 chat_data/<id>.json 仍可读取，写入或后台迁移时移到新位置。
+CHAT_FILE = "chat.json"
+
+# 聊天记录不放在 chat.json 里，而是写成逐行 JSON 的 history-<代号>.jsonl，
+# 并配一个 .idx 偏移索引（每条消息的结束偏移，小端 8 字节）。chat.json 只保存头部和消息数，
+# 打开聊天时内存映射记录文件，按索引只解码最后几条消息，更早的消息往前翻时再读。
+HISTORY_PREFIX = "history-"
+OFFSET_SIZE = 8
+# 保存时不写入头部的内存字段，branch_stats 是当前分支的统计，保存在分支表里
+HISTORY_FIELDS = ('chat_history', 'history_offset', 'history_saved', 'branch_stats')
+
+# 分支：头部的 branches 表记录每个分支的父分支和分叉位置，分叉点之前的消息沿父分支读取，
+# 每个分支只在自己的记录文件里保存分叉之后的消息。
+MAIN_BRANCH = "主线"
+
+# 回复的候选版本：分支表里按消息位置记录版本的内容哈希和选中的序号，
+# 文本按哈希去重后追加到聊天目录下的 versions.jsonl，切换版本只改头部，不重写聊天记录。
+VERSIONS_FILE = "versions.jsonl"
+
+# 超过 COLD_AFTER_DAYS 天没有写入的聊天由后台任务压缩成单个 chat.json.gz（头部和各分支的消息，紧凑 JSON），
+# 读取时透明解压，再次保存时重新写成热格式并删除压缩文件。
+COLD_FILE = "chat.json.gz"
+COLD_AFTER_DAYS = 14
+
+# 数据格式版本：头部的 schema 字段记录版本，读到旧版本时依次执行注册的升级步骤。
+# 热数据升级后立即写回，以后不再重复；冷存储和旧的平铺文件只在内存中升级，下次保存时一并写回。
+SCHEMA_VERSION = 4
+MIGRATIONS = {}
+
+# 消息固定为 [发言者, 头像, 内容, 时间]
+MESSAGE_FIELDS = 4
+
+
+def migration(version):
+    """注册把格式从 version 升到 version + 1 的步骤，步骤以 (manager, chat_id, header) 调用"""
+    def decorator(fn):
+        MIGRATIONS[version] = fn
+        return fn
+    return decorator
+
+
+class _ChatLock:
+    """单个聊天的写锁，同一线程可以重入；没有 fcntl 的平台只在进程内互斥"""
+
+    def __init__(self, path):
+        self.path = path
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(self.path, 'a')
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._rlock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._rlock.release()
+
+
+class ChatManager:
+    def __init__(self, data_dir="chat_data"):
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(exist_ok=True)
+        self._listing = None
+        self._lock = threading.RLock()
+        self._writer_id = uuid.uuid4().hex
+        self.journal_path = self.data_dir / JOURNAL_NAME
+        self._journal_state = self._journal_stat()
+        self.latest_path = self.data_dir / LATEST_NAME
+        self._chat_locks = {}
+    
+    # ---------- 路径解析 ----------
+    def _chat_dir(self, chat_id):
+        return self.data_dir / chat_id[:2] / chat_id[2:4] / chat_id
+    
+    def _chat_path(self, chat_id):
+        return self._chat_dir(chat_id) / CHAT_FILE
+    
+    def _chat_lock(self, chat_id):
+        """聊天的写锁，save_chat 和会删除文件的后台任务都在锁内进行"""
+        with self._lock:
+            lock = self._chat_locks.get(chat_id)
+            if lock is None:
+                lock = self._chat_locks[chat_id] = _ChatLock(self._chat_dir(chat_id) / LOCK_FILE)
+            return lock
+    
+    def _legacy_path(self, chat_id):
+        return self.data_dir / f"{chat_id}.json"
+    
+    def _find_chat_file(self, chat_id):
+        """返回聊天文件的实际位置，兼容冷存储的压缩文件和旧的平铺布局"""
+        path = self._chat_path(chat_id)
+        if path.exists():
+            return path
+        cold = self._chat_dir(chat_id) / COLD_FILE
+        if cold.exists():
+            return cold
+        legacy = self._legacy_path(chat_id)
+        if legacy.exists():
+            return legacy
+        # 后台迁移可能刚好把文件移走，再看一次新位置
+        return path if path.exists() else None
+    
+    def _iter_chat_files(self):
+        """逐个返回 (聊天ID, 文件路径, stat)，热数据优先于冷存储和旧的平铺文件"""
+        seen = set()
+        for chat_dir in _shard_dirs(self.data_dir, 3):
+            for name in (CHAT_FILE, COLD_FILE):
+                file = Path(chat_dir.path) / name
+                try:
+                    stat = file.stat()
+                except OSError:
+                    continue
+                seen.add(chat_dir.name)
+                yield chat_dir.name, file, stat
+                break
+        for file in self.data_dir.glob("*.json"):
+            if file.stem not in seen:
+                try:
+                    yield file.stem, file, file.stat()
+                except OSError:
+                    continue
+    
+    def chat_ids(self):
+        """所有聊天的ID，只列目录，不读取文件内容"""
+        return [chat_id for chat_id, _, _ in self._iter_chat_files()]
+    
+    def get_all_chats(self):
+        """返回所有保存的聊天"""
+        chats = []
+        for chat_id, file, stat in self._iter_chat_files():
+            try:
+                data = read_json(file)
+                data['id'] = chat_id
+                data['filename'] = str(file.relative_to(self.data_dir))
+                data['modified'] = datetime.fromtimestamp(stat.st_mtime)
+                chats.append(data)
+            except:
+                continue
+        
+        chats.sort(key=lambda x: x['modified'], reverse=True)
+        return chats
+    
+    def _scan_listing(self):
+        """只读文件的修改时间建立摘要列表，标题留到用到时再读"""
+        listing = [
+            {'id': chat_id, 'title': None, 'modified': datetime.fromtimestamp(stat.st_mtime)}
+            for chat_id, _, stat in self._iter_chat_files()
+        ]
+        listing.sort(key=lambda x: x['modified'], reverse=True)
+        return listing
+    
+    def _load_title(self, summary):
+        filepath = self._find_chat_file(summary['id'])
+        if filepath is None:
+            return False
+        try:
+            summary['title'] = read_json(filepath).get('title', '无标题')
+        except (OSError, ValueError):
+            return False
+        return True
+    
+    def list_chats(self, limit=None):
+        """返回聊天摘要（id、标题、修改时间），按修改时间倒序
+
+        摘要列表缓存在内存中，本实例的增删改就地更新，其他进程的改动通过变更日志同步；
+        首次建立列表只读文件的修改时间，标题只为返回的前 limit 条读取。
+        """
+        self.sync()
+        with self._lock:
+            if self._listing is None:
+                self._listing = self._scan_listing()
+            end = len(self._listing) if limit is None else limit
+            i = 0
+            while i < min(end, len(self._listing)):
+                # 读不出来的文件不出现在列表里
+                if self._listing[i]['title'] is None and not self._load_title(self._listing[i]):
+                    del self._listing[i]
+                    continue
+                i += 1
+            listing = self._listing[:end]
+        return [dict(summary) for summary in listing]
+    
+    def latest_chat_id(self):
+        """最近保存的聊天ID，没有聊天时返回 None
+
+        优先读取保存时记下的指针文件；指针缺失或指向已删除的聊天时，按文件修改时间找出最新的一个并重写指针。
+        """
+        try:
+            chat_id = self.latest_path.read_text(encoding='utf-8').strip()
+        except OSError:
+            chat_id = None
+        if chat_id and self._find_chat_file(chat_id) is not None:
+            return chat_id
+        
+        latest = max(
+            ((stat.st_mtime, chat_id) for chat_id, _, stat in self._iter_chat_files()),
+            default=None
+        )
+        if latest is None:
+            return None
+        self._write_latest(latest[1])
+        return latest[1]
+    
+    def _write_latest(self, chat_id):
+        tmp_path = self.latest_path.with_name(f"{LATEST_NAME}.{self._writer_id}.{threading.get_ident()}")
+        tmp_path.write_text(chat_id, encoding='utf-8')
+        os.replace(tmp_path, self.latest_path)
+    
+    def chat_count(self):
+        """已保存聊天的数量"""
+        self.sync()
+        with self._lock:
+            if self._listing is None:
+                self.list_chats(limit=0)
+            return len(self._listing)
+    
+    def invalidate_listing(self):
+        """丢弃缓存的摘要列表，下次读取时重新扫描"""
+        with self._lock:
+            self._listing = None
+    
+    def _update_listing(self, chat_id, summary=None):
+        with self._lock:
+            if self._listing is None:
+                return
+            self._listing = [s for s in self._listing if s['id'] != chat_id]
+            if summary is not None:
+                self._listing.insert(0, summary)
+    
+    # ---------- 跨进程变更日志 ----------
+    def _journal_stat(self):
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size
+    
+    def _journal_append(self, op, chat_id):
+        line = json.dumps({'op': op, 'id': chat_id, 'writer': self._writer_id}) + "\n"
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            size = f.tell()
+        if size > JOURNAL_MAX_BYTES:
+            # 换成新文件而不是截断，其他进程通过 inode 变化得知需要全量刷新
+            tmp_path = self.journal_path.with_name(f"{JOURNAL_NAME}.{self._writer_id}")
+            tmp_path.touch()
+            os.replace(tmp_path, self.journal_path)
+    
+    def sync(self):
+        """读取其他进程追加的变更，只刷新变化的聊天摘要"""
+        current = self._journal_stat()
+        with self._lock:
+            previous = self._journal_state
+            if current is None or current == previous:
+                return
+            if previous is None or current[0] != previous[0] or current[1] < previous[1]:
+                # 日志是新建的或被轮换过，中间的变更可能已丢失
+                self._journal_state = current
+                if previous is not None:
+                    self._listing = None
+                else:
+                    self._read_journal(0, current)
+                return
+            self._read_journal(previous[1], current)
+    
+    def _read_journal(self, offset, current):
+        with open(self.journal_path, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read(current[1] - offset)
+        # 只处理完整的行，写了一半的行留到下次
+        complete = chunk[:chunk.rfind(b"\n") + 1]
+        self._journal_state = (current[0], offset + len(complete))
+        for line in complete.decode('utf-8').splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('writer') != self._writer_id:
+                self._apply_change(entry.get('op'), entry.get('id'))
+    
+    def _apply_change(self, op, chat_id):
+        if self._listing is None or not chat_id:
+            return
+        filepath = self._find_chat_file(chat_id)
+        if op == 'delete' or filepath is None:
+            self._update_listing(chat_id)
+            return
+        try:
+            data = read_json(filepath)
+        except (OSError, ValueError):
+            return
+        self._update_listing(chat_id, {
+            'id': chat_id,
+            'title': data.get('title', '无标题'),
+            'modified': datetime.fromtimestamp(filepath.stat().st_mtime),
+        })
+    
+    # ---------- 聊天记录文件 ----------
+    def _history_paths(self, chat_id, name):
+        chat_dir = self._chat_dir(chat_id)
+        return chat_dir / f"{name}.jsonl", chat_dir / f"{name}.idx"
+    
+    def _read_header(self, chat_id):
+        for _ in range(2):
+            filepath = self._find_chat_file(chat_id)
+            if filepath is None:
+                return None
+            try:
+                header = read_json(filepath)
+                if header.get('schema', 0) < SCHEMA_VERSION:
+                    header = self._migrate(chat_id, filepath, header)
+                return header
+            except FileNotFoundError:
+                # 文件刚被迁移或压缩，重新定位一次
+                continue
+        return None
+    
+    def _migrate(self, chat_id, filepath, header):
+        """把头部升级到当前版本并返回；热文件在聊天的写锁内升级、写回并清理旧的记录文件"""
+        if filepath.name != CHAT_FILE:
+            self._upgrade(chat_id, header)
+            return header
+        with self._chat_lock(chat_id):
+            # 等锁期间可能已有进程保存或升级过，拿到锁后重新读一次
+            header = read_json(filepath)
+            if header.get('schema', 0) >= SCHEMA_VERSION:
+                return header
+            stat = filepath.stat()
+            self._upgrade(chat_id, header)
+            tmp_path = filepath.with_name(f".{CHAT_FILE}.{self._writer_id}.{threading.get_ident()}")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(header, f, ensure_ascii=False, indent=2)
+            # 保留原来的修改时间，升级不算一次写入
+            os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+            os.replace(tmp_path, filepath)
+            self._remove_stale_history(chat_id, {info.get('history_file') for info in header['branches'].values()})
+        return header
+    
+    def _upgrade(self, chat_id, header):
+        """依次执行注册的升级步骤"""
+        for version in range(header.get('schema', 0), SCHEMA_VERSION):
+            MIGRATIONS[version](self, chat_id, header)
+        header['schema'] = SCHEMA_VERSION
+    
+    def _read_offsets(self, idx_path, start, stop):
+        """返回第 start 条消息的起始偏移和第 start..stop-1 条的结束偏移"""
+        first = max(start - 1, 0)
+        with open(idx_path, 'rb') as f:
+            f.seek(first * OFFSET_SIZE)
+            data = f.read((stop - first) * OFFSET_SIZE)
+        offsets = list(struct.unpack(f"<{len(data) // OFFSET_SIZE}q", data))
+        return [0] + offsets if start == 0 else offsets
+    
+    def _read_messages(self, chat_id, name, start, stop):
+        if stop <= start:
+            return []
+        jsonl_path, idx_path = self._history_paths(chat_id, name)
+        offsets = self._read_offsets(idx_path, start, stop)
+        with open(jsonl_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[offsets[0]:offsets[-1]]
+        return [json.loads(line) for line in data.splitlines()]
+    
+    def _read_own(self, chat_id, branch, info, start, stop):
+        """解码分支自有部分（分叉点之后）的第 start..stop-1 条消息"""
+        if 'messages' in info:
+            # 冷存储和旧格式的消息内嵌在头部里
+            return info['messages'][start:stop]
+        if stop <= start or not info.get('history_file'):
+            return []
+        try:
+            return self._read_messages(chat_id, info['history_file'], start, stop)
+        except FileNotFoundError:
+            # 记录文件已被其他进程重写或压缩，改读磁盘上的当前版本
+            header = self._read_header(chat_id)
+            current = branch_table(header).get(branch) if header else None
+            if current is None or current.get('history_file') == info['history_file']:
+                raise
+            return self._read_own(chat_id, branch, current, start, stop)
+    
+    def _read_branch(self, chat_id, branches, branch, start, stop):
+        """解码分支上第 start..stop-1 条消息，分叉点之前的部分沿父分支读取"""
+        info = branches[branch]
+        fork_at = info.get('fork_at', 0)
+        messages = []
+        if start < fork_at and info.get('parent') in branches:
+            messages = self._read_branch(chat_id, branches, info['parent'], start, min(stop, fork_at))
+        if stop > fork_at:
+            first = max(start, fork_at)
+            own = self._read_own(chat_id, branch, info, first - fork_at, stop - fork_at)
+            texts = None
+            for key, entry in info.get('alternates', {}).items():
+                index = int(key) - first
+                if 0 <= index < len(own):
+                    # 显示选中的版本，记录文件里的原文不动
+                    texts = self._read_versions(chat_id) if texts is None else texts
+                    text = texts.get(entry['versions'][entry['selected']])
+                    if text is not None:
+                        own[index] = own[index][:2] + [text] + own[index][3:]
+            messages += own
+        return messages
+    
+    def _encode_messages(self, messages, start):
+        lines = [json.dumps(msg, ensure_ascii=False).encode('utf-8') + b"\n" for msg in messages]
+        ends = list(itertools.accumulate(map(len, lines), initial=start))[1:]
+        return b"".join(lines), struct.pack(f"<{len(ends)}q", *ends)
+    
+    def _write_history(self, chat_id, messages):
+        """把完整记录写成新版本的记录文件，返回版本名"""
+        name = HISTORY_PREFIX + uuid.uuid4().hex[:12]
+        jsonl_path, idx_path = self._history_paths(chat_id, name)
+        data, offsets = self._encode_messages(messages, 0)
+        with open(jsonl_path, 'wb') as f:
+            f.write(data)
+        with open(idx_path, 'wb') as f:
+            f.write(offsets)
+        return name
+    
+    def _append_history(self, chat_id, name, count, messages):
+        """在已有的 count 条消息后追加新消息"""
+        if not messages:
+            return
+        jsonl_path, idx_path = self._history_paths(chat_id, name)
+        end = self._read_offsets(idx_path, count, count)[0]
+        data, offsets = self._encode_messages(messages, end)
+        # 先截掉上次中断写入留下的残余，头部的消息数之外的内容都视为无效
+        with open(jsonl_path, 'r+b') as f:
+            f.truncate(end)
+            f.seek(end)
+            f.write(data)
+        with open(idx_path, 'r+b') as f:
+            f.truncate(count * OFFSET_SIZE)
+            f.seek(count * OFFSET_SIZE)
+            f.write(offsets)
+    
+    def _remove_stale_history(self, chat_id, keep):
+        for path in self._chat_dir(chat_id).glob(f"{HISTORY_PREFIX}*"):
+            if path.stem not in keep:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+    
+    def save_chat(self, chat_data, chat_id=None):
+        """保存聊天
+
+        当前分支只追加 history_saved 之后的新消息；修改了已保存的消息时，先删掉 history_saved
+        再保存，当前分支自有的部分会整体重写。保存到另一个ID时把当前分支展平成一个新聊天。
+        """
+        source_id = chat_data.get('id')
+        if chat_id is None:
+            chat_id = str(uuid.uuid4())
+        
+        filepath = self._chat_path(chat_id)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        
+        history = chat_data.get('chat_history', [])
+        offset = chat_data.get('history_offset', 0)
+        saved = chat_data.get('history_saved')
+        branches = chat_data.get('branches') or {MAIN_BRANCH: new_branch()}
+        branch = chat_data.get('branch') if chat_data.get('branch') in branches else next(iter(branches))
+        
+        # 写入、替换头部和清理旧文件都在聊天的写锁内，后台压缩和格式升级不会和保存交错
+        with self._chat_lock(chat_id):
+            if chat_id != source_id:
+                # 新聊天或另存为：补齐没有加载的早期消息，写成只有主线的新聊天
+                older = self._read_branch(source_id, branches, branch, 0, offset) if offset else []
+                branches = {MAIN_BRANCH: new_branch(history_file=self._write_history(chat_id, older + history))}
+                branches[MAIN_BRANCH]['history_count'] = offset + len(history)
+                branch = MAIN_BRANCH
+            else:
+                on_disk = self._read_header(chat_id)
+                disk_branches = branch_table(on_disk) if on_disk else {}
+                # 其他进程新建的分支一并保留
+                branches = {**disk_branches, **branches}
+                info = branches[branch]
+                disk_info = disk_branches.get(branch, {})
+                fork_at = info.get('fork_at', 0)
+                if (saved is not None and info.get('history_file')
+                        and disk_info.get('history_file') == info['history_file']
+                        and disk_info.get('history_count') == saved
+                        and max(offset, fork_at) <= saved <= offset + len(history)):
+                    self._append_history(chat_id, info['history_file'], saved - fork_at, history[saved - offset:])
+                else:
+                    # 磁盘上的版本已变化或有消息被修改：整体重写当前分支自有的部分
+                    if offset > fork_at:
+                        own = self._read_own(chat_id, branch, info, 0, offset - fork_at) + history
+                    else:
+                        own = history[fork_at - offset:]
+                    info = {k: v for k, v in info.items() if k != 'messages'}
+                    info['history_file'] = self._write_history(chat_id, own)
+                info['history_count'] = offset + len(history)
+                branches[branch] = info
+                # 从冷存储或旧格式读进来的其他分支顺便写回记录文件
+                for name, other in list(branches.items()):
+                    if 'messages' in other:
+                        other = {k: v for k, v in other.items() if k != 'messages'}
+                        other['history_file'] = self._write_history(chat_id, branches[name]['messages'])
+                        branches[name] = other
+            if 'branch_stats' in chat_data:
+                branches[branch]['stats'] = chat_data['branch_stats']
+            
+            chat_data['id'] = chat_id
+            chat_data['schema'] = SCHEMA_VERSION
+            chat_data['modified'] = datetime.now().isoformat()
+            chat_data['branches'] = branches
+            chat_data['branch'] = branch
+            header = {k: v for k, v in chat_data.items() if k not in HISTORY_FIELDS}
+            # 先写临时文件再替换，其他进程不会读到写了一半的文件
+            tmp_path = filepath.with_name(f".{CHAT_FILE}.{self._writer_id}.{threading.get_ident()}")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(header, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, filepath)
+            # 热文件完整写好之后才删除旧布局和冷存储的副本
+            self._legacy_path(chat_id).unlink(missing_ok=True)
+            (filepath.parent / COLD_FILE).unlink(missing_ok=True)
+            self._remove_stale_history(chat_id, {info.get('history_file') for info in branches.values()})
+            modified = filepath.stat().st_mtime
+        chat_data['history_saved'] = offset + len(history)
+        
+        self._update_listing(chat_id, {
+            'id': chat_id,
+            'title': chat_data.get('title', '无标题'),
+            'modified': datetime.fromtimestamp(modified),
+        })
+        self._write_latest(chat_id)
+        self._journal_append('save', chat_id)
+        return chat_id
+    
+    def load_chat(self, chat_id, tail=None, branch=None):
+        """根据ID加载聊天，指定 tail 时只解码最后 tail 条公共消息
+
+        默认打开上次所在的分支。history_offset 记录内存中第一条消息在分支完整记录里的位置，
+        更早的消息用 load_earlier 补上。
+        """
+        chat = self._read_header(chat_id)
+        if chat is None:
+            return None
+        branches = branch_table(chat)
+        if branch not in branches:
+            branch = chat['branch'] if chat.get('branch') in branches else next(iter(branches))
+        count = branches[branch]['history_count']
+        start = 0 if tail is None else max(0, count - tail)
+        chat['chat_history'] = self._read_branch(chat_id, branches, branch, start, count)
+        chat['branch_stats'] = branches[branch].get('stats') or self._branch_stats(chat_id, branches, branch, count,
+                                                                                  chat.get('modified'))
+        chat['branch'] = branch
+        chat['history_offset'] = start
+        chat['history_saved'] = count
+        return chat
+    
+    def _branch_stats(self, chat_id, branches, branch, count, last_activity=None):
+        """从分支的前 count 条消息重建公共消息统计"""
+        return build_stats(self._read_branch(chat_id, branches, branch, 0, count), last_activity)
+    
+    def load_messages(self, chat, start, stop):
+        """解码聊天当前分支第 start..stop-1 条公共消息，不改动内存中的聊天"""
+        if chat.get('branch') not in chat.get('branches', {}):
+            return []
+        return self._read_branch(chat['id'], chat['branches'], chat['branch'], start, stop)
+    
+    def load_earlier(self, chat, count):
+        """把更早的 count 条消息解码后插到内存记录前面，返回实际载入的条数"""
+        offset = chat.get('history_offset', 0)
+        if offset <= 0 or not chat.get('branches'):
+            return 0
+        start = max(0, offset - count)
+        older = self._read_branch(chat['id'], chat['branches'], chat['branch'], start, offset)
+        chat['chat_history'][:0] = older
+        chat['history_offset'] = start
+        return len(older)
+    
+    # ---------- 回复版本 ----------
+    def _read_versions(self, chat_id):
+        """读取聊天的版本内容库 {哈希: 文本}"""
+        texts = {}
+        try:
+            with open(self._chat_dir(chat_id) / VERSIONS_FILE, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    texts[entry['hash']] = entry['text']
+        except FileNotFoundError:
+            pass
+        return texts
+    
+    def _store_version(self, chat_id, text, texts):
+        """把文本存进版本内容库，已有相同内容时不重复写入，返回内容哈希"""
+        digest = content_hash(text)
+        if digest not in texts:
+            chat_dir = self._chat_dir(chat_id)
+            chat_dir.mkdir(parents=True, exist_ok=True)
+            with open(chat_dir / VERSIONS_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'hash': digest, 'text': text}, ensure_ascii=False) + "\n")
+            texts[digest] = text
+        return digest
+    
+    def add_version(self, chat, index, text):
+        """给当前分支第 index 条消息添加一个候选版本并选中，返回版本序号"""
+        branches = chat['branches']
+        owner = owner_branch(branches, chat['branch'], index)
+        alternates = branches[owner].setdefault('alternates', {})
+        if index < chat.get('history_offset', 0):
+            self.load_earlier(chat, chat['history_offset'] - index)
+        texts = self._read_versions(chat['id'])
+        entry = alternates.get(str(index))
+        if entry is None:
+            # 第一次重新生成时把原文记为版本 0
+            original = chat['chat_history'][index - chat.get('history_offset', 0)][2]
+            entry = {'versions': [self._store_version(chat['id'], original, texts)], 'selected': 0}
+            alternates[str(index)] = entry
+        digest = self._store_version(chat['id'], text, texts)
+        if digest not in entry['versions']:
+            entry['versions'].append(digest)
+        version = entry['versions'].index(digest)
+        self.select_version(chat, index, version, texts)
+        return version
+    
+    def select_version(self, chat, index, version, texts=None):
+        """切换第 index 条消息显示的版本，只重写头部"""
+        entry = message_versions(chat, index)
+        if entry is None or not 0 <= version < len(entry['versions']):
+            return False
+        if index < chat.get('history_offset', 0):
+            self.load_earlier(chat, chat['history_offset'] - index)
+        position = index - chat.get('history_offset', 0)
+        if not 0 <= position < len(chat['chat_history']):
+            return False
+        texts = self._read_versions(chat['id']) if texts is None else texts
+        entry['selected'] = version
+        msg = chat['chat_history'][position]
+        chat['chat_history'][position] = msg[:2] + [texts[entry['versions'][version]]] + msg[3:]
+        self.save_chat(chat, chat['id'])
+        return True
+    
+    # ---------- 分支 ----------
+    def create_branch(self, chat, fork_at, name=None):
+        """从当前分支的前 fork_at 条消息处分叉并切换到新分支，返回分支名，重名时返回 None
+
+        新分支通过父分支引用共同的前缀，自己只保存分叉之后的消息。
+        """
+        self.save_chat(chat, chat.get('id'))
+        branches = chat['branches']
+        if name is None:
+            number = len(branches)
+            while f"分支 {number}" in branches:
+                number += 1
+            name = f"分支 {number}"
+        elif name in branches:
+            return None
+        
+        offset = chat.get('history_offset', 0)
+        total = offset + len(chat['chat_history'])
+        fork_at = max(0, min(fork_at, total))
+        # 新分支的统计只算共享的前 fork_at 条消息
+        if fork_at == total and 'branch_stats' in chat:
+            chat['branch_stats'] = merge_stats(chat['branch_stats'])
+        else:
+            chat['branch_stats'] = self._branch_stats(chat['id'], branches, chat['branch'], fork_at, chat.get('modified'))
+        branches[name] = new_branch(parent=chat['branch'], fork_at=fork_at)
+        chat['chat_history'] = chat['chat_history'][:max(0, fork_at - offset)]
+        chat['history_offset'] = min(offset, fork_at)
+        chat['history_saved'] = fork_at
+        chat['branch'] = name
+        self.save_chat(chat, chat['id'])
+        return name
+    
+    def delete_chat(self, chat_id):
+        """删除聊天"""
+        legacy = self._legacy_path(chat_id)
+        chat_dir = self._chat_dir(chat_id)
+        if legacy.exists() or chat_dir.exists():
+            legacy.unlink(missing_ok=True)
+            shutil.rmtree(chat_dir, ignore_errors=True)
+            self._update_listing(chat_id)
+            self._journal_append('delete', chat_id)
+            return True
+        return False
+    
+    def rename_chat(self, chat_id, new_title):
+        """重命名聊天"""
+        data = self.load_chat(chat_id, tail=0)
+        if data:
+            data['title'] = new_title
+            self.save_chat(data, chat_id)
+            return True
+        return False
+    
+    # ---------- 在线迁移 ----------
+    def migrate_legacy(self, pause=0.0):
+        """把旧的平铺文件移到分片目录，服务运行期间也可以执行，返回迁移的数量"""
+        moved = 0
+        for legacy in self.data_dir.glob("*.json"):
+            target = self._chat_path(legacy.stem)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                # 硬链接只在目标不存在时成功，不会覆盖其他进程刚写入的新版本
+                os.link(legacy, target)
+            except FileExistsError:
+                pass
+            except FileNotFoundError:
+                continue
+            except OSError:
+                # 不支持硬链接的文件系统
+                if not target.exists():
+                    os.replace(legacy, target)
+                    moved += 1
+                    continue
+            else:
+                moved += 1
+            legacy.unlink(missing_ok=True)
+            if pause:
+                time.sleep(pause)
+        return moved
+    
+    def start_migration(self):
+        """存在旧布局的文件时，在后台线程中迁移"""
+        if next(self.data_dir.glob("*.json"), None) is not None:
+            threading.Thread(target=self.migrate_legacy, kwargs={'pause': 0.001}, daemon=True).start()
+    
+    # ---------- 冷热分层 ----------
+    def compress_inactive(self, days=COLD_AFTER_DAYS, pause=0.0):
+        """把超过 days 天没有写入的聊天压缩成冷存储，返回压缩的数量和前后的磁盘占用"""
+        cutoff = time.time() - days * 86400
+        report = {'chats': 0, 'bytes_before': 0, 'bytes_after': 0}
+        for filepath in list(self.data_dir.glob(f"*/*/*/{CHAT_FILE}")):
+            try:
+                if filepath.stat().st_mtime > cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            chat_dir = filepath.parent
+            # 在写锁内完成读取、压缩和删除，期间的保存会等压缩结束后把聊天重新写成热格式
+            with self._chat_lock(chat_dir.name):
+                # 先读头部（旧格式在这里升级并写回），再取写回之后的文件状态
+                chat = self._read_header(chat_dir.name)
+                try:
+                    stat = filepath.stat()
+                except FileNotFoundError:
+                    continue
+                if chat is None or stat.st_mtime > cutoff:
+                    continue
+                # 每个分支自有的消息内嵌进头部
+                for name, info in branch_table(chat).items():
+                    if 'messages' not in info:
+                        fork_at = info.get('fork_at', 0)
+                        info['messages'] = self._read_own(chat_dir.name, name, info, 0, info['history_count'] - fork_at)
+                        info.pop('history_file', None)
+                before = sum(f.stat().st_size for f in chat_dir.iterdir() if f.is_file())
+                
+                cold_path = chat_dir / COLD_FILE
+                tmp_path = chat_dir / f".{COLD_FILE}.{self._writer_id}"
+                with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+                    json.dump(chat, f, ensure_ascii=False, separators=(',', ':'))
+                # 保留原来的修改时间，聊天列表的排序不变
+                os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+                os.replace(tmp_path, cold_path)
+                filepath.unlink(missing_ok=True)
+                for path in chat_dir.glob(f"{HISTORY_PREFIX}*"):
+                    path.unlink(missing_ok=True)
+                
+                report['chats'] += 1
+                report['bytes_before'] += before
+                report['bytes_after'] += cold_path.stat().st_size
+            if pause:
+                time.sleep(pause)
+        return report
+    
+    def start_tiering(self, days=COLD_AFTER_DAYS):
+        """在后台线程中压缩不活跃的聊天"""
+        threading.Thread(target=self.compress_inactive, kwargs={'days': days, 'pause': 0.001}, daemon=True).start()
+
+
+# ================== 格式升级步骤 ==================
+def normalize_message(msg):
+    """把旧消息补齐成 [发言者, 头像, 内容, 时间]，返回 None 表示已经是标准格式"""
+    if isinstance(msg, list) and len(msg) == MESSAGE_FIELDS:
+        return None
+    if isinstance(msg, dict):
+        return [msg.get('speaker', ''), msg.get('avatar', '👤'), msg.get('text', ''), msg.get('time', '')]
+    msg = list(msg)[:MESSAGE_FIELDS]
+    return msg + ["", "👤", "", ""][len(msg):]
+
+
+def _normalize_list(messages):
+    """原地补齐一组消息，返回是否有改动"""
+    changed = False
+    for i, msg in enumerate(messages):
+        fixed = normalize_message(msg)
+        if fixed is not None:
+            messages[i] = fixed
+            changed = True
+    return changed
+
+
+@migration(0)
+def _migrate_branches(manager, chat_id, header):
+    """没有分支表的旧格式转成只有主线的一项"""
+    branch_table(header)
+
+
+@migration(1)
+def _migrate_defaults(manager, chat_id, header):
+    """补上早期聊天缺少的字段"""
+    header.setdefault('title', '无标题')
+    header.setdefault('scenario', '')
+    header.setdefault('user_role', '您')
+    header.setdefault('agents', {})
+    header.setdefault('private_history', {})
+
+
+@migration(2)
+def _migrate_messages(manager, chat_id, header):
+    """消息统一成四个字段，记录文件里有旧消息时整体重写"""
+    for messages in header['private_history'].values():
+        _normalize_list(messages)
+    for name, info in header['branches'].items():
+        if 'messages' in info:
+            _normalize_list(info['messages'])
+        elif info.get('history_file'):
+            count = info['history_count'] - info.get('fork_at', 0)
+            messages = manager._read_messages(chat_id, info['history_file'], 0, count)
+            if _normalize_list(messages):
+                info['history_file'] = manager._write_history(chat_id, messages)
+
+
+@migration(3)
+def _migrate_stats(manager, chat_id, header):
+    """整个聊天共用的统计拆成各分支的公共消息统计和私聊统计"""
+    header.pop('stats', None)
+    modified = header.get('modified')
+    private = [msg for messages in header['private_history'].values() for msg in messages]
+    header['private_stats'] = build_stats(private, modified, private=True)
+    branches = header['branches']
+    for name, info in branches.items():
+        info['stats'] = manager._branch_stats(chat_id, branches, name, info['history_count'], modified)
+
+
+def _shard_dirs(root, depth):
+    """逐层列出分片目录，返回第 depth 层的目录项，跳过以点开头的文件和目录"""
+    if depth == 0:
+        yield root
+        return
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return
+    for entry in entries:
+        if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False):
+            yield from _shard_dirs(entry, depth - 1)
+
+
+def new_branch(parent=None, fork_at=0, history_file=None):
+    """分支表中的一项：父分支、分叉位置（共享的前缀条数）和自有记录文件"""
+    info = {'parent': parent, 'fork_at': fork_at, 'history_count': fork_at}
+    if history_file is not None:
+        info['history_file'] = history_file
+    return info
+
+
+def branch_table(header):
+    """返回磁盘头部的分支表，没有分支的旧格式就地转换成只有主线的一项"""
+    if 'branches' not in header:
+        if 'history_file' in header:
+            info = new_branch(history_file=header.pop('history_file'))
+            info['history_count'] = header.pop('history_count', 0)
+        else:
+            info = new_branch()
+            info['messages'] = header.pop('chat_history', [])
+            info['history_count'] = len(info['messages'])
+        header['branches'] = {MAIN_BRANCH: info}
+        header['branch'] = MAIN_BRANCH
+    return header['branches']
+
+
+def owner_branch(branches, branch, index):
+    """第 index 条消息实际保存在哪个分支，分叉点之前的消息属于父分支"""
+    while index < branches[branch].get('fork_at', 0) and branches[branch].get('parent') in branches:
+        branch = branches[branch]['parent']
+    return branch
+
+
+def message_versions(chat, index):
+    """第 index 条消息的候选版本 {'versions': [哈希], 'selected': 序号}，没有时返回 None"""
+    branches = chat.get('branches')
+    if not branches or chat.get('branch') not in branches:
+        return None
+    owner = owner_branch(branches, chat['branch'], index)
+    return branches[owner].get('alternates', {}).get(str(index))
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def read_json(path):
+    """读取 JSON 文件，.gz 结尾的按 gzip 解压"""
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# ================== 聊天统计 ==================
+def estimate_tokens(text):
+    """粗略估算 token 数：中日韩等宽字符（U+2E80 以上）按一个计，其余约四个字符一个"""
+    cjk = sum(1 for ch in text if ch >= '⺀')
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def new_stats():
+    """空的统计块"""
+    return {
+        'public': 0,
+        'private': 0,
+        'tokens': 0,
+        'speakers': {},
+        'last_activity': None,
+    }
+
+
+def record_message(stats, speaker, text, private=False):
+    """把一条新消息计入统计块"""
+    now = datetime.now().isoformat()
+    tokens = estimate_tokens(text)
+
+    stats['private' if private else 'public'] += 1
+    stats['tokens'] += tokens
+    stats['last_activity'] = now
+
+    speaker_stats = stats['speakers'].setdefault(speaker, {'messages': 0, 'tokens': 0, 'last_activity': None})
+    speaker_stats['messages'] += 1
+    speaker_stats['tokens'] += tokens
+    speaker_stats['last_activity'] = now
+
+
+def build_stats(messages, last_activity=None, private=False):
+    """从一组消息重建统计块，消息的时间只有时分，最近活跃时间取 last_activity"""
+    stats = new_stats()
+    for msg in messages:
+        record_message(stats, msg[0], msg[2], private=private)
+    stats['last_activity'] = last_activity
+    for speaker_stats in stats['speakers'].values():
+        speaker_stats['last_activity'] = last_activity
+    return stats
+
+
+def _latest(*times):
+    return max((t for t in times if t), default=None)
+
+
+def merge_stats(*blocks):
+    """把几个统计块相加成一个新的统计块"""
+    merged = new_stats()
+    for stats in blocks:
+        for key in ('public', 'private', 'tokens'):
+            merged[key] += stats[key]
+        merged['last_activity'] = _latest(merged['last_activity'], stats['last_activity'])
+        for speaker, speaker_stats in stats['speakers'].items():
+            target = merged['speakers'].setdefault(speaker, {'messages': 0, 'tokens': 0, 'last_activity': None})
+            target['messages'] += speaker_stats['messages']
+            target['tokens'] += speaker_stats['tokens']
+            target['last_activity'] = _latest(target['last_activity'], speaker_stats['last_activity'])
+    return merged
+
+
+def _stats_parts(chat):
+    """当前分支的公共消息统计和全聊天共用的私聊统计，新聊天缺少时从内存中的记录重建"""
+    if 'branch_stats' not in chat:
+        chat['branch_stats'] = build_stats(chat.get('chat_history', []), chat.get('modified'))
+    if 'private_stats' not in chat:
+        private = [msg for messages in chat.get('private_history', {}).values() for msg in messages]
+        chat['private_stats'] = build_stats(private, chat.get('modified'), private=True)
+    return chat['branch_stats'], chat['private_stats']
+
+
+def ensure_stats(chat):
+    """返回聊天当前分支的统计（公共消息按分支统计，私聊不分分支）
+
+    从磁盘加载的聊天由 load_chat 提供整个分支的统计，只加载了尾部消息也不会少算。
+    """
+    return merge_stats(*_stats_parts(chat))
+
+
+def append_public_message(chat, speaker, avatar, text, timestamp=None):
+    """追加一条公共消息并更新统计"""
+    timestamp = timestamp or datetime.now().strftime("%H:%M")
+    stats = _stats_parts(chat)[0]
+    chat.setdefault('chat_history', []).append([speaker, avatar, text, timestamp])
+    record_message(stats, speaker, text)
+
+
+def append_private_message(chat, agent_name, speaker, avatar, text, timestamp=None):
+    """追加一条与某个角色的私聊消息并更新统计"""
+    timestamp = timestamp or datetime.now().strftime("%H:%M")
+    stats = _stats_parts(chat)[1]
+    chat.setdefault('private_history', {}).setdefault(agent_name, []).append([speaker, avatar, text, timestamp])
+    record_message(stats, speaker, text, private=True)
@@ -0,0 +1,140 @@
+import os
+import threading
+from collections import deque
+
+
+# ================== 生成策略 ==================
+# 按角色记录实际的响应延迟和输出速度，据此为每次请求选择 max_tokens，让一次发言在目标时间内完成。
+# 角色的目标时长保存在角色数据的 target_latency 里（秒，0 表示不限），手动上限保存在 max_tokens 里（0 表示自动）。
+# 默认不限制，设置了目标时长或回合总时长之后才会发送 max_tokens，超出上限的回复截到最后一个完整的句子。
+def _env_seconds(name, default):
+    try:
+        return float(os.getenv(name, str(default)) or default)
+    except ValueError:
+        return default
+
+
+DEFAULT_TARGET_LATENCY = _env_seconds("AGENT_TARGET_LATENCY", 0.0)
+
+# 多个角色依次回应一条消息时的总时长，剩余时间平均分给还没发言的角色；用完之后的角色按最短长度生成
+DEFAULT_TURN_BUDGET = _env_seconds("TURN_LATENCY_BUDGET", 0.0)
+
+# max_tokens 的取值范围，再短的预算也要留出说完一两句话的长度
+MIN_MAX_TOKENS = 64
+MAX_MAX_TOKENS = 1024
+
+# 还没有实测数据时假设的固定开销（排队、处理提示）和输出速度
+DEFAULT_OVERHEAD = 1.5
+DEFAULT_TOKENS_PER_SECOND = 25.0
+
+# 按目标时长的这个比例计算，给速度波动留出余量
+SAFETY_RATIO = 0.85
+
+# 每个角色保留最近的观测条数
+SAMPLES = 20
+
+# 接口最多接受的停止序列数
+MAX_STOP_SEQUENCES = 16
+
+# 中文大约每个 token 对应 0.8 个字，用于在指令里提示篇幅
+CHARS_PER_TOKEN = 0.8
+
+LENGTH_HINT = "（请在{chars}字以内说完）"
+
+SENTENCE_ENDS = "。！？…!?.~～」』”）)"
+
+
+def trim_to_sentence(text):
+    """输出因长度上限被截断时，去掉最后半句话；找不到句子结尾时原样返回"""
+    cut = max(text.rfind(ch) for ch in SENTENCE_ENDS)
+    if cut <= 0:
+        return text
+    return text[:cut + 1]
+
+
+def stop_sequences(chat, agent_name):
+    """其他角色和用户另起一行开口时停止，避免替别人说话"""
+    names = [name for name in chat.get('agents', {}) if name != agent_name]
+    names.append(chat.get('user_role', '用户'))
+    return [f"\n{name}：" for name in names][:MAX_STOP_SEQUENCES]
+
+
+class GenerationPolicy:
+    """按角色估计响应延迟，为每次请求选择输出长度上限
+
+    把每次调用的耗时看成「固定开销 + 输出 token 数 / 输出速度」，
+    用最近几次观测做线性拟合，数据不够时退回默认值。
+    """
+
+    def __init__(self, samples=SAMPLES):
+        self._samples = {}
+        self._maxlen = samples
+        self._lock = threading.Lock()
+
+    def observe(self, chat_id, agent, latency, completion_tokens):
+        """记录一次调用的耗时（秒）和输出 token 数"""
+        if latency <= 0 or completion_tokens <= 0:
+            return
+        with self._lock:
+            samples = self._samples.setdefault((chat_id, agent), deque(maxlen=self._maxlen))
+            samples.append((completion_tokens, latency))
+
+    def estimate(self, chat_id, agent):
+        """返回 {'overhead', 'tokens_per_second', 'latency', 'samples'}，latency 是最近调用的平均耗时"""
+        with self._lock:
+            samples = list(self._samples.get((chat_id, agent), ()))
+        estimate = {
+            'overhead': DEFAULT_OVERHEAD,
+            'tokens_per_second': DEFAULT_TOKENS_PER_SECOND,
+            'latency': None,
+            'samples': len(samples),
+        }
+        if not samples:
+            return estimate
+        n = len(samples)
+        mean_tokens = sum(t for t, _ in samples) / n
+        mean_latency = sum(l for _, l in samples) / n
+        estimate['latency'] = mean_latency
+        variance = sum((t - mean_tokens) ** 2 for t, _ in samples)
+        if n >= 3 and variance > 0:
+            slope = sum((t - mean_tokens) * (l - mean_latency) for t, l in samples) / variance
+            overhead = mean_latency - slope * mean_tokens
+            if slope > 0 and overhead >= 0:
+                estimate['overhead'] = overhead
+                estimate['tokens_per_second'] = 1 / slope
+                return estimate
+        # 观测太少或输出长度都差不多时无法拟合，固定开销取默认值和最快一次调用中较小的那个
+        overhead = min(DEFAULT_OVERHEAD, min(l for _, l in samples) / 2)
+        generating = sum(max(l - overhead, 1e-3) for _, l in samples)
+        estimate['overhead'] = overhead
+        estimate['tokens_per_second'] = sum(t for t, _ in samples) / generating
+        return estimate
+
+    def max_tokens(self, chat_id, agent, target):
+        """在 target 秒内能输出的 token 数，限制在 MIN_MAX_TOKENS 到 MAX_MAX_TOKENS 之间"""
+        estimate = self.estimate(chat_id, agent)
+        budget = target * SAFETY_RATIO - estimate['overhead']
+        tokens = int(budget * estimate['tokens_per_second'])
+        return max(MIN_MAX_TOKENS, min(MAX_MAX_TOKENS, tokens))
+
+    def limits(self, chat, agent_name, deadline=None):
+        """角色这次请求的采样参数，deadline 是本轮分给这个角色的秒数
+
+        deadline 不为 None 时总是限制长度，回合时间已经用完（deadline 为 0）时取 MIN_MAX_TOKENS。
+        """
+        data = chat.get('agents', {}).get(agent_name, {})
+        target = data.get('target_latency', DEFAULT_TARGET_LATENCY) or 0
+        caps = []
+        if deadline is not None:
+            caps.append(self.max_tokens(chat.get('id'), agent_name, min(target, deadline) if target else deadline))
+        elif target:
+            caps.append(self.max_tokens(chat.get('id'), agent_name, target))
+        if data.get('max_tokens'):
+            caps.append(data['max_tokens'])
+        limits = {'stop': stop_sequences(chat, agent_name)}
+        if caps:
+            limits['max_tokens'] = min(caps)
+        return limits
+
+
+generation_policy = GenerationPolicy()
@@ -0,0 +1,179 @@
+import re
+import threading
+from array import array
+from collections import Counter
+
+import numpy as np
+
+
+# ================== 检索记忆 ==================
+# 历史超出请求窗口后，用本地的 BM25 稀疏索引找回与当前对话相关的早期消息，不依赖网络。
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 查询只取区分度最高的若干个词，常见词对排序几乎没有贡献
+MAX_QUERY_TERMS = 32
+
+# 中日韩字符（U+2E80 以上，与 estimate_tokens 一致）按相邻两字切分，其余按字母数字单词切分
+_TOKEN_RE = re.compile(r"[⺀-鿿가-힯豈-﫿]+|[a-z0-9]+")
+
+
+def tokenize(text):
+    """把文本切成检索用的词：中日韩字符取二元组，单字保留原样，英文和数字按单词"""
+    tokens = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if run[0] >= '⺀' and len(run) > 1:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class MemoryIndex:
+    """单个聊天分支的增量 BM25 索引
+
+    每个词的倒排表用两个 array 保存（文档号和词频），追加新消息只在表尾写入；
+    检索时把倒排表零拷贝转成 NumPy 数组，一次 bincount 累加所有查询词的得分。
+    公共消息记录它在聊天记录里的位置，私聊消息只对所属角色可见。
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._doc_len = array('f')
+        self._positions = array('i')
+        self._owners = array('i')
+        self._owner_codes = {None: 0}
+        self._docs = []
+        self._total_len = 0.0
+        self.public_count = 0
+        self.private_counts = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, speaker, text, position=-1, owner=None):
+        """加入一条消息，position 是公共消息在聊天记录里的位置，私聊消息传入所属角色 owner"""
+        doc = len(self._docs)
+        counts = Counter(tokenize(text))
+        for term, tf in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = (array('i'), array('f'))
+            postings[0].append(doc)
+            postings[1].append(tf)
+        length = sum(counts.values())
+        self._doc_len.append(length)
+        self._total_len += length
+        self._positions.append(position)
+        self._owners.append(self._owner_codes.setdefault(owner, len(self._owner_codes)))
+        self._docs.append((speaker, text, position))
+
+    def search(self, query, k=4, before=None, owner=None):
+        """返回与 query 最相关的 k 条消息 [(发言者, 内容, 位置)]
+
+        before 限制只检索位置在它之前的公共消息；私聊消息只有 owner 本人能检索到。
+        """
+        n = len(self._docs)
+        terms = [t for t in set(tokenize(query)) if t in self._postings]
+        if not n or not terms:
+            return []
+
+        df = {t: len(self._postings[t][0]) for t in terms}
+        idf = {t: np.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5)) for t in terms}
+        terms = sorted(terms, key=idf.get, reverse=True)[:MAX_QUERY_TERMS]
+
+        doc_len = np.frombuffer(self._doc_len, dtype=np.float32)
+        avg_len = self._total_len / n
+        ids = []
+        weights = []
+        for term in terms:
+            docs = np.frombuffer(self._postings[term][0], dtype=np.int32)
+            tf = np.frombuffer(self._postings[term][1], dtype=np.float32)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len[docs] / avg_len)
+            ids.append(docs)
+            weights.append(idf[term] * tf * (BM25_K1 + 1) / (tf + norm))
+        scores = np.bincount(np.concatenate(ids), weights=np.concatenate(weights), minlength=n)
+
+        positions = np.frombuffer(self._positions, dtype=np.int32)
+        owners = np.frombuffer(self._owners, dtype=np.int32)
+        visible = owners == 0
+        if owner in self._owner_codes:
+            visible |= owners == self._owner_codes[owner]
+        if before is not None:
+            visible &= (positions < before) | (owners != 0)
+        scores[~visible] = 0
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(scores[candidates], -k)[-k:]]
+        ranked = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [self._docs[i] for i in ranked]
+
+
+class ChatMemory:
+    """按（聊天ID, 分支）管理检索索引，检索前把新追加的消息补进索引
+
+    只加载了尾部的聊天通过 loader(chat, start, stop) 读取更早的消息，没有 loader 时只索引内存中的部分。
+    """
+
+    LOAD_CHUNK = 5000
+
+    def __init__(self, loader=None, max_chats=16):
+        self.loader = loader
+        self.max_chats = max_chats
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _index_for(self, chat):
+        key = (chat.get('id'), chat.get('branch'))
+        with self._lock:
+            index = self._indexes.pop(key, None)
+            if index is None:
+                index = MemoryIndex()
+            # 按最近使用排序，超出上限时淘汰最久未用的
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_chats:
+                self._indexes.pop(next(iter(self._indexes)))
+        return index
+
+    def _sync(self, index, chat):
+        history = chat.get('chat_history', [])
+        offset = chat.get('history_offset', 0)
+        while index.public_count < offset:
+            if self.loader is None:
+                index.public_count = offset
+                break
+            stop = min(offset, index.public_count + self.LOAD_CHUNK)
+            older = self.loader(chat, index.public_count, stop)
+            if not older:
+                index.public_count = offset
+                break
+            for msg in older:
+                index.add(msg[0], msg[2], index.public_count)
+                index.public_count += 1
+        for msg in history[index.public_count - offset:]:
+            index.add(msg[0], msg[2], index.public_count)
+            index.public_count += 1
+
+        for agent_name, messages in chat.get('private_history', {}).items():
+            done = index.private_counts.get(agent_name, 0)
+            for msg in messages[done:]:
+                index.add(msg[0], msg[2], owner=agent_name)
+            index.private_counts[agent_name] = len(messages)
+
+    def invalidate(self, chat_id):
+        """丢弃聊天所有分支的索引，已索引的消息内容变化（如切换回复版本）后调用"""
+        with self._lock:
+            for key in [key for key in self._indexes if key[0] == chat_id]:
+                del self._indexes[key]
+
+    def search(self, chat, query, k=4, before=None, agent_name=None):
+        """检索与 query 相关的早期消息，before 之后的公共消息已在请求窗口里，不再返回"""
+        index = self._index_for(chat)
+        with index.lock:
+            self._sync(index, chat)
+            return index.search(query, k=k, before=before, owner=agent_name)
+
+
+chat_memory = ChatMemory()
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from generation_policy import LENGTH_HINT
+
+
+# ================== 录制与回放 ==================
+# 把模型请求和响应（流式输出连同每块的到达时间）录进本地 JSONL 磁带，回放时按原始或缩放后的延迟返回，
+# 应用和基准测试都可以离线复现。通过环境变量开启：
+#   MODEL_CASSETTE=磁带路径  CASSETTE_MODE=record|replay|auto  CASSETTE_SPEED=延迟倍数（0 表示不等待）
+CASSETTE_ENV = "MODEL_CASSETTE"
+CASSETTE_MODE_ENV = "CASSETTE_MODE"
+CASSETTE_SPEED_ENV = "CASSETTE_SPEED"
+CASSETTE_STRICT_ENV = "CASSETTE_STRICT"
+
+# record 总是请求真实接口并录制；replay 只回放，找不到录制时报错；auto 有录制就回放，没有就请求并录制
+MODES = ('record', 'replay', 'auto')
+
+
+class CassetteMiss(LookupError):
+    """回放时找不到与请求匹配的录制"""
+
+
+# 不计入指纹的参数：max_tokens 由生成策略按实测速度和回合剩余时间决定，同一段对话每次运行都可能不一样
+VOLATILE_PARAMS = ('max_tokens',)
+
+# 指令末尾的篇幅提示由 max_tokens 换算而来，计算指纹前从消息里去掉
+VOLATILE_TEXT = re.compile(re.escape(LENGTH_HINT).replace(re.escape("{chars}"), r"\d+"))
+
+
+def _stable_message(message):
+    content = message.get('content') if isinstance(message, dict) else None
+    if not isinstance(content, str):
+        return message
+    return {**message, 'content': VOLATILE_TEXT.sub('', content)}
+
+
+def request_key(kwargs):
+    """请求参数的指纹，除 VOLATILE_PARAMS 和消息里的篇幅提示外参数完全相同的请求对应同一组录制"""
+    stable = {k: v for k, v in kwargs.items() if k not in VOLATILE_PARAMS}
+    if isinstance(stable.get('messages'), list):
+        stable['messages'] = [_stable_message(message) for message in stable['messages']]
+    payload = json.dumps(stable, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+class Cassette:
+    """磁带文件：每行一次调用，记录请求指纹、请求内容、延迟和响应
+
+    同一指纹录了多次时按顺序依次回放，用完后重复最后一条；
+    非严格模式下找不到指纹时，按录制顺序取下一条还没回放过的同类录制，
+    这样提示里带时间等细节变化的运行也能回放。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = []
+        self._by_key = {}
+        self._served = {}
+        self._used = set()
+        self._cursor = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._index(json.loads(line))
+                    except ValueError:
+                        continue
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _index(self, entry):
+        self._by_key.setdefault(entry['key'], []).append(len(self._entries))
+        self._entries.append(entry)
+
+    def add(self, entry):
+        """追加一条录制"""
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            self._index(entry)
+
+    def find(self, key, stream, strict=False):
+        """取出与请求匹配的录制，没有时返回 None"""
+        with self._lock:
+            indexes = self._by_key.get(key)
+            if indexes:
+                served = self._served.get(key, 0)
+                self._served[key] = served + 1
+                index = indexes[min(served, len(indexes) - 1)]
+                self._used.add(index)
+                return self._entries[index]
+            if strict:
+                return None
+            for index in range(self._cursor, len(self._entries)):
+                if index not in self._used and self._entries[index]['stream'] == stream:
+                    self._used.add(index)
+                    self._cursor = index + 1
+                    return self._entries[index]
+            return None
+
+
+class CassetteClient:
+    """包装 OpenAI 客户端录制或回放补全请求，调用方式与 client.chat.completions.create 相同
+
+    replayed 表示本线程最近一次调用是否由磁带回放：回放的耗时不代表接口的速度，
+    生成策略只学习录制和未命中时真实请求的耗时。
+    """
+
+    def __init__(self, client, path, mode='replay', speed=1.0, strict=False):
+        if mode not in MODES:
+            raise ValueError(f"未知的磁带模式：{mode}")
+        self._client = client
+        self.cassette = Cassette(path)
+        self.mode = mode
+        self.speed = speed
+        self.strict = strict
+        self._local = threading.local()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    @property
+    def replayed(self):
+        return getattr(self._local, 'replayed', False)
+
+    def _create(self, **kwargs):
+        key = request_key(kwargs)
+        stream = bool(kwargs.get('stream'))
+        self._local.replayed = False
+        if self.mode != 'record':
+            entry = self.cassette.find(key, stream, self.strict)
+            if entry is not None:
+                self._local.replayed = True
+                return self._replay_stream(entry) if stream else self._replay(entry)
+            if self.mode == 'replay':
+                raise CassetteMiss(f"磁带 {self.cassette.path} 中没有匹配的录制（{kwargs.get('model')}）")
+        return self._record(key, kwargs, stream)
+
+    # ---------- 录制 ----------
+    def _record(self, key, kwargs, stream):
+        started = time.perf_counter()
+        response = self._client.chat.completions.create(**kwargs)
+        if stream:
+            return self._record_stream(key, kwargs, response, started)
+        self.cassette.add({
+            'key': key,
+            'request': kwargs,
+            'stream': False,
+            'latency': round(time.perf_counter() - started, 4),
+            'response': response.model_dump(mode='json'),
+        })
+        return response
+
+    def _record_stream(self, key, kwargs, response, started):
+        chunks = []
+        for chunk in response:
+            chunks.append({'t': round(time.perf_counter() - started, 4), 'chunk': chunk.model_dump(mode='json')})
+            yield chunk
+        # 只录制完整读完的流
+        self.cassette.add({
+            'key': key,
+            'request': kwargs,
+            'stream': True,
+            'latency': chunks[0]['t'] if chunks else 0.0,
+            'chunks': chunks,
+        })
+
+    # ---------- 回放 ----------
+    def _replay(self, entry):
+        if self.speed > 0:
+            time.sleep(entry['latency'] * self.speed)
+        return ChatCompletion.model_validate(entry['response'])
+
+    def _replay_stream(self, entry):
+        started = time.perf_counter()
+        for recorded in entry['chunks']:
+            if self.speed > 0:
+                delay = recorded['t'] * self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            yield ChatCompletionChunk.model_validate(recorded['chunk'])
+
+
+def cassette_from_env(client):
+    """设置了 MODEL_CASSETTE 时返回包装后的客户端，否则原样返回"""
+    path = os.getenv(CASSETTE_ENV)
+    if not path:
+        return client
+    try:
+        speed = float(os.getenv(CASSETTE_SPEED_ENV, "1") or 1)
+    except ValueError:
+        speed = 1.0
+    return CassetteClient(
+        client,
+        path,
+        mode=os.getenv(CASSETTE_MODE_ENV, "replay"),
+        speed=speed,
+        strict=os.getenv(CASSETTE_STRICT_ENV, "").lower() in ("1", "true", "yes"),
+    )
@@ -0,0 +1,223 @@
+"""无界面批量运行场景
+
+通过 ChatManager 读取已保存的场景，让角色按轮流顺序对话若干轮，再把结果写回聊天记录。
+多个场景分给进程池并行运行，每个模型接口的并发请求数单独限制，适合夜间批量生成评测用的对话记录。
+
+用法：
+    python scene_runner.py --rounds 5 --processes 4 --per-endpoint 2
+    python scene_runner.py --chats <聊天ID> <聊天ID> --new-branch 评测 --output results.jsonl
+    python scene_runner.py --endpoint http://host-a:8000 --endpoint http://host-b:8000 --limit 100
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from types import SimpleNamespace
+
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from agent_engine import (
+    DEFAULT_MODEL,
+    HISTORY_STEP,
+    HISTORY_WINDOW,
+    generate_agent_turn,
+    generate_introductions,
+    next_speaker,
+)
+from chat_storage import ChatManager, append_public_message
+from memory_index import chat_memory
+from model_cassette import cassette_from_env
+from usage_ledger import LEDGER_NAME, usage_ledger
+
+DEFAULT_BASE_URL = "https://api.deepseek.com"
+
+# 只加载请求窗口需要的尾部消息，更早的消息由检索记忆按需读取
+LOAD_TAIL = HISTORY_WINDOW + HISTORY_STEP
+
+
+class EndpointClient:
+    """包装 OpenAI 客户端，用跨进程共享的信号量限制同一接口的并发请求数"""
+
+    def __init__(self, client, semaphore):
+        self._client = client
+        self._semaphore = semaphore
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    @property
+    def replayed(self):
+        """被包装的客户端是否从磁带回放了本线程最近一次调用"""
+        return getattr(self._client, 'replayed', False)
+
+    def _create(self, **kwargs):
+        with self._semaphore:
+            return self._client.chat.completions.create(**kwargs)
+
+
+# 工作进程内的状态，由 _init_worker 在进程启动时设置
+_worker = {}
+
+
+def _init_worker(data_dir, endpoints, semaphores, api_key):
+    chat_manager = ChatManager(data_dir)
+    chat_memory.loader = chat_manager.load_messages
+    usage_ledger.open(chat_manager.data_dir / LEDGER_NAME)
+    _worker['chat_manager'] = chat_manager
+    _worker['clients'] = {
+        url: EndpointClient(cassette_from_env(OpenAI(api_key=api_key, base_url=url)), semaphore)
+        for url, semaphore in zip(endpoints, semaphores)
+    }
+
+
+def scene_summary(chat_id, endpoint, error=None):
+    """一个场景的结果摘要"""
+    return {'id': chat_id, 'endpoint': endpoint, 'messages': 0, 'error': error}
+
+
+def run_scene(chat_id, endpoint, rounds, model=DEFAULT_MODEL, branch=None, new_branch=None):
+    """在工作进程中运行一个场景并保存，返回结果摘要
+
+    还没有消息的场景第一轮先做自我介绍，之后每轮所有角色按顺序各发言一次；
+    指定 new_branch 时先在当前末尾分叉，生成的对话只写入新分支。
+    """
+    chat_manager = _worker['chat_manager']
+    client = _worker['clients'][endpoint]
+    started = time.perf_counter()
+    summary = scene_summary(chat_id, endpoint)
+
+    try:
+        chat = chat_manager.load_chat(chat_id, tail=LOAD_TAIL, branch=branch)
+    except Exception as e:
+        summary['error'] = f"读取场景失败：{e}"
+        return summary
+    if chat is None:
+        summary['error'] = "场景不存在"
+        return summary
+    summary['title'] = chat.get('title', '无标题')
+    agents = chat.get('agents', {})
+    if not agents:
+        summary['error'] = "场景没有角色"
+        return summary
+    if new_branch:
+        end = chat.get('history_offset', 0) + len(chat['chat_history'])
+        try:
+            created = chat_manager.create_branch(chat, end, new_branch)
+        except Exception as e:
+            summary['error'] = f"创建分支失败：{e}"
+            return summary
+        if created is None:
+            summary['error'] = f"分支 {new_branch} 已存在"
+            return summary
+    summary['branch'] = chat.get('branch')
+    before = usage_ledger.chat_totals(chat_id)
+
+    def append(agent_name, content):
+        if content:
+            append_public_message(chat, agent_name, agents[agent_name].get('avatar', '👤'), content)
+            summary['messages'] += 1
+
+    saved = 0
+    try:
+        for _ in range(rounds):
+            if not chat.get('history_offset') and not chat['chat_history']:
+                for agent_name, content in generate_introductions(client, chat, batch=True, model=model):
+                    append(agent_name, content)
+            else:
+                for _ in range(len(agents)):
+                    agent_name = next_speaker(chat)
+                    append(agent_name, generate_agent_turn(client, chat, agent_name, model=model))
+            # 每轮保存一次，中途出错也保留已经生成的部分
+            chat_manager.save_chat(chat, chat_id)
+            saved = summary['messages']
+    except Exception as e:
+        summary['error'] = str(e)
+        if summary['messages'] > saved:
+            # 保存出错的原因（磁盘、锁）可能还在，再失败时只记进摘要
+            try:
+                chat_manager.save_chat(chat, chat_id)
+            except Exception as save_error:
+                summary['error'] += f"；保存未完成的一轮失败：{save_error}"
+
+    after = usage_ledger.chat_totals(chat_id)
+    summary['calls'] = after['calls'] - before['calls']
+    summary['prompt_tokens'] = after['prompt_tokens'] - before['prompt_tokens']
+    summary['completion_tokens'] = after['completion_tokens'] - before['completion_tokens']
+    summary['cost'] = round(after['cost'] - before['cost'], 6)
+    summary['seconds'] = round(time.perf_counter() - started, 2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="无界面批量运行场景")
+    parser.add_argument('--data-dir', default="chat_data", help="聊天数据目录")
+    parser.add_argument('--chats', nargs='*', default=None, help="要运行的聊天ID，默认按修改时间取全部")
+    parser.add_argument('--limit', type=int, default=None, help="未指定 --chats 时最多运行最近的几个场景")
+    parser.add_argument('--rounds', type=int, default=3, help="每个场景运行的轮数")
+    parser.add_argument('--model', default=DEFAULT_MODEL)
+    parser.add_argument('--branch', default=None, help="在哪个分支上继续，默认为上次保存的分支")
+    parser.add_argument('--new-branch', default=None, help="先分叉出这个分支，生成的对话只写入新分支")
+    parser.add_argument('--processes', type=int, default=4, help="工作进程数")
+    parser.add_argument('--endpoint', action='append', default=None,
+                        help="模型接口地址，可重复指定，场景轮流分配；默认取 DEEPSEEK_BASE_URL")
+    parser.add_argument('--per-endpoint', type=int, default=2, help="每个接口同时进行的请求数上限")
+    parser.add_argument('--output', default=None, help="把每个场景的结果摘要写入 JSONL 文件")
+    args = parser.parse_args()
+
+    load_dotenv()
+    endpoints = args.endpoint or [os.getenv("DEEPSEEK_BASE_URL", DEFAULT_BASE_URL)]
+    if args.chats:
+        chat_ids = args.chats
+    else:
+        chat_ids = [chat['id'] for chat in ChatManager(args.data_dir).list_chats(args.limit)]
+    if not chat_ids:
+        print("没有可运行的场景")
+        return 1
+
+    context = multiprocessing.get_context()
+    semaphores = [context.BoundedSemaphore(args.per_endpoint) for _ in endpoints]
+    print(f"运行 {len(chat_ids)} 个场景，每个 {args.rounds} 轮，{args.processes} 个进程，{len(endpoints)} 个接口")
+
+    started = time.perf_counter()
+    results = []
+    output = open(args.output, 'a', encoding='utf-8') if args.output else None
+    try:
+        with ProcessPoolExecutor(
+            max_workers=args.processes,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(args.data_dir, endpoints, semaphores, os.getenv("DEEPSEEK_API_KEY")),
+        ) as pool:
+            futures = {
+                pool.submit(run_scene, chat_id, endpoints[i % len(endpoints)], args.rounds,
+                            args.model, args.branch, args.new_branch): (chat_id, endpoints[i % len(endpoints)])
+                for i, chat_id in enumerate(chat_ids)
+            }
+            for future in as_completed(futures):
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    # 场景抛出了异常或工作进程退出，记下失败，继续等其余的场景
+                    summary = scene_summary(*futures[future], error=f"{type(e).__name__}: {e}")
+                results.append(summary)
+                status = f"失败：{summary['error']}" if summary['error'] else "完成"
+                print(f"[{len(results)}/{len(chat_ids)}] {summary.get('title', summary['id'])} "
+                      f"+{summary['messages']} 条，{summary.get('seconds', 0)}s，{status}")
+                if output:
+                    output.write(json.dumps(summary, ensure_ascii=False) + "\n")
+                    output.flush()
+    finally:
+        if output:
+            output.close()
+
+    failed = sum(1 for r in results if r['error'])
+    print(f"共生成 {sum(r['messages'] for r in results)} 条消息，"
+          f"花费 ${sum(r.get('cost', 0) for r in results):.4f}，"
+          f"耗时 {time.perf_counter() - started:.1f}s，失败 {failed} 个")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
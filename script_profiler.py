@@ -0,0 +1,170 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# ================== 脚本剖析 ==================
+# 设置环境变量 PROFILE_SCRIPT=1 或在地址后加 ?profile=1 开启，逐段记录一次脚本重跑的耗时。
+# 片段单独重跑时不经过整页的剖析，由片段包装器各自写一份 fragment-*.json 追踪。
+PROFILE_ENV = "PROFILE_SCRIPT"
+PROFILE_PARAM = "profile"
+
+# 追踪文件和 cProfile 结果的输出目录
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# 目录里最多保留的追踪份数，超出时删除最旧的
+try:
+    PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50") or 50)
+except ValueError:
+    PROFILE_KEEP = 50
+
+
+def profiling_enabled(query_params=None):
+    """环境变量或查询参数打开了剖析模式时返回 True"""
+    if os.getenv(PROFILE_ENV, "").lower() in ("1", "true", "yes", "on"):
+        return True
+    if query_params is not None:
+        return query_params.get(PROFILE_PARAM, "") not in ("", "0", "false")
+    return False
+
+
+class ScriptProfiler:
+    """记录一次脚本重跑里各个命名段落的起止时间
+
+    顶层段落用 mark 顺序切换，不必改动代码缩进；嵌套的部分（如片段）用 section 包裹。
+    结果可以汇总成表，也可以导出为 Chrome 追踪格式，用 chrome://tracing 或 Perfetto 查看。
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.events = []
+        self.active = True
+        self.total = None
+        self._current = None
+        self._depth = 0
+        self._profile = None
+        self.cprofile_report = None
+
+    def _close(self, event):
+        event['dur'] = time.perf_counter() - event['start']
+
+    def mark(self, name):
+        """结束当前的顶层段落并开始新的一段"""
+        if not self.active:
+            return
+        if self._current is not None:
+            self._close(self._current)
+        self._current = {'name': name, 'start': time.perf_counter(), 'depth': 0}
+        self.events.append(self._current)
+
+    @contextmanager
+    def section(self, name):
+        """记录一个嵌套段落"""
+        if not self.active:
+            yield
+            return
+        self._depth += 1
+        event = {'name': name, 'start': time.perf_counter(), 'depth': self._depth}
+        self.events.append(event)
+        try:
+            yield
+        finally:
+            self._close(event)
+            self._depth -= 1
+
+    # ---------- cProfile ----------
+    def start_cprofile(self):
+        """对本次重跑开启 cProfile，已有别的剖析器在运行时返回 False"""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return False
+        self._profile = profile
+        return True
+
+    def _stop_cprofile(self, limit):
+        self._profile.disable()
+        stream = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(limit)
+        self.cprofile_report = stream.getvalue()
+
+    def finish(self, cprofile_limit=30):
+        """结束剖析，之后的 mark 和 section 不再记录"""
+        if not self.active:
+            return
+        if self._current is not None:
+            self._close(self._current)
+            self._current = None
+        if self._profile is not None:
+            self._stop_cprofile(cprofile_limit)
+        self.active = False
+        self.total = time.perf_counter() - self.started
+
+    # ---------- 输出 ----------
+    def breakdown(self):
+        """各段落的耗时表，按执行顺序排列"""
+        return [
+            {
+                '段落': "　" * e['depth'] + e['name'],
+                '开始(ms)': round((e['start'] - self.started) * 1000, 1),
+                '耗时(ms)': round(e.get('dur', 0) * 1000, 1),
+            }
+            for e in self.events
+        ]
+
+    def chrome_trace(self):
+        """Chrome 追踪事件格式（完整事件 ph=X，时间单位为微秒）"""
+        pid = os.getpid()
+        tid = threading.get_ident()
+        events = [
+            {
+                'name': e['name'],
+                'cat': "script",
+                'ph': "X",
+                'ts': round((e['start'] - self.started) * 1e6, 1),
+                'dur': round(e.get('dur', 0) * 1e6, 1),
+                'pid': pid,
+                'tid': tid,
+            }
+            for e in self.events
+        ]
+        events.append({'name': "thread_name", 'ph': "M", 'pid': pid, 'tid': tid, 'args': {'name': "脚本重跑"}})
+        return {'traceEvents': events, 'displayTimeUnit': "ms"}
+
+    def write_trace(self, directory=PROFILE_DIR, prefix="trace", keep=PROFILE_KEEP):
+        """把追踪写入文件，有 cProfile 结果时同时保存 .prof 文件，返回追踪文件路径"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S") + f"-{int(time.time() * 1000) % 1000:03d}"
+        path = directory / f"{prefix}-{stamp}.json"
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f, ensure_ascii=False)
+        if self._profile is not None:
+            self._profile.dump_stats(str(path.with_suffix(".prof")))
+        prune_traces(directory, keep)
+        return path
+
+
+def _mtime(path):
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return 0.0
+
+
+def prune_traces(directory=PROFILE_DIR, keep=PROFILE_KEEP):
+    """只保留最新的 keep 份追踪及对应的 .prof 文件，keep 为 0 时不清理"""
+    if keep <= 0:
+        return
+    traces = sorted(Path(directory).glob("*.json"), key=_mtime)
+    for path in traces[:-keep]:
+        path.unlink(missing_ok=True)
+        path.with_suffix(".prof").unlink(missing_ok=True)
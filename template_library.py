@@ -0,0 +1,150 @@
+import json
+import random
+import uuid
+from pathlib import Path
+
+from agent_engine import compile_agent_prefix
+
+
+# ================== 场景与角色模板库 ==================
+class TemplateLibrary:
+    """本地的场景和角色模板库
+
+    templates/index.json 记录每个模板的文件名和摘要，列出模板时只读索引；
+    角色的静态系统提示前缀在首次读取时编译一次，之后原样复用。
+    """
+
+    KINDS = ("scenes", "agents")
+
+    def __init__(self, template_dir="templates"):
+        self.template_dir = Path(template_dir)
+        for kind in self.KINDS:
+            (self.template_dir / kind).mkdir(parents=True, exist_ok=True)
+        self.index_path = self.template_dir / "index.json"
+        self._templates = {}
+        self._prefixes = {}
+        if self.index_path.exists():
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        else:
+            self.rebuild_index()
+
+    def rebuild_index(self):
+        """扫描模板目录重建索引"""
+        self.index = {kind: {} for kind in self.KINDS}
+        for kind in self.KINDS:
+            for file in sorted((self.template_dir / kind).glob("*.json")):
+                try:
+                    with open(file, 'r', encoding='utf-8') as f:
+                        template = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                self.index[kind][template['name']] = self._index_entry(kind, file.name, template)
+        self._write_index()
+
+    def _index_entry(self, kind, filename, template):
+        entry = {'file': filename}
+        if kind == "agents":
+            entry['avatar'] = template.get('avatar', '👤')
+        else:
+            entry['agents'] = template.get('agents', [])
+        return entry
+
+    def _write_index(self):
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, ensure_ascii=False, indent=2)
+
+    def _load(self, kind, name):
+        key = (kind, name)
+        if key not in self._templates:
+            entry = self.index[kind].get(name)
+            if entry is None:
+                return None
+            with open(self.template_dir / kind / entry['file'], 'r', encoding='utf-8') as f:
+                self._templates[key] = json.load(f)
+        return self._templates[key]
+
+    def _save(self, kind, template):
+        name = template['name']
+        entry = self.index[kind].get(name)
+        filename = entry['file'] if entry else f"{uuid.uuid4()}.json"
+        with open(self.template_dir / kind / filename, 'w', encoding='utf-8') as f:
+            json.dump(template, f, ensure_ascii=False, indent=2)
+        self._templates[(kind, name)] = template
+        if kind == "agents":
+            self._prefixes.pop(name, None)
+        self.index[kind][name] = self._index_entry(kind, filename, template)
+        self._write_index()
+
+    # ---------- 角色模板 ----------
+    def agent_names(self):
+        """所有角色模板的名字"""
+        return list(self.index["agents"].keys())
+
+    def get_agent(self, name):
+        return self._load("agents", name)
+
+    def agent_prefix(self, name):
+        """角色模板已编译的系统提示前缀"""
+        if name not in self._prefixes:
+            template = self.get_agent(name)
+            self._prefixes[name] = compile_agent_prefix(name, template.get('personality', ''))
+        return self._prefixes[name]
+
+    def agent_data(self, name):
+        """生成可直接放进聊天 agents 字典的角色数据，附带预编译的前缀"""
+        template = self.get_agent(name)
+        if template is None:
+            return {'avatar': "👤", 'system_prompt': ''}
+        return {
+            'avatar': template.get('avatar', "👤"),
+            'system_prompt': '',
+            'personality': template.get('personality', ''),
+            'prompt_prefix': self.agent_prefix(name),
+            'prefix_source': template.get('personality', ''),
+        }
+
+    def random_agents(self, count=3):
+        """随机挑选若干角色模板"""
+        names = self.agent_names()
+        return random.sample(names, min(count, len(names)))
+
+    def save_agent(self, name, data):
+        """把聊天中的角色保存为模板"""
+        self._save("agents", {
+            'name': name,
+            'avatar': data.get('avatar', "👤"),
+            'personality': data.get('personality', ''),
+        })
+
+    # ---------- 场景模板 ----------
+    def scene_names(self):
+        """所有场景模板的名字"""
+        return list(self.index["scenes"].keys())
+
+    def get_scene(self, name):
+        return self._load("scenes", name)
+
+    def apply_scene(self, name, chat):
+        """把场景模板应用到聊天上，已有的同名角色保持不变"""
+        template = self.get_scene(name)
+        if template is None:
+            return False
+        chat['title'] = template['name']
+        chat['scenario'] = template.get('scenario', '')
+        chat['user_role'] = template.get('user_role', '您')
+        for agent_name in template.get('agents', []):
+            if agent_name not in chat['agents']:
+                chat['agents'][agent_name] = self.agent_data(agent_name)
+        return True
+
+    def save_scene(self, chat):
+        """把当前场景及其角色保存为模板"""
+        for agent_name, data in chat.get('agents', {}).items():
+            self.save_agent(agent_name, data)
+        self._save("scenes", {
+            'name': chat.get('title', '无标题'),
+            'scenario': chat.get('scenario', ''),
+            'user_role': chat.get('user_role', '您'),
+            'agents': list(chat.get('agents', {}).keys()),
+        })
@@ -0,0 +1,33 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from chat_storage import ChatManager, append_public_message  # noqa: E402
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return ChatManager(tmp_path / "chat_data")
+
+
+def make_chat(count, title="测试聊天"):
+    """内存中的新聊天，带 count 条公共消息"""
+    chat = {
+        'title': title,
+        'scenario': '',
+        'user_role': '您',
+        'agents': {},
+        'private_history': {},
+        'chat_history': [],
+    }
+    for i in range(count):
+        append_public_message(chat, '女巫' if i % 2 else '您', '🧙', f"第{i}条消息。", "12:00")
+    return chat
+
+
+def texts(chat):
+    return [msg[2] for msg in chat['chat_history']]
@@ -0,0 +1,208 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import agent_engine
+from agent_engine import (HISTORY_STEP, HISTORY_WINDOW, GenerationWorker, SpeculativeCache, agent_prompt_prefix,
+                          build_agent_messages, compile_agent_prefix, history_window, next_speaker, relevance_scores,
+                          route_responders)
+from chat_storage import append_public_message
+from usage_ledger import LEDGER_NAME, UsageLedger
+from conftest import make_chat
+
+
+def scene(count):
+    chat = make_chat(count)
+    chat['scenario'] = "雨夜咖啡馆"
+    chat['agents'] = {'女巫': {'avatar': '🧙', 'personality': '神秘，喜欢占卜'}, '侦探': {'avatar': '🕵️'}}
+    return chat
+
+
+# ================== 提示前缀 ==================
+def test_prefix_compiled_once():
+    data = {'personality': '神秘'}
+    prefix = agent_prompt_prefix('女巫', data)
+    assert prefix == compile_agent_prefix('女巫', '神秘')
+    assert agent_prompt_prefix('女巫', data) is prefix
+    data['personality'] = '健谈'
+    assert agent_prompt_prefix('女巫', data) == compile_agent_prefix('女巫', '健谈')
+    assert "健谈" in data['prompt_prefix']
+
+
+def test_request_prefix_stable_across_turns(monkeypatch):
+    # 只看系统提示和历史窗口，检索到的记忆和指令跟在后面
+    monkeypatch.setattr(agent_engine, 'recall_messages', lambda *args: None)
+    chat = scene(HISTORY_WINDOW + 1)
+    previous = build_agent_messages(chat, '女巫')
+    shifts = 0
+    for i in range(3 * HISTORY_STEP):
+        append_public_message(chat, '侦探', '🕵️', f"第{i}条新线索。", "12:01")
+        messages = build_agent_messages(chat, '女巫')
+        assert HISTORY_WINDOW <= len(messages) - 1 < HISTORY_WINDOW + HISTORY_STEP
+        if messages[:len(previous)] != previous:
+            # 窗口起点只在跨过一个 HISTORY_STEP 时整块后移
+            shifts += 1
+            assert messages[0] == previous[0]
+        previous = messages
+    assert shifts == 3
+
+
+def test_history_window_matches_tail_load(manager):
+    chat_id = manager.save_chat(scene(HISTORY_WINDOW + 37))
+    expected = history_window(manager.load_chat(chat_id)['chat_history'])
+    # 应用和批量运行加载 HISTORY_WINDOW + HISTORY_STEP 条尾部消息，窗口与完整加载时相同
+    loaded = manager.load_chat(chat_id, tail=HISTORY_WINDOW + HISTORY_STEP)
+    assert history_window(loaded['chat_history'], loaded['history_offset']) == expected
+    # 尾部不够对齐时只少带开头的几条，不改变窗口里的其余内容
+    loaded = manager.load_chat(chat_id, tail=HISTORY_WINDOW)
+    window = history_window(loaded['chat_history'], loaded['history_offset'])
+    assert window == expected[-HISTORY_WINDOW:]
+
+
+# ================== 回应路由 ==================
+def cast(count=0):
+    chat = make_chat(count)
+    chat['agents'] = {
+        '女巫': {'personality': '神秘，擅长占卜和草药'},
+        '侦探': {'personality': '冷静，擅长推理和调查案件'},
+        '商人': {'personality': '精明，喜欢讨价还价'},
+    }
+    return chat
+
+
+def test_mentions_pick_responders_in_order():
+    chat = cast()
+    assert route_responders(chat, "@商人 这个多少钱？@女巫 你也看看") == ['商人', '女巫']
+    # 提到了角色时不看相关度
+    assert route_responders(chat, "@商人 帮我推理一下这个案件") == ['商人']
+    assert route_responders(chat, "@侦探 @女巫 @商人 都来", max_responders=2) == ['侦探', '女巫']
+    assert route_responders(chat, "@女巫 你好", max_responders=0) == []
+    assert route_responders({'agents': {}}, "@女巫 你好") == []
+
+
+def test_relevance_fallback():
+    chat = cast()
+    assert route_responders(chat, "能帮我调查一下这个案件吗") == ['侦探']
+    assert set(route_responders(chat, "我想占卜一下，顺便讨价还价")) == {'女巫', '商人'}
+    assert relevance_scores(chat, "我想占卜一下")['侦探'] == 0
+    # 直接叫名字不带 @ 也算
+    assert route_responders(chat, "侦探先生，晚上好")[0] == '侦探'
+
+
+def test_unrelated_message_goes_to_next_speaker():
+    chat = cast()
+    chat['chat_history'] = [['女巫', '🧙', '欢迎。', '12:00'], ['您', '👤', '谢谢。', '12:00']]
+    assert route_responders(chat, "今天天气不错") == [next_speaker(chat)] == ['侦探']
+
+
+# ================== 后台生成 ==================
+def blocked_job(release, cancel_event=None):
+    release.wait(5)
+    return "完成"
+
+
+def test_worker_dedups_jobs():
+    worker = GenerationWorker(max_workers=2)
+    release = threading.Event()
+    first = worker.submit('会话', 'chat', ('reply',), "回应", blocked_job, release)
+    assert worker.submit('会话', 'chat', ('reply',), "回应", blocked_job, release) == first
+    assert worker.submit('另一会话', 'chat', ('reply',), "回应", blocked_job, release) != first
+    regen = worker.submit('会话', 'chat', ('regen', 3), "重新生成", blocked_job, release)
+    assert regen != first
+    assert [job['id'] for job in worker.pending('会话', 'chat')][0] == first
+    # 取消之后再提交是新的任务，取消的结果不再交付
+    worker.cancel(first)
+    second = worker.submit('会话', 'chat', ('reply',), "回应", blocked_job, release)
+    assert second != first
+    release.set()
+    deadline = time.monotonic() + 5
+    while worker.pending('会话') and time.monotonic() < deadline:
+        time.sleep(0.01)
+    finished = worker.collect('会话')
+    assert sorted(job['id'] for job, _, _ in finished) == sorted([second, regen])
+    assert all(result == "完成" and error is None for _, result, error in finished)
+    assert not worker.has_jobs('会话')
+
+
+def test_worker_prunes_uncollected_jobs():
+    worker = GenerationWorker(job_ttl=0.05)
+    release = threading.Event()
+    release.set()
+    worker.submit('关掉的标签页', 'chat', ('reply',), "回应", blocked_job, release)
+    deadline = time.monotonic() + 5
+    while worker.pending('关掉的标签页') and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert worker.has_jobs('关掉的标签页')
+    time.sleep(0.1)
+    # 完成超过 job_ttl 一直没有被取回的任务在下次提交时清理
+    worker.submit('会话', 'chat', ('reply',), "回应", blocked_job, release)
+    assert not worker.has_jobs('关掉的标签页')
+
+
+# ================== 预生成缓存 ==================
+class GatedClient:
+    """等 release 之后才回复的客户端，记录请求次数"""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.calls += 1
+        self.release.wait(5)
+        choice = SimpleNamespace(message=SimpleNamespace(content=f"第{self.calls}次预生成。"), finish_reason="stop")
+        return SimpleNamespace(choices=[choice], usage=None)
+
+
+@pytest.fixture
+def ledger(manager, monkeypatch):
+    ledger = UsageLedger(manager.data_dir / LEDGER_NAME)
+    monkeypatch.setattr(agent_engine, 'usage_ledger', ledger)
+    return ledger
+
+
+def test_prefetch_taken_when_history_unchanged(ledger):
+    cache = SpeculativeCache()
+    client = GatedClient()
+    chat = {**scene(2), 'id': 'chat'}
+    agent = next_speaker(chat)
+    cache.prefetch(client, chat)
+    future = cache._entries['chat']['future']
+    # 记录没变时重复预取沿用同一个任务
+    cache.prefetch(client, chat)
+    assert cache._entries['chat']['future'] is future
+    client.release.set()
+    assert cache.take(chat, agent, timeout=5) == "第1次预生成。"
+    assert client.calls == 1
+    # 结果只能取用一次
+    assert cache.take(chat, agent) is None
+
+
+def test_prefetch_dropped_when_history_changes(ledger):
+    cache = SpeculativeCache()
+    client = GatedClient()
+    client.release.set()
+    chat = {**scene(2), 'id': 'chat'}
+    agent = next_speaker(chat)
+    cache.prefetch(client, chat)
+    append_public_message(chat, '您', '👤', "等一下，我改主意了。", "12:01")
+    assert cache.take(chat, agent, timeout=5) is None
+    assert 'chat' not in cache._entries
+
+    # 轮到的角色不对也不取用
+    cache.prefetch(client, chat)
+    assert cache.take(chat, '您', timeout=5) is None
+
+    cache.prefetch(client, chat)
+    cache.discard('chat')
+    assert cache.take(chat, next_speaker(chat), timeout=5) is None
+
+    # 接近预算时不再预取
+    ledger.set_budgets(chat_budget=1.0)
+    ledger.record('chat', '女巫', 'deepseek-chat', SimpleNamespace(
+        prompt_tokens=0, prompt_cache_hit_tokens=0, prompt_cache_miss_tokens=0, completion_tokens=900_000))
+    cache.prefetch(client, chat)
+    assert 'chat' not in cache._entries
@@ -0,0 +1,112 @@
+import os
+import time
+
+import pytest
+
+from chat_replication import LocalStore, Replicator
+from chat_storage import HISTORY_PREFIX, ChatManager, append_public_message
+from conftest import make_chat, texts
+
+
+@pytest.fixture
+def replicator(manager, tmp_path):
+    # 块很小，记录文件跨好几个块
+    return Replicator(manager, LocalStore(tmp_path / "backup"), block_size=64)
+
+
+def replicate(replicator, **kwargs):
+    # 快照ID精确到毫秒
+    time.sleep(0.002)
+    return replicator.replicate(**kwargs)
+
+
+def restored(replicator, tmp_path, snapshot_id, name):
+    assert replicator.restore(snapshot_id, tmp_path / name) >= 0
+    return ChatManager(tmp_path / name)
+
+
+def test_snapshot_and_restore(manager, replicator, tmp_path):
+    chat_id = manager.save_chat(make_chat(8))
+    first = replicate(replicator)
+    assert first['chats'] == 1 and not first['failed']
+
+    chat = manager.load_chat(chat_id)
+    append_public_message(chat, '女巫', '🧙', "快照之后的消息。", "12:01")
+    manager.save_chat(chat, chat_id)
+    other_id = manager.save_chat(make_chat(2))
+    second = replicate(replicator)
+    assert second['chats'] == 2
+    assert replicator.snapshots() == [first['snapshot'], second['snapshot']]
+    # 变化的聊天只重传追加过的块
+    assert second['bytes_uploaded'] < first['bytes_uploaded'] * 2
+
+    latest = restored(replicator, tmp_path, second['snapshot'], "latest")
+    assert texts(latest.load_chat(chat_id))[-1] == "快照之后的消息。"
+    assert len(texts(latest.load_chat(other_id))) == 2
+    earlier = restored(replicator, tmp_path, first['snapshot'], "earlier")
+    assert texts(earlier.load_chat(chat_id)) == texts(make_chat(8))
+    assert earlier.load_chat(other_id) is None
+
+    with pytest.raises(FileExistsError):
+        replicator.restore(second['snapshot'], tmp_path / "latest")
+
+
+def test_unchanged_data_makes_no_snapshot(manager, replicator):
+    manager.save_chat(make_chat(3))
+    assert replicate(replicator)['snapshot']
+    assert replicate(replicator)['snapshot'] is None
+
+
+def test_deleted_and_cold_chats(manager, replicator, tmp_path):
+    kept_id = manager.save_chat(make_chat(3))
+    deleted_id = manager.save_chat(make_chat(3))
+    replicate(replicator)
+    manager.delete_chat(deleted_id)
+    report = replicate(replicator)
+    assert report['deleted'] == 1
+    target = restored(replicator, tmp_path, report['snapshot'], "deleted")
+    assert target.chat_ids() == [kept_id]
+
+    past = time.time() - 30 * 86400
+    path = manager._chat_path(kept_id)
+    os.utime(path, (past, past))
+    assert manager.compress_inactive()['chats'] == 1
+    report = replicate(replicator, full=True)
+    target = restored(replicator, tmp_path, report['snapshot'], "cold")
+    assert texts(target.load_chat(kept_id)) == texts(make_chat(3))
+
+
+def test_rewritten_leftover_bytes(manager, replicator, tmp_path):
+    chat_id = manager.save_chat(make_chat(4))
+    chat = manager.load_chat(chat_id)
+    # 中断的写入在记录文件末尾留下头部没有引用的残余
+    jsonl = next(manager._chat_dir(chat_id).glob(f"{HISTORY_PREFIX}*.jsonl"))
+    with open(jsonl, 'ab') as f:
+        f.write(b"x" * 100)
+    replicate(replicator)
+    # 下次追加截掉残余原地重写，文件没有变短
+    append_public_message(chat, '女巫', '🧙', "重写残余的消息" * 12 + "。", "12:01")
+    manager.save_chat(chat, chat_id)
+    report = replicate(replicator)
+    target = restored(replicator, tmp_path, report['snapshot'], "leftover")
+    assert texts(target.load_chat(chat_id)) == texts(manager.load_chat(chat_id))
+
+
+def test_failed_chat_keeps_cursor(manager, replicator, monkeypatch):
+    chat_id = manager.save_chat(make_chat(2))
+    replicate(replicator)
+    chat = manager.load_chat(chat_id)
+    append_public_message(chat, '女巫', '🧙', "复制失败的消息。", "12:01")
+    manager.save_chat(chat, chat_id)
+
+    def rewritten(chat_id, previous):
+        raise FileNotFoundError(chat_id)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(replicator, '_replicate_chat', rewritten)
+        report = replicate(replicator)
+    assert report['failed'] == [chat_id]
+    assert report['snapshot'] is None
+    # 日志位置没有前进，下次仍会复制这个聊天
+    report = replicate(replicator)
+    assert report['chats'] == 1 and not report['failed']
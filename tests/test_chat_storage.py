@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+
+from chat_storage import (CHAT_FILE, COLD_FILE, HISTORY_PREFIX, MAIN_BRANCH, append_public_message, ensure_stats,
+                          message_versions)
+from conftest import make_chat, texts
+
+
+def history_files(manager, chat_id):
+    return sorted(path.name for path in manager._chat_dir(chat_id).glob(f"{HISTORY_PREFIX}*"))
+
+
+# ================== 追加与重写 ==================
+def test_save_and_load_round_trip(manager):
+    chat_id = manager.save_chat(make_chat(5))
+    loaded = manager.load_chat(chat_id)
+    assert texts(loaded) == [f"第{i}条消息。" for i in range(5)]
+    assert loaded['history_offset'] == 0
+    assert loaded['history_saved'] == 5
+    assert 'chat_history' not in manager._read_header(chat_id)
+
+
+def test_append_keeps_history_file(manager):
+    chat_id = manager.save_chat(make_chat(3))
+    chat = manager.load_chat(chat_id)
+    files = history_files(manager, chat_id)
+    append_public_message(chat, '女巫', '🧙', "新的消息。", "12:01")
+    manager.save_chat(chat, chat_id)
+    assert history_files(manager, chat_id) == files
+    assert texts(manager.load_chat(chat_id))[-1] == "新的消息。"
+    assert manager.load_chat(chat_id)['history_saved'] == 4
+
+
+def test_edit_rewrites_history(manager):
+    chat_id = manager.save_chat(make_chat(3))
+    chat = manager.load_chat(chat_id)
+    files = history_files(manager, chat_id)
+    chat['chat_history'][1][2] = "改过的消息。"
+    chat.pop('history_saved')
+    manager.save_chat(chat, chat_id)
+    assert history_files(manager, chat_id) != files
+    assert len(history_files(manager, chat_id)) == 2
+    assert texts(manager.load_chat(chat_id)) == ["第0条消息。", "改过的消息。", "第2条消息。"]
+
+
+def test_append_discards_interrupted_write(manager):
+    chat_id = manager.save_chat(make_chat(2))
+    chat = manager.load_chat(chat_id)
+    jsonl = next(manager._chat_dir(chat_id).glob(f"{HISTORY_PREFIX}*.jsonl"))
+    with open(jsonl, 'ab') as f:
+        f.write(b'["\xe5\x8d\x8a')
+    append_public_message(chat, '女巫', '🧙', "之后的消息。", "12:01")
+    manager.save_chat(chat, chat_id)
+    assert texts(manager.load_chat(chat_id)) == ["第0条消息。", "第1条消息。", "之后的消息。"]
+
+
+def test_tail_load_and_load_earlier(manager):
+    chat_id = manager.save_chat(make_chat(10))
+    chat = manager.load_chat(chat_id, tail=3)
+    assert chat['history_offset'] == 7
+    assert texts(chat) == [f"第{i}条消息。" for i in range(7, 10)]
+    # 只加载了尾部，统计仍是整个分支的
+    assert ensure_stats(chat)['public'] == 10
+    assert manager.load_earlier(chat, 4) == 4
+    assert chat['history_offset'] == 3
+    assert texts(chat)[0] == "第3条消息。"
+    append_public_message(chat, '您', '👤', "尾部追加。", "12:01")
+    manager.save_chat(chat, chat_id)
+    assert texts(manager.load_chat(chat_id))[-2:] == ["第9条消息。", "尾部追加。"]
+
+
+def test_save_as_flattens_tail_loaded_chat(manager):
+    chat_id = manager.save_chat(make_chat(6))
+    chat = manager.load_chat(chat_id, tail=2)
+    copy_id = manager.save_chat(chat, "copy-of-chat")
+    assert copy_id == "copy-of-chat"
+    assert texts(manager.load_chat(copy_id)) == [f"第{i}条消息。" for i in range(6)]
+    assert len(texts(manager.load_chat(chat_id))) == 6
+
+
+# ================== 冷热分层 ==================
+def age(manager, chat_id, days=30):
+    path = manager._chat_path(chat_id)
+    past = time.time() - days * 86400
+    os.utime(path, (past, past))
+
+
+def test_compress_inactive_round_trip(manager):
+    chat_id = manager.save_chat(make_chat(4))
+    recent_id = manager.save_chat(make_chat(2))
+    age(manager, chat_id)
+    report = manager.compress_inactive()
+    assert report['chats'] == 1
+    chat_dir = manager._chat_dir(chat_id)
+    assert (chat_dir / COLD_FILE).exists()
+    assert not (chat_dir / CHAT_FILE).exists()
+    assert history_files(manager, chat_id) == []
+    assert manager._chat_path(recent_id).exists()
+
+    chat = manager.load_chat(chat_id, tail=2)
+    assert texts(chat) == ["第2条消息。", "第3条消息。"]
+    assert ensure_stats(chat)['public'] == 4
+    append_public_message(chat, '女巫', '🧙', "醒来了。", "12:01")
+    manager.save_chat(chat, chat_id)
+    assert not (chat_dir / COLD_FILE).exists()
+    assert texts(manager.load_chat(chat_id)) == [f"第{i}条消息。" for i in range(4)] + ["醒来了。"]
+
+
+def test_compress_waits_for_save(manager):
+    chat_id = manager.save_chat(make_chat(1))
+    chat = manager.load_chat(chat_id)
+    saves = threading.Event()
+
+    def keep_saving():
+        for i in range(50):
+            append_public_message(chat, '您', '👤', f"并发{i}。", "12:01")
+            manager.save_chat(chat, chat_id)
+        saves.set()
+
+    writer = threading.Thread(target=keep_saving, daemon=True)
+    writer.start()
+    while not saves.is_set():
+        with manager._chat_lock(chat_id):
+            if manager._chat_path(chat_id).exists():
+                age(manager, chat_id)
+        manager.compress_inactive()
+    writer.join()
+    assert len(texts(manager.load_chat(chat_id))) == 51
+
+
+# ================== 分支 ==================
+def test_branch_shares_prefix(manager):
+    chat_id = manager.save_chat(make_chat(6))
+    chat = manager.load_chat(chat_id)
+    name = manager.create_branch(chat, 3)
+    assert chat['branch'] == name
+    assert texts(chat) == [f"第{i}条消息。" for i in range(3)]
+    append_public_message(chat, '女巫', '🧙', "另一种走向。", "12:01")
+    manager.save_chat(chat, chat_id)
+
+    branch = manager.load_chat(chat_id)
+    assert branch['branch'] == name
+    assert texts(branch) == [f"第{i}条消息。" for i in range(3)] + ["另一种走向。"]
+    assert texts(manager.load_chat(chat_id, tail=2, branch=name)) == ["第2条消息。", "另一种走向。"]
+    main = manager.load_chat(chat_id, branch=MAIN_BRANCH)
+    assert texts(main) == [f"第{i}条消息。" for i in range(6)]
+    assert manager.create_branch(branch, 1, name=name) is None
+
+
+def test_branch_stats(manager):
+    chat_id = manager.save_chat(make_chat(6))
+    chat = manager.load_chat(chat_id, tail=2)
+    name = manager.create_branch(chat, 4)
+    # 只加载了尾部也按分叉点之前的全部消息统计
+    assert ensure_stats(chat)['public'] == 4
+    append_public_message(chat, '女巫', '🧙', "另一种走向。", "12:01")
+    manager.save_chat(chat, chat_id)
+    assert ensure_stats(manager.load_chat(chat_id, branch=name))['public'] == 5
+    main = manager.load_chat(chat_id, branch=MAIN_BRANCH)
+    assert ensure_stats(main)['public'] == 6
+    manager.create_branch(main, 6)
+    assert ensure_stats(main)['public'] == 6
+
+
+def test_branches_survive_cold_tier(manager):
+    chat_id = manager.save_chat(make_chat(4))
+    chat = manager.load_chat(chat_id)
+    name = manager.create_branch(chat, 2)
+    append_public_message(chat, '女巫', '🧙', "另一种走向。", "12:01")
+    manager.save_chat(chat, chat_id)
+    age(manager, chat_id)
+    assert manager.compress_inactive()['chats'] == 1
+    assert texts(manager.load_chat(chat_id, branch=name)) == ["第0条消息。", "第1条消息。", "另一种走向。"]
+    main = manager.load_chat(chat_id, branch=MAIN_BRANCH)
+    append_public_message(main, '您', '👤', "回到主线。", "12:02")
+    manager.save_chat(main, chat_id)
+    assert texts(manager.load_chat(chat_id, branch=name))[-1] == "另一种走向。"
+    assert texts(manager.load_chat(chat_id, branch=MAIN_BRANCH))[-1] == "回到主线。"
+
+
+# ================== 回复版本 ==================
+def test_versions_switch_without_rewriting_history(manager):
+    chat_id = manager.save_chat(make_chat(4))
+    chat = manager.load_chat(chat_id)
+    files = history_files(manager, chat_id)
+    assert manager.add_version(chat, 1, "第二个版本。") == 1
+    assert manager.add_version(chat, 1, "第1条消息。") == 0
+    assert manager.select_version(chat, 1, 1)
+    assert history_files(manager, chat_id) == files
+    assert texts(manager.load_chat(chat_id))[1] == "第二个版本。"
+    assert message_versions(manager.load_chat(chat_id), 1)['selected'] == 1
+
+
+def test_select_version_range(manager):
+    chat_id = manager.save_chat(make_chat(6))
+    chat = manager.load_chat(chat_id)
+    manager.add_version(chat, 0, "开场白的新版本。")
+    tail = manager.load_chat(chat_id, tail=2)
+    assert not manager.select_version(tail, 0, 5)
+    assert not manager.select_version(tail, 3, 0)
+    # 版本所在的消息还没加载时先补上更早的消息
+    assert manager.select_version(tail, 0, 0)
+    assert tail['history_offset'] == 0
+    assert texts(manager.load_chat(chat_id))[0] == "第0条消息。"
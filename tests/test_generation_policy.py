@@ -0,0 +1,135 @@
+from types import SimpleNamespace
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+import agent_engine
+import generation_policy as policy_module
+from generation_policy import (MAX_MAX_TOKENS, MIN_MAX_TOKENS, GenerationPolicy, stop_sequences,
+                               trim_to_sentence)
+from model_cassette import CassetteClient, request_key
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    monkeypatch.setattr(policy_module, 'DEFAULT_TARGET_LATENCY', 0.0)
+    return {'id': 'chat', 'user_role': '您', 'agents': {'女巫': {}, '侦探': {}}}
+
+
+def test_no_limit_by_default(chat):
+    limits = GenerationPolicy().limits(chat, '女巫')
+    assert 'max_tokens' not in limits
+    assert limits['stop'] == ["\n侦探：", "\n您："]
+
+
+def test_spent_deadline_is_a_hard_cap(chat):
+    policy = GenerationPolicy()
+    assert policy.limits(chat, '女巫', deadline=0)['max_tokens'] == MIN_MAX_TOKENS
+    chat['agents']['女巫']['target_latency'] = 30
+    assert policy.limits(chat, '女巫', deadline=0)['max_tokens'] == MIN_MAX_TOKENS
+
+
+def test_target_deadline_and_manual_cap(chat):
+    policy = GenerationPolicy()
+    # 没有实测数据时按默认的开销和速度：(10 * 0.85 - 1.5) * 25
+    assert policy.limits(chat, '女巫', deadline=10)['max_tokens'] == 175
+    chat['agents']['女巫']['target_latency'] = 4
+    assert policy.limits(chat, '女巫')['max_tokens'] == MIN_MAX_TOKENS
+    assert policy.limits(chat, '女巫', deadline=100)['max_tokens'] == MIN_MAX_TOKENS
+    chat['agents']['女巫'] = {'target_latency': 1000, 'max_tokens': 96}
+    assert policy.limits(chat, '女巫')['max_tokens'] == 96
+    chat['agents']['女巫'] = {'max_tokens': 96}
+    assert policy.limits(chat, '女巫')['max_tokens'] == 96
+
+
+def test_default_target_from_environment(chat, monkeypatch):
+    monkeypatch.setattr(policy_module, 'DEFAULT_TARGET_LATENCY', 1000.0)
+    assert GenerationPolicy().limits(chat, '女巫')['max_tokens'] == MAX_MAX_TOKENS
+    chat['agents']['女巫']['target_latency'] = 0
+    assert 'max_tokens' not in GenerationPolicy().limits(chat, '女巫')
+
+
+def test_estimate_fits_observations():
+    policy = GenerationPolicy()
+    for tokens, latency in [(50, 2.5), (100, 4.5), (200, 8.5)]:
+        policy.observe('chat', '女巫', latency, tokens)
+    policy.observe('chat', '女巫', 0, 10)
+    estimate = policy.estimate('chat', '女巫')
+    assert estimate['samples'] == 3
+    assert estimate['overhead'] == pytest.approx(0.5)
+    assert estimate['tokens_per_second'] == pytest.approx(25)
+    assert policy.max_tokens('chat', '女巫', 8) == 157
+    # 观测按聊天和角色分开
+    assert policy.estimate('chat', '侦探')['samples'] == 0
+
+
+def test_trim_and_stop_sequences():
+    assert trim_to_sentence("你好。我是女巫，今天") == "你好。"
+    assert trim_to_sentence("没有句号") == "没有句号"
+    chat = {'agents': {f"角色{i}": {} for i in range(20)}}
+    assert len(stop_sequences(chat, "角色0")) == policy_module.MAX_STOP_SEQUENCES
+
+
+def test_cassette_key_ignores_max_tokens():
+    request = {'model': 'deepseek-chat', 'messages': [{'role': 'user', 'content': '你好'}]}
+    assert request_key({**request, 'max_tokens': 64}) == request_key({**request, 'max_tokens': 900}) == request_key(request)
+    assert request_key({**request, 'model': 'other'}) != request_key(request)
+
+
+def test_cassette_key_ignores_length_hint():
+    def request(content):
+        return {'model': 'deepseek-chat', 'messages': [{'role': 'system', 'content': '设定'},
+                                                       {'role': 'user', 'content': content}]}
+
+    hinted = [request("请回应。" + policy_module.LENGTH_HINT.format(chars=chars)) for chars in (50, 810)]
+    assert request_key(hinted[0]) == request_key(hinted[1]) == request_key(request("请回应。"))
+    assert request_key(request("请回应！")) != request_key(request("请回应。"))
+
+
+class FakeClient:
+    """每次返回同一条补全的客户端"""
+
+    def __init__(self):
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.requests.append(kwargs)
+        return ChatCompletion.model_validate({
+            'id': 'fake', 'object': 'chat.completion', 'created': 0, 'model': kwargs['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': '好的。'}}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 20, 'total_tokens': 30},
+        })
+
+
+def test_only_replayed_calls_are_not_observed(monkeypatch, tmp_path):
+    policy = GenerationPolicy()
+    monkeypatch.setattr(agent_engine, 'generation_policy', policy)
+    request = {'model': 'deepseek-chat', 'messages': [{'role': 'user', 'content': '你好'}]}
+    agent_engine.create_completion(FakeClient(), {'id': 'chat'}, '女巫', **request)
+    assert policy.estimate('chat', '女巫')['samples'] == 1
+
+    client = FakeClient()
+    cassette = CassetteClient(client, str(tmp_path / "cassette.jsonl"), mode='auto', speed=0)
+    agent_engine.create_completion(cassette, {'id': 'chat'}, '侦探', max_tokens=64, **request)
+    # 录制时请求了真实接口，耗时照常计入
+    assert policy.estimate('chat', '侦探')['samples'] == 1
+    agent_engine.create_completion(cassette, {'id': 'chat'}, '侦探', max_tokens=900, **request)
+    # 第二次请求只是 max_tokens 不同，直接回放第一次的录制，不计入
+    assert len(client.requests) == 1
+    assert cassette.replayed
+    assert policy.estimate('chat', '侦探')['samples'] == 1
+
+
+def test_turn_budget_replays_from_cassette(chat, monkeypatch, tmp_path):
+    monkeypatch.setattr(agent_engine, 'generation_policy', GenerationPolicy())
+    chat['chat_history'] = [['您', '👤', '大家好。', '12:00']]
+    path = str(tmp_path / "cassette.jsonl")
+    recorder = FakeClient()
+    agent_engine.generate_agent_reply(CassetteClient(recorder, path, mode='record'), chat, '女巫',
+                                      "请回应。", deadline=12)
+    # 回放时回合剩下的时间不同，篇幅提示和 max_tokens 都变了，严格模式下仍能命中
+    replayer = CassetteClient(FakeClient(), path, mode='replay', speed=0, strict=True)
+    content = agent_engine.generate_agent_reply(replayer, chat, '女巫', "请回应。", deadline=3)
+    assert content == "好的。"
+    assert policy_module.LENGTH_HINT.format(chars=170) in recorder.requests[0]['messages'][-1]['content']
@@ -0,0 +1,63 @@
+from chat_storage import append_private_message, append_public_message
+from memory_index import ChatMemory, MemoryIndex, tokenize
+from conftest import make_chat
+
+
+def test_tokenize_cjk_bigrams():
+    assert tokenize("古老的咖啡馆") == ["古老", "老的", "的咖", "咖啡", "啡馆"]
+    assert tokenize("猫 and Dog 42") == ["猫", "and", "dog", "42"]
+    assert tokenize("Hi, 你好!") == ["hi", "你好"]
+
+
+def test_bm25_ranking():
+    index = MemoryIndex()
+    texts = [
+        "今天的天气很好，我们去散步吧。",
+        "我在古老的图书馆里找到了一本魔法书。",
+        "魔法书的封面上画着一只黑猫。",
+        "天气预报说明天会下雨。",
+    ]
+    for position, text in enumerate(texts):
+        index.add('女巫', text, position)
+    assert {position for _, _, position in index.search("那本魔法书在哪里", k=2)} == {1, 2}
+    # 两个词都命中的消息排在只命中一个的前面
+    assert index.search("图书馆的魔法书", k=4)[0][2] == 1
+    assert {position for _, _, position in index.search("天气", k=4)} == {0, 3}
+    assert index.search("完全无关的内容xyz") == []
+
+
+def test_before_and_private_visibility():
+    index = MemoryIndex()
+    index.add('您', "我们聊聊那只黑猫吧", 0)
+    index.add('您', "黑猫又出现了", 5)
+    index.add('您', "只告诉你：黑猫是我的", owner='女巫')
+    # before 之后的公共消息已经在请求窗口里，私聊只有所属角色能检索到
+    assert index.search("黑猫", k=5, before=3) == [('您', "我们聊聊那只黑猫吧", 0)]
+    found = index.search("黑猫", k=5, before=3, owner='女巫')
+    assert sorted(text for _, text, _ in found) == sorted(["我们聊聊那只黑猫吧", "只告诉你：黑猫是我的"])
+
+
+def test_chat_memory_reads_unloaded_messages(manager):
+    chat = make_chat(0)
+    for i in range(30):
+        append_public_message(chat, '您', '👤', f"第{i}件小事。", "12:00")
+    append_public_message(chat, '女巫', '🧙', "我把护身符藏在钟楼顶上了。", "12:00")
+    for i in range(30):
+        append_public_message(chat, '您', '👤', f"又一件小事{i}。", "12:00")
+    chat_id = manager.save_chat(chat)
+    tail = manager.load_chat(chat_id, tail=10)
+    append_private_message(tail, '女巫', '您', '👤', "钟楼的钥匙在我这里。", "12:01")
+
+    memory = ChatMemory(loader=manager.load_messages)
+    found = memory.search(tail, "护身符在钟楼吗", k=1, before=tail['history_offset'], agent_name='女巫')
+    assert found == [('女巫', "我把护身符藏在钟楼顶上了。", 30)]
+    assert "钟楼的钥匙在我这里。" in [text for _, text, _ in memory.search(tail, "钟楼钥匙", agent_name='女巫')]
+    assert "钟楼的钥匙在我这里。" not in [text for _, text, _ in memory.search(tail, "钟楼钥匙", agent_name='侦探')]
+
+    # 没有 loader 时只索引内存中的部分
+    assert ChatMemory().search(tail, "护身符在钟楼吗", before=tail['history_offset']) == []
+
+    # 消息内容变化后丢弃旧索引，重新检索时按新内容建索引
+    tail['chat_history'][-1][2] = "护身符其实在井底。"
+    memory.invalidate(chat_id)
+    assert memory.search(tail, "井底", k=1)[0][1] == "护身符其实在井底。"
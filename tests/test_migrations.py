@@ -0,0 +1,113 @@
+import gzip
+import json
+import os
+import time
+
+from chat_storage import CHAT_FILE, COLD_FILE, HISTORY_PREFIX, MAIN_BRANCH, SCHEMA_VERSION, ensure_stats, read_json
+from conftest import make_chat, texts
+
+
+def rewrite_header(manager, chat_id, update, days=30):
+    """把磁盘上的头部改成旧格式，修改时间设为 days 天前"""
+    path = manager._chat_path(chat_id)
+    header = read_json(path)
+    update(header)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(header, f, ensure_ascii=False)
+    past = time.time() - days * 86400
+    os.utime(path, (past, past))
+    return path
+
+
+def test_legacy_flat_file(manager):
+    legacy = manager.data_dir / "legacy-chat.json"
+    with open(legacy, 'w', encoding='utf-8') as f:
+        json.dump({
+            'title': '旧聊天',
+            'chat_history': [
+                {'speaker': '您', 'avatar': '👤', 'text': '你好。', 'time': '10:00'},
+                ['女巫', '🧙', '欢迎。'],
+            ],
+            'stats': {'public': 2},
+        }, f, ensure_ascii=False)
+
+    chat = manager.load_chat("legacy-chat")
+    assert chat['chat_history'] == [['您', '👤', '你好。', '10:00'], ['女巫', '🧙', '欢迎。', '']]
+    assert chat['user_role'] == '您' and chat['agents'] == {}
+    assert ensure_stats(chat)['public'] == 2
+    # 旧的平铺文件只在内存中升级
+    assert 'schema' not in read_json(legacy)
+
+    assert manager.migrate_legacy() == 1
+    assert not legacy.exists()
+    assert 'schema' not in read_json(manager._chat_path("legacy-chat"))
+    assert texts(manager.load_chat("legacy-chat")) == ['你好。', '欢迎。']
+    assert read_json(manager._chat_path("legacy-chat"))['schema'] == SCHEMA_VERSION
+
+
+def test_hot_header_written_back_once(manager):
+    chat_id = manager.save_chat(make_chat(4))
+
+    def to_schema_3(header):
+        header['schema'] = 3
+        header['stats'] = {'public': 99}
+        header.pop('private_stats', None)
+        for info in header['branches'].values():
+            info.pop('stats', None)
+
+    path = rewrite_header(manager, chat_id, to_schema_3)
+    mtime = path.stat().st_mtime
+    chat = manager.load_chat(chat_id, tail=1)
+    assert ensure_stats(chat)['public'] == 4
+
+    header = read_json(path)
+    assert header['schema'] == SCHEMA_VERSION
+    assert 'stats' not in header
+    assert header['branches'][MAIN_BRANCH]['stats']['public'] == 4
+    assert header['private_stats']['private'] == 0
+    # 升级不算一次写入，列表排序和冷热分层不受影响
+    assert path.stat().st_mtime == mtime
+
+
+def test_old_messages_in_history_file(manager):
+    chat_id = manager.save_chat(make_chat(2))
+    old_file = manager._write_history(chat_id, [['您', '👤', '旧消息。'], ['女巫', '🧙', '旧回复。', '10:00']])
+
+    def to_schema_2(header):
+        header['schema'] = 2
+        header['branches'][MAIN_BRANCH]['history_file'] = old_file
+
+    rewrite_header(manager, chat_id, to_schema_2)
+    chat = manager.load_chat(chat_id)
+    assert chat['chat_history'] == [['您', '👤', '旧消息。', ''], ['女巫', '🧙', '旧回复。', '10:00']]
+    history_file = read_json(manager._chat_path(chat_id))['branches'][MAIN_BRANCH]['history_file']
+    assert history_file != old_file
+    names = {path.stem for path in manager._chat_dir(chat_id).glob(f"{HISTORY_PREFIX}*")}
+    assert names == {history_file}
+
+
+def test_cold_chat_upgraded_in_memory(manager):
+    chat_id = manager.save_chat(make_chat(3))
+
+    def to_schema_1(header):
+        header['schema'] = 1
+        header.pop('scenario')
+
+    rewrite_header(manager, chat_id, to_schema_1)
+    assert manager.compress_inactive()['chats'] == 1
+    cold_path = manager._chat_dir(chat_id) / COLD_FILE
+    # 压缩前先升级头部，冷存储里是当前格式
+    with gzip.open(cold_path, 'rt', encoding='utf-8') as f:
+        cold = json.load(f)
+    assert cold['schema'] == SCHEMA_VERSION
+    assert cold['scenario'] == ''
+
+    cold['schema'] = 3
+    cold.pop('private_stats')
+    with gzip.open(cold_path, 'wt', encoding='utf-8') as f:
+        json.dump(cold, f, ensure_ascii=False)
+    chat = manager.load_chat(chat_id)
+    assert texts(chat) == ["第0条消息。", "第1条消息。", "第2条消息。"]
+    assert chat['private_stats']['private'] == 0
+    assert not (manager._chat_dir(chat_id) / CHAT_FILE).exists()
+    assert read_json(cold_path)['schema'] == 3
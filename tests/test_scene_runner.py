@@ -0,0 +1,79 @@
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import scene_runner
+from conftest import make_chat, texts
+
+
+class FailingClient:
+    """前 successes 次调用正常回复，之后抛出异常的客户端"""
+
+    def __init__(self, successes=0):
+        self.successes = successes
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        if self.successes <= 0:
+            raise ConnectionError("接口不可用")
+        self.successes -= 1
+        choice = SimpleNamespace(message=SimpleNamespace(content="好的。"), finish_reason="stop")
+        return SimpleNamespace(choices=[choice], usage=None)
+
+
+class ThreadPool(ThreadPoolExecutor):
+    """在本进程里代替进程池，不运行工作进程的初始化"""
+
+    def __init__(self, max_workers, mp_context=None, initializer=None, initargs=()):
+        super().__init__(max_workers=max_workers)
+
+
+def test_scene_errors_are_reported(manager, monkeypatch):
+    chat = make_chat(2)
+    chat['agents'] = {'女巫': {'avatar': '🧙'}}
+    chat_id = manager.save_chat(chat)
+    monkeypatch.setitem(scene_runner._worker, 'chat_manager', manager)
+    monkeypatch.setitem(scene_runner._worker, 'clients', {'fake': FailingClient(successes=1)})
+    summary = scene_runner.run_scene(chat_id, 'fake', rounds=2)
+    assert summary['error'] == "接口不可用"
+    assert summary['messages'] == 1
+    assert texts(manager.load_chat(chat_id))[-1] == "好的。"
+
+    def broken(*args, **kwargs):
+        raise OSError("磁盘已满")
+
+    # 每轮的保存失败，补存未完成的一轮也失败：只记进摘要，不抛出
+    monkeypatch.setitem(scene_runner._worker, 'clients', {'fake': FailingClient(successes=1)})
+    monkeypatch.setattr(manager, 'save_chat', broken)
+    summary = scene_runner.run_scene(chat_id, 'fake', rounds=2)
+    assert summary['error'] == "磁盘已满；保存未完成的一轮失败：磁盘已满"
+
+    monkeypatch.setattr(manager, 'load_chat', broken)
+    summary = scene_runner.run_scene(chat_id, 'fake', rounds=1)
+    assert summary['error'] == "读取场景失败：磁盘已满"
+
+
+def test_batch_continues_after_a_crashed_scene(manager, monkeypatch, tmp_path, capsys):
+    chat_ids = [manager.save_chat(make_chat(1)) for _ in range(3)]
+
+    def run_scene(chat_id, endpoint, rounds, *args):
+        if chat_id == chat_ids[1]:
+            raise RuntimeError("工作进程退出")
+        return {**scene_runner.scene_summary(chat_id, endpoint), 'messages': rounds}
+
+    output = tmp_path / "results.jsonl"
+    monkeypatch.setattr(scene_runner, 'ProcessPoolExecutor', ThreadPool)
+    monkeypatch.setattr(scene_runner, 'run_scene', run_scene)
+    monkeypatch.setattr(sys, 'argv', ['scene_runner.py', '--data-dir', str(manager.data_dir), '--chats', *chat_ids,
+                                      '--rounds', '2', '--endpoint', 'fake', '--output', str(output)])
+    assert scene_runner.main() == 1
+
+    results = {r['id']: r for r in map(json.loads, output.read_text(encoding='utf-8').splitlines())}
+    assert set(results) == set(chat_ids)
+    assert results[chat_ids[1]]['error'] == "RuntimeError: 工作进程退出"
+    assert results[chat_ids[1]]['endpoint'] == 'fake'
+    assert results[chat_ids[0]]['messages'] == 2 and results[chat_ids[2]]['error'] is None
+    assert "失败 1 个" in capsys.readouterr().out
+    # 场景本身没有被改动
+    assert texts(manager.load_chat(chat_ids[0])) == ["第0条消息。"]
@@ -0,0 +1,79 @@
+import time
+from types import SimpleNamespace
+
+import openai
+import pytest
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+import agent_engine
+from conftest import ROOT
+
+APP = str(ROOT / "ultimate_chat_manager.py")
+
+
+class FakeOpenAI:
+    """不联网的客户端，回复用户消息的开头"""
+
+    def __init__(self, *args, **kwargs):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, **kwargs):
+        content = "好的。" + messages[-1]['content'][:10]
+        usage = SimpleNamespace(prompt_tokens=100, completion_tokens=20, total_tokens=120)
+        if kwargs.get('stream'):
+            delta = SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason="stop")
+            return iter([SimpleNamespace(choices=[delta], usage=usage)])
+        choice = SimpleNamespace(message=SimpleNamespace(content=content), finish_reason="stop")
+        return SimpleNamespace(choices=[choice], usage=usage)
+
+
+class RecordingCache(agent_engine.SpeculativeCache):
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        RecordingCache.instances.append(self)
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(openai, 'OpenAI', FakeOpenAI)
+    monkeypatch.setattr(agent_engine, 'SpeculativeCache', RecordingCache)
+    RecordingCache.instances.clear()
+    st.cache_resource.clear()
+    at = AppTest.from_file(APP, default_timeout=30)
+    at.run()
+    next(w for w in at.text_area if w.label.startswith("详细描述场景")).input("雨夜咖啡馆")
+    next(w for w in at.text_input if w.label.startswith("批量添加角色")).input("女巫, 侦探")
+    at.button(key="quick_add").click().run()
+    at.button(key="start_roleplay").click().run()
+    assert not at.exception, at.exception
+    yield at
+    st.cache_resource.clear()
+
+
+def wait_for_generations(at):
+    for _ in range(100):
+        if not [b for b in at.button if b.key and b.key.startswith('cancel_gen_')]:
+            return
+        time.sleep(0.05)
+        at.run()
+    raise AssertionError("后台生成没有完成")
+
+
+def test_prefetch_survives_apply_generation(app):
+    app.toggle(key="speculative_prefetch").set_value(True).run()
+    app.button(key="ai_interact_btn").click().run()
+    assert not app.exception, app.exception
+    wait_for_generations(app)
+
+    chat = app.session_state.current_chat
+    assert chat['chat_history'][-1][2].startswith("好的。")
+    cache = RecordingCache.instances[-1]
+    # 回复写入当前聊天后按新记录发起的预取没有被丢弃
+    entry = cache._entries.get(chat['id'])
+    assert entry is not None
+    assert not entry['future'].cancelled()
+    assert entry['fingerprint'] == agent_engine.history_fingerprint(chat)
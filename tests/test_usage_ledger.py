@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+import pytest
+
+import agent_engine
+from usage_ledger import DEGRADED_MESSAGES, LEDGER_NAME, BudgetExceeded, UsageLedger, call_cost
+
+
+def usage(prompt=0, hit=0, completion=0):
+    return SimpleNamespace(prompt_tokens=prompt, prompt_cache_hit_tokens=hit,
+                           prompt_cache_miss_tokens=prompt - hit, completion_tokens=completion)
+
+
+@pytest.fixture
+def ledger(manager):
+    return UsageLedger(manager.data_dir / LEDGER_NAME)
+
+
+def test_totals_and_cache_pricing(ledger):
+    ledger.record('a', '女巫', 'deepseek-chat', usage(prompt=1_000_000, hit=1_000_000))
+    ledger.record('a', '侦探', 'deepseek-chat', usage(prompt=1_000_000, completion=1_000_000))
+    ledger.record('b', '女巫', 'deepseek-reasoner', usage(completion=1000))
+    assert ledger.chat_totals('a')['calls'] == 2
+    assert ledger.chat_totals('a')['cost'] == pytest.approx(0.07 + 0.27 + 1.10)
+    assert ledger.agent_totals('a')['女巫']['cache_hit_tokens'] == 1_000_000
+    assert ledger.day_totals()['calls'] == 3
+    assert call_cost('unknown', 0, 0, 1_000_000) == call_cost('deepseek-chat', 0, 0, 1_000_000)
+
+
+def test_refuse_and_degrade_at_budget(ledger):
+    assert ledger.check('a') == 'ok'
+    ledger.set_budgets(chat_budget=1.0)
+    ledger.record('a', '女巫', 'deepseek-chat', usage(completion=700_000))
+    assert ledger.check('a') == 'ok'
+    ledger.record('a', '女巫', 'deepseek-chat', usage(completion=100_000))
+    assert ledger.check('a') == 'degrade'
+    ledger.record('a', '女巫', 'deepseek-chat', usage(completion=200_000))
+    assert ledger.check('a') == 'refuse'
+    assert ledger.check('b') == 'ok'
+    # 每日预算把所有聊天的花费加在一起
+    ledger.set_budgets(chat_budget=0, daily_budget=2.0)
+    assert ledger.check('b') == 'ok'
+    ledger.record('b', '女巫', 'deepseek-chat', usage(completion=800_000))
+    assert ledger.check('b') == 'degrade'
+
+
+def test_budgets_shared_through_the_ledger(manager, ledger):
+    other = UsageLedger(manager.data_dir / LEDGER_NAME, chat_budget=5.0)
+    assert other.chat_budget == 5.0
+    ledger.set_budgets(chat_budget=0.5)
+    ledger.record('a', '女巫', 'deepseek-chat', usage(completion=500_000))
+    assert other.check('a') == 'refuse'
+    assert other.chat_budget == 0.5
+    other.set_budgets(daily_budget=3.0)
+    assert ledger.budget_ratio('a') == pytest.approx(0.55 / 0.5)
+    assert UsageLedger(manager.data_dir / LEDGER_NAME).daily_budget == 3.0
+
+
+class CountingClient:
+    def __init__(self):
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.requests.append(kwargs)
+        choice = SimpleNamespace(message=SimpleNamespace(content="好的。"), finish_reason="stop")
+        return SimpleNamespace(choices=[choice], usage=usage(prompt=100, completion=10))
+
+
+def test_create_completion_enforces_budget(ledger, monkeypatch):
+    monkeypatch.setattr(agent_engine, 'usage_ledger', ledger)
+    monkeypatch.setattr(agent_engine, 'BUDGET_FALLBACK_MODEL', None)
+    client = CountingClient()
+    messages = [{'role': 'system', 'content': '设定'}] + [{'role': 'user', 'content': str(i)} for i in range(30)]
+    ledger.set_budgets(chat_budget=1.0)
+    ledger.record('a', '女巫', 'deepseek-chat', usage(completion=850_000))
+
+    agent_engine.create_completion(client, {'id': 'a'}, '女巫', model='deepseek-chat', messages=messages)
+    request = client.requests[-1]
+    # 降级只缩短上下文，没有配置备用模型时不换模型
+    assert request['model'] == 'deepseek-chat'
+    assert request['messages'] == messages[:1] + messages[-DEGRADED_MESSAGES:]
+
+    monkeypatch.setattr(agent_engine, 'BUDGET_FALLBACK_MODEL', 'cheap-model')
+    agent_engine.create_completion(client, {'id': 'a'}, '女巫', model='deepseek-chat', messages=messages)
+    assert client.requests[-1]['model'] == 'cheap-model'
+
+    ledger.record('a', '女巫', 'deepseek-chat', usage(completion=200_000))
+    with pytest.raises(BudgetExceeded):
+        agent_engine.create_completion(client, {'id': 'a'}, '女巫', model='deepseek-chat', messages=messages)
+    assert len(client.requests) == 2
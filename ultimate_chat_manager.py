@@ -1,12 +1,62 @@
 import streamlit as st
+import functools
 import os
-import json
+from contextlib import nullcontext
+import time
 import uuid
 from datetime import datetime
-from pathlib import Path
 from openai import OpenAI
 from dotenv import load_dotenv
 
+from agent_engine import (
+    DEFAULT_MAX_RESPONDERS,
+    HISTORY_STEP,
+    HISTORY_WINDOW,
+    GenerationWorker,
+    SpeculativeCache,
+    call_log,
+    chat_snapshot,
+    generate_agent_turn,
+    generate_introductions,
+    generate_responses,
+    next_speaker,
+    regenerate_reply,
+    route_responders,
+)
+from chat_replication import LocalStore, Replicator
+from chat_storage import (
+    ChatManager,
+    append_public_message,
+    ensure_stats,
+    message_versions,
+    new_stats,
+)
+from generation_policy import DEFAULT_TARGET_LATENCY, DEFAULT_TURN_BUDGET, MAX_MAX_TOKENS, generation_policy
+from memory_index import chat_memory
+from model_cassette import cassette_from_env
+from script_profiler import ScriptProfiler, profiling_enabled
+from template_library import TemplateLibrary
+from usage_ledger import BUDGET_FALLBACK_MODEL, LEDGER_NAME, usage_ledger
+
+# 整页重跑的起始时间，用于和片段局部重跑对比耗时
+_page_started = time.perf_counter()
+
+# 剖析模式下逐段记录本次重跑的耗时，点了“捕获 cProfile”的那次重跑同时开启 cProfile
+profiler = ScriptProfiler() if profiling_enabled(st.query_params) else None
+if profiler is not None and st.session_state.pop('cprofile_next', False):
+    profiler.start_cprofile()
+
+def profile_mark(name):
+    """剖析模式下开始一个新的顶层段落"""
+    if profiler is not None:
+        profiler.mark(name)
+
+def profile_section(name):
+    """剖析模式下记录一个嵌套段落"""
+    return profiler.section(name) if profiler is not None else nullcontext()
+
+profile_mark("页面配置与样式")
+
 # ================== 高级样式和配置 ==================
 st.set_page_config(
     page_title="🎭 AI角色扮演聊天室 | 沉浸式多角色体验",
@@ -774,17 +824,52 @@ def load_advanced_css():
 # 应用高级CSS
 load_advanced_css()
 
+profile_mark("客户端与资源")
+
 load_dotenv()
 
 @st.cache_resource
 def get_ai_client():
-    return OpenAI(
+    # 设置了 MODEL_CASSETTE 时录制或回放模型调用
+    return cassette_from_env(OpenAI(
         api_key=os.getenv("DEEPSEEK_API_KEY"),
-        base_url="https://api.deepseek.com"
-    )
+        base_url=os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+    ))
 
 client = get_ai_client()
 
+@st.cache_resource
+def get_chat_manager():
+    chat_manager = ChatManager()
+    chat_manager.start_migration()
+    chat_manager.start_tiering()
+    # 检索记忆通过它读取没有加载进内存的早期消息
+    chat_memory.loader = chat_manager.load_messages
+    # 用量账本和聊天数据放在同一目录
+    usage_ledger.open(chat_manager.data_dir / LEDGER_NAME)
+    return chat_manager
+
+@st.cache_resource
+def get_replicator():
+    """设置了 REPLICA_DIR 时把变化的聊天定期增量复制到副本目录，没有设置时返回 None"""
+    if not os.getenv("REPLICA_DIR"):
+        return None
+    replicator = Replicator(get_chat_manager(), LocalStore(os.getenv("REPLICA_DIR")))
+    replicator.start(interval=float(os.getenv("REPLICA_INTERVAL", "30")))
+    return replicator
+
+@st.cache_resource
+def get_speculative_cache():
+    return SpeculativeCache()
+
+@st.cache_resource
+def get_template_library():
+    return TemplateLibrary()
+
+@st.cache_resource
+def get_generation_worker():
+    return GenerationWorker()
+
 # ================== 高级动画组件 ==================
 def animated_header():
     """高级动画标题"""
@@ -852,73 +937,7 @@ def role_card_display(role_name, avatar, status="在线"):
     </div>
     """
 
-# ================== 聊天管理实用工具（保持不变） ==================
-class ChatManager:
-    def __init__(self, data_dir="chat_data"):
-        self.data_dir = Path(data_dir)
-        self.data_dir.mkdir(exist_ok=True)
-    
-    def get_all_chats(self):
-        """返回所有保存的聊天"""
-        chats = []
-        for file in self.data_dir.glob("*.json"):
-            try:
-                with open(file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    data['id'] = file.stem
-                    data['filename'] = file.name
-                    data['modified'] = datetime.fromtimestamp(file.stat().st_mtime)
-                    chats.append(data)
-            except:
-                continue
-        
-        chats.sort(key=lambda x: x['modified'], reverse=True)
-        return chats
-    
-    def save_chat(self, chat_data, chat_id=None):
-        """保存聊天"""
-        if chat_id is None:
-            chat_id = str(uuid.uuid4())
-        
-        chat_data['id'] = chat_id
-        chat_data['modified'] = datetime.now().isoformat()
-        
-        filepath = self.data_dir / f"{chat_id}.json"
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(chat_data, f, ensure_ascii=False, indent=2)
-        
-        return chat_id
-    
-    def load_chat(self, chat_id):
-        """根据ID加载聊天"""
-        filepath = self.data_dir / f"{chat_id}.json"
-        if filepath.exists():
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return None
-    
-    def delete_chat(self, chat_id):
-        """删除聊天"""
-        filepath = self.data_dir / f"{chat_id}.json"
-        if filepath.exists():
-            filepath.unlink()
-            return True
-        return False
-    
-    def rename_chat(self, chat_id, new_title):
-        """重命名聊天"""
-        data = self.load_chat(chat_id)
-        if data:
-            data['title'] = new_title
-            self.save_chat(data, chat_id)
-            return True
-        return False
-
 # ================== 主要功能（保持不变） ==================
-def generate_agent_prompt(context, agent_name, avatar, other_agents, user_role="用户"):
-    """为代理创建系统提示"""
-    pass
-
 def create_new_chat():
     """创建新聊天"""
     chat_id = str(uuid.uuid4())
@@ -930,19 +949,490 @@ def create_new_chat():
         'agents': {},
         'chat_history': [],
         'private_history': {},
+        'branch_stats': new_stats(),
+        'private_stats': new_stats(),
         'created': datetime.now().isoformat(),
         'modified': datetime.now().isoformat()
     }
     st.session_state.editing_chat = True
 
+# ================== 局部刷新片段 ==================
+# 片段内的交互只重跑片段本身，不会重新执行CSS注入、侧边栏和整段聊天记录
+
+# 聊天记录每次向前加载的条数
+HISTORY_PAGE_SIZE = 50
+
+# 打开聊天时从磁盘解码的最近消息条数，要覆盖首屏和模型请求的历史窗口
+LOAD_TAIL = max(HISTORY_PAGE_SIZE, HISTORY_WINDOW + HISTORY_STEP)
+
+def record_timing(scope, started):
+    """记录一次重跑的耗时，只保留最近20条"""
+    timings = st.session_state.setdefault('interaction_timings', [])
+    timings.append({
+        '范围': scope,
+        '耗时(ms)': round((time.perf_counter() - started) * 1000, 1),
+        '时间': datetime.now().strftime('%H:%M:%S'),
+    })
+    del timings[:-20]
+
+def timed_fragment(name, run_every=None):
+    """把函数包装成 st.fragment，并记录每次执行的耗时"""
+    def decorator(fn):
+        @st.fragment(run_every=run_every)
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            # 片段单独重跑时整页的剖析已经结束，为这次重跑另记一份追踪
+            rerun_profiler = ScriptProfiler() if profiler is not None and not profiler.active else None
+            section = rerun_profiler.section if rerun_profiler is not None else profile_section
+            try:
+                with section(f"片段·{name}"):
+                    return fn(*args, **kwargs)
+            finally:
+                record_timing(f"片段·{name}", started)
+                if rerun_profiler is not None:
+                    rerun_profiler.finish()
+                    rerun_profiler.write_trace(prefix="fragment")
+        return wrapper
+    return decorator
+
+def render_generation_settings(role, data):
+    """角色的生成策略：目标发言时长、输出上限，以及实测的延迟和速度"""
+    data['target_latency'] = st.number_input(
+        "目标发言时长（秒）:",
+        min_value=0.0,
+        max_value=120.0,
+        value=float(data.get('target_latency', DEFAULT_TARGET_LATENCY)),
+        step=1.0,
+        key=f"target_latency_{role}",
+        help="按实测的输出速度限制回复长度，让发言在这个时间内完成；0 表示不限"
+    )
+    data['max_tokens'] = st.number_input(
+        "最长输出 token:",
+        min_value=0,
+        max_value=MAX_MAX_TOKENS,
+        value=int(data.get('max_tokens', 0)),
+        step=32,
+        key=f"max_tokens_{role}",
+        help="手动设置的输出上限，和按时长算出的上限取较小的一个；0 表示自动"
+    )
+    chat_id = st.session_state.current_chat.get('id')
+    estimate = generation_policy.estimate(chat_id, role)
+    limit = generation_policy.limits(st.session_state.current_chat, role).get('max_tokens')
+    if estimate['samples']:
+        st.caption(f"实测 {estimate['samples']} 次：平均 {estimate['latency']:.1f}s，"
+                   f"约 {estimate['tokens_per_second']:.0f} token/s，"
+                   f"固定开销 {estimate['overhead']:.1f}s")
+    else:
+        st.caption("还没有实测数据，按默认速度估算")
+    st.caption(f"当前输出上限：{limit} token" if limit else "当前输出上限：不限")
+
+@timed_fragment("角色编辑")
+def render_agent_editor():
+    """已添加角色的网格，修改头像和个性时只重跑这一块"""
+    agents = st.session_state.current_chat['agents']
+    if agents:
+        st.markdown(f'<h4 style="color: #ffffff; margin-top: 2rem;">已添加角色 ({len(agents)})</h4>', unsafe_allow_html=True)
+        
+        # 使用网格展示角色
+        cols_per_row = min(4, len(agents))
+        roles_list = list(agents.keys())
+        
+        rows = (len(roles_list) + cols_per_row - 1) // cols_per_row
+        for row in range(rows):
+            cols = st.columns(cols_per_row)
+            for col_idx in range(cols_per_row):
+                idx = row * cols_per_row + col_idx
+                if idx < len(roles_list):
+                    role = roles_list[idx]
+                    
+                    with cols[col_idx]:
+                        # 角色卡片
+                        st.markdown(role_card_display(role, agents[role]['avatar']), unsafe_allow_html=True)
+                        
+                        # 角色设置
+                        with st.expander("角色设置", expanded=False):
+                            # 头像选择
+                            avatar_options = ["👤", "🧙", "👑", "🦸", "🧚", "🤖", "👽", "🧝"]
+                            selected_avatar = st.selectbox(
+                                "选择头像:",
+                                options=avatar_options,
+                                index=avatar_options.index(agents[role]['avatar']) if agents[role]['avatar'] in avatar_options else 0,
+                                key=f"avatar_{role}"
+                            )
+                            agents[role]['avatar'] = selected_avatar
+                            
+                            # 个性描述
+                            personality = st.text_area(
+                                "角色个性:",
+                                value=agents[role].get('personality', ''),
+                                placeholder="描述角色的性格特点、说话风格等",
+                                key=f"personality_{role}",
+                                height=100
+                            )
+                            agents[role]['personality'] = personality
+                            
+                            render_generation_settings(role, agents[role])
+                        
+                        # 删除按钮
+                        if st.button("移除", key=f"remove_{role}", use_container_width=True):
+                            del agents[role]
+                            st.rerun()
+
+@timed_fragment("分支")
+def render_branches():
+    """分支切换，以及从任意位置分叉出新分支"""
+    chat = st.session_state.current_chat
+    branches = chat.get('branches')
+    if not branches:
+        return
+    
+    total = chat.get('history_offset', 0) + len(chat.get('chat_history', []))
+    with st.expander(f"🌿 分支：{chat['branch']}", expanded=False):
+        col_switch, col_fork = st.columns(2)
+        
+        with col_switch:
+            names = list(branches)
+            target = st.selectbox(
+                "切换到分支:",
+                options=names,
+                index=names.index(chat['branch']),
+                key="branch_select"
+            )
+            st.caption(f"共 {branches[target]['history_count']} 条消息")
+            if st.button("🔀 切换", use_container_width=True, key="switch_branch", disabled=target == chat['branch']):
+                chat_manager = st.session_state.chat_manager
+                chat_manager.save_chat(chat, chat['id'])
+                st.session_state.current_chat = chat_manager.load_chat(chat['id'], tail=LOAD_TAIL, branch=target)
+                st.session_state.history_limit = HISTORY_PAGE_SIZE
+                get_speculative_cache().discard(chat['id'])
+                st.rerun()
+        
+        with col_fork:
+            fork_at = st.number_input("保留前几条消息:", min_value=0, max_value=total, value=total)
+            branch_name = st.text_input("新分支名称:", placeholder="留空自动命名", key="branch_name")
+            if st.button("🌿 创建分支", use_container_width=True, key="create_branch"):
+                # 新分支共享前 fork_at 条消息，只保存之后的新消息
+                if st.session_state.chat_manager.create_branch(chat, int(fork_at), branch_name.strip() or None) is None:
+                    st.warning(f"🌿 分支「{branch_name.strip()}」已存在")
+                else:
+                    get_speculative_cache().discard(chat['id'])
+                    st.rerun()
+
+@timed_fragment("聊天记录")
+def render_history(user_role):
+    """公共聊天记录，只渲染最近的若干条，需要时再向前加载"""
+    chat = st.session_state.current_chat
+    chat_history = chat.get('chat_history', [])
+    
+    if chat_history:
+        limit = st.session_state.history_limit
+        earlier = chat.get('history_offset', 0) + len(chat_history) - limit
+        if earlier > 0:
+            if st.button(f"⬆️ 显示更早的消息 ({earlier})", use_container_width=True, key="load_earlier"):
+                st.session_state.history_limit += HISTORY_PAGE_SIZE
+                # 还没解码的更早消息到这时才从磁盘读取
+                missing = st.session_state.history_limit - len(chat_history)
+                if missing > 0:
+                    st.session_state.chat_manager.load_earlier(chat, missing)
+                st.rerun(scope="fragment")
+        
+        visible = chat_history[-limit:]
+        first = chat.get('history_offset', 0) + len(chat_history) - len(visible)
+        for index, (agent, avatar, message, timestamp) in enumerate(visible, start=first):
+            is_user = (agent == user_role)
+            
+            # 显示聊天消息
+            st.markdown(chat_message_display(agent, avatar, message, timestamp, is_user), unsafe_allow_html=True)
+            if not is_user and agent in chat.get('agents', {}) and chat.get('branches'):
+                render_version_controls(chat, index, agent)
+    else:
+        st.markdown("""
+        <div style="text-align: center; padding: 3rem; color: rgba(255,255,255,0.7);">
+            <div style="font-size: 4rem; margin-bottom: 1rem;">💭</div>
+            <h3>对话尚未开始</h3>
+            <p>点击下方的"开始介绍"按钮，让AI角色向你问好吧！</p>
+        </div>
+        """, unsafe_allow_html=True)
+
+def switch_version(chat, index, version):
+    """切换回复版本，检索索引里还是旧的文本，一并丢弃"""
+    if st.session_state.chat_manager.select_version(chat, index, version):
+        chat_memory.invalidate(chat['id'])
+
+def render_version_controls(chat, index, agent):
+    """角色消息下方的重新生成按钮和版本切换"""
+    pending = generation_pending(('regen', chat['branch'], index))
+    versions = message_versions(chat, index)
+    cols = st.columns([1, 1, 1, 9])
+    
+    with cols[0]:
+        if st.button("🔄", key=f"regen_{index}", help="重新生成这条回复", disabled=pending):
+            # 后台生成新版本，当前版本保持显示
+            submit_generation(('regen', chat['branch'], index), f"重新生成 {agent}", regenerate_job,
+                              chat_snapshot(chat, index), agent, context={'index': index})
+            st.rerun()
+    
+    if versions:
+        selected = versions['selected']
+        with cols[1]:
+            if st.button("◀", key=f"prev_version_{index}", disabled=selected == 0):
+                switch_version(chat, index, selected - 1)
+                st.rerun()
+        with cols[2]:
+            if st.button("▶", key=f"next_version_{index}", disabled=selected == len(versions['versions']) - 1):
+                switch_version(chat, index, selected + 1)
+                st.rerun()
+        with cols[3]:
+            st.caption(f"版本 {selected + 1}/{len(versions['versions'])}" + (" · 正在重新生成..." if pending else ""))
+    elif pending:
+        with cols[3]:
+            st.caption("正在重新生成...")
+
+# ---------- 后台生成 ----------
+# 模型请求交给 GenerationWorker 执行，按钮只提交任务，之后任何重跑都不会打断或重复请求
+
+def intro_job(snapshot, batch, cancel_event=None):
+    return generate_introductions(client, snapshot, batch=batch, cancel_event=cancel_event)
+
+def turn_job(snapshot, agent_name, speculative, cancel_event=None):
+    content = get_speculative_cache().take(snapshot, agent_name) if speculative else None
+    if content is None and not cancel_event.is_set():
+        content = generate_agent_turn(client, snapshot, agent_name)
+    return [(agent_name, content)]
+
+def reply_job(snapshot, agent_names, turn_budget, cancel_event=None):
+    return generate_responses(client, snapshot, agent_names, cancel_event=cancel_event, turn_budget=turn_budget)
+
+def regenerate_job(snapshot, agent_name, cancel_event=None):
+    return regenerate_reply(client, snapshot, agent_name)
+
+def submit_generation(key, label, fn, *args, context=None):
+    """为当前聊天提交一个后台生成任务"""
+    chat = st.session_state.current_chat
+    context = dict(context or {}, branch=chat.get('branch'))
+    return get_generation_worker().submit(
+        st.session_state.session_token, chat.get('id'), key, label, fn, *args, context=context
+    )
+
+def generation_pending(key=None):
+    """当前聊天是否有进行中的任务，指定 key 时只看这一种"""
+    jobs = get_generation_worker().pending(st.session_state.session_token, st.session_state.current_chat.get('id'))
+    return any(key is None or job['key'] == key for job in jobs)
+
+def apply_generation(job, result):
+    """把完成的任务结果写入所属的聊天"""
+    chat_manager = st.session_state.chat_manager
+    current = st.session_state.current_chat
+    context = job['context']
+    # 结果写入前丢弃这个聊天按旧记录预生成的发言，写入当前聊天后再按新记录预取
+    get_speculative_cache().discard(job['chat_id'])
+    if current.get('id') == job['chat_id'] and current.get('branch') == context.get('branch'):
+        chat = current
+    else:
+        # 任务完成前切换了场景或分支，结果写回原来的聊天
+        chat = chat_manager.load_chat(job['chat_id'], tail=LOAD_TAIL, branch=context.get('branch'))
+        if chat is None:
+            return
+    
+    if job['key'][0] == 'regen':
+        if result:
+            chat_manager.add_version(chat, context['index'], result)
+            chat_memory.invalidate(chat['id'])
+    else:
+        for agent_name, content in result:
+            if content:
+                avatar = chat['agents'].get(agent_name, {}).get('avatar', '👤')
+                append_public_message(chat, agent_name, avatar, content)
+        if chat is not current:
+            chat_manager.save_chat(chat, chat['id'])
+        elif st.session_state.get('speculative_prefetch'):
+            get_speculative_cache().prefetch(client, chat)
+
+@timed_fragment("后台生成", run_every=1)
+def poll_generations():
+    """每秒检查一次后台任务，显示进度和取消按钮，有结果时整页刷新"""
+    worker = get_generation_worker()
+    finished = worker.collect(st.session_state.session_token)
+    for job, result, error in finished:
+        if error is not None:
+            st.toast(f"❌ {job['label']}失败：{error}")
+        else:
+            apply_generation(job, result)
+    
+    pending = worker.pending(st.session_state.session_token)
+    for job in pending:
+        col_label, col_cancel = st.columns([5, 1])
+        with col_label:
+            elapsed = time.monotonic() - job['created']
+            st.caption(f"⏳ {job['label']} 进行中... {elapsed:.0f}s")
+        with col_cancel:
+            if st.button("⏹️ 取消", key=f"cancel_gen_{job['id']}", use_container_width=True):
+                worker.cancel(job['id'])
+                st.rerun()
+    if finished or not pending:
+        st.rerun()
+
+@timed_fragment("消息输入")
+def render_composer(user_role):
+    """消息输入区，输入时只重跑这一块"""
+    # 聊天输入区域
+    st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
+    st.markdown('<h4 style="color: #ffffff; margin-bottom: 1rem;">🎤 发送消息</h4>', unsafe_allow_html=True)
+    
+    col_input, col_send = st.columns([4, 1])
+    
+    with col_input:
+        user_input = st.text_area(
+            "输入消息给所有AI角色:",
+            height=120,
+            placeholder=f"作为{user_role}，你想对大家说什么？用 @角色名 指定谁来回应",
+            key="public_input",
+            label_visibility="collapsed"
+        )
+    
+    with col_send:
+        st.write(" ")
+        if st.button("🚀 发送", type="primary", use_container_width=True, key="send_public"):
+            if user_input:
+                chat = st.session_state.current_chat
+                append_public_message(chat, user_role, "👤", user_input)
+                get_speculative_cache().discard(chat.get('id'))
+                if st.session_state.get('auto_reply', True):
+                    # 只让被提到或相关的角色回应，大场景里不必每个角色都请求一次
+                    responders = route_responders(
+                        chat,
+                        user_input,
+                        st.session_state.get('max_responders', DEFAULT_MAX_RESPONDERS)
+                    )
+                    if responders:
+                        position = chat.get('history_offset', 0) + len(chat['chat_history'])
+                        submit_generation(('reply', chat.get('branch'), position), f"{'、'.join(responders)} 回应",
+                                          reply_job, chat_snapshot(chat), responders,
+                                          st.session_state.get('turn_budget', DEFAULT_TURN_BUDGET))
+                st.rerun()
+
+@timed_fragment("控制面板")
+def render_control_panel():
+    """控制面板：介绍、AI互动、保存等操作"""
+    st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
+    st.markdown('<h4 style="color: #ffffff; margin-bottom: 1rem;">⚙️ 控制面板</h4>', unsafe_allow_html=True)
+    
+    col_toggles = st.columns(5)
+    with col_toggles[0]:
+        st.toggle(
+            "📦 批量介绍",
+            value=True,
+            key="batch_intro",
+            help="一次请求生成所有角色的自我介绍，解析失败的角色再逐个生成"
+        )
+    with col_toggles[1]:
+        st.toggle(
+            "⚡ 预生成",
+            value=False,
+            key="speculative_prefetch",
+            help="角色发言后，在你输入时预先生成AI互动的下一轮发言"
+        )
+    with col_toggles[2]:
+        st.toggle(
+            "💬 自动回应",
+            value=True,
+            key="auto_reply",
+            help="发送消息后，被 @ 提到或与话题相关的角色自动回应"
+        )
+    with col_toggles[3]:
+        st.number_input(
+            "每条消息最多回应",
+            min_value=1,
+            max_value=8,
+            value=DEFAULT_MAX_RESPONDERS,
+            key="max_responders",
+            help="没有 @ 提及时，按与角色名字和个性的相关度挑选回应的角色"
+        )
+    with col_toggles[4]:
+        st.number_input(
+            "回应总时长（秒）",
+            min_value=0.0,
+            max_value=300.0,
+            value=DEFAULT_TURN_BUDGET,
+            step=5.0,
+            key="turn_budget",
+            help="多个角色依次回应时的总时间预算，剩余时间平均分给还没发言的角色；0 表示不限"
+        )
+    
+    # 控制按钮
+    col_controls = st.columns(5)
+    
+    branch = st.session_state.current_chat.get('branch')
+    
+    with col_controls[0]:
+        if st.button("👋 开始介绍", use_container_width=True, key="start_intro_btn",
+                     disabled=generation_pending(('intro', branch))):
+            agents = st.session_state.current_chat.get('agents', {})
+            if agents:
+                submit_generation(('intro', branch), "角色介绍", intro_job,
+                                  chat_snapshot(st.session_state.current_chat), st.session_state.batch_intro)
+                st.rerun()
+            else:
+                st.warning("👥 请添加至少一个AI角色")
+    
+    with col_controls[1]:
+        if st.button("🎭 AI互动", use_container_width=True, key="ai_interact_btn",
+                     disabled=generation_pending(('turn', branch))):
+            current_chat = st.session_state.current_chat
+            agent_name = next_speaker(current_chat)
+            if agent_name:
+                submit_generation(('turn', branch), f"{agent_name} 发言", turn_job,
+                                  chat_snapshot(current_chat), agent_name, st.session_state.speculative_prefetch)
+                st.rerun()
+            else:
+                st.warning("👥 请添加至少一个AI角色")
+    
+    with col_controls[2]:
+        if st.button("💾 保存", use_container_width=True, key="save_btn"):
+            # 保存到当前ID，不再每次另存一份新场景
+            chat_id = st.session_state.chat_manager.save_chat(
+                st.session_state.current_chat,
+                st.session_state.current_chat.get('id')
+            )
+            st.success(f"💾 场景已保存")
+    
+    with col_controls[3]:
+        if st.button("📥 导出", use_container_width=True, key="export_btn"):
+            st.info("导出功能开发中...")
+    
+    with col_controls[4]:
+        if st.button("🔄 刷新", use_container_width=True, key="refresh_btn"):
+            st.session_state.chat_manager.invalidate_listing()
+            st.rerun()
+
 # ================== 初始化 ==================
+profile_mark("初始化")
+
+# 侧边栏每页显示的场景数
+SIDEBAR_PAGE_SIZE = 10
+
 if 'chat_manager' not in st.session_state:
-    st.session_state.chat_manager = ChatManager()
+    st.session_state.chat_manager = get_chat_manager()
+# 后台备份随第一个会话启动
+get_replicator()
+
+# 后台任务按会话归属
+if 'session_token' not in st.session_state:
+    st.session_state.session_token = uuid.uuid4().hex
+
+if 'sidebar_limit' not in st.session_state:
+    st.session_state.sidebar_limit = SIDEBAR_PAGE_SIZE
+
+if 'history_limit' not in st.session_state:
+    st.session_state.history_limit = HISTORY_PAGE_SIZE
 
 if 'current_chat' not in st.session_state:
-    all_chats = st.session_state.chat_manager.get_all_chats()
-    if all_chats:
-        st.session_state.current_chat = st.session_state.chat_manager.load_chat(all_chats[0]['id'])
+    # 通过最近保存的指针直接打开最新的聊天，不扫描全部聊天
+    latest_id = st.session_state.chat_manager.latest_chat_id()
+    latest_chat = st.session_state.chat_manager.load_chat(latest_id, tail=LOAD_TAIL) if latest_id else None
+    if latest_chat is not None:
+        st.session_state.current_chat = latest_chat
         st.session_state.editing_chat = False
     else:
         create_new_chat()
@@ -950,11 +1440,16 @@ if 'current_chat' not in st.session_state:
 if 'editing_chat' not in st.session_state:
     st.session_state.editing_chat = True
 
-if 'private_history' not in st.session_state.current_chat:
-    st.session_state.current_chat['private_history'] = {}
+ensure_stats(st.session_state.current_chat)
 
 # ================== 高级侧边栏设计 ==================
-with st.sidebar:
+def update_budget(key):
+    """把输入框里的新预算写进账本"""
+    usage_ledger.set_budgets(**{key: st.session_state[key]})
+
+@timed_fragment("侧边栏")
+def render_sidebar():
+    """侧边栏：场景列表、当前场景和系统状态"""
     # 侧边栏头部
     st.markdown("""
     <div class="sidebar-header">
@@ -970,19 +1465,20 @@ with st.sidebar:
     
     st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
     
-    # 聊天列表
-    all_chats = st.session_state.chat_manager.get_all_chats()
+    # 聊天列表（只渲染最近的若干个，按需加载更多）
+    chat_count = st.session_state.chat_manager.chat_count()
+    recent_chats = st.session_state.chat_manager.list_chats(limit=st.session_state.sidebar_limit)
     
-    if all_chats:
+    if recent_chats:
         st.markdown(f'''
         <div style="color: rgba(255,255,255,0.7); font-size: 0.9rem; margin-bottom: 1rem;">
-            已保存场景 ({len(all_chats)})
+            已保存场景 ({chat_count})
         </div>
         ''', unsafe_allow_html=True)
         
-        for chat in all_chats:
+        for chat in recent_chats:
             chat_id = chat['id']
-            chat_title = chat.get('title', '无标题')
+            chat_title = chat['title']
             chat_time = chat['modified'].strftime('%H:%M') if isinstance(chat['modified'], datetime) else '--:--'
             
             is_active = st.session_state.current_chat.get('id') == chat_id
@@ -1000,7 +1496,7 @@ with st.sidebar:
             col1, col2 = st.columns(2)
             with col1:
                 if st.button("📂", key=f"load_{chat_id}", help="加载场景", use_container_width=True):
-                    loaded_chat = st.session_state.chat_manager.load_chat(chat_id)
+                    loaded_chat = st.session_state.chat_manager.load_chat(chat_id, tail=LOAD_TAIL)
                     if loaded_chat:
                         st.session_state.current_chat = loaded_chat
                         st.session_state.editing_chat = False
@@ -1010,6 +1506,11 @@ with st.sidebar:
                 if st.button("🗑️", key=f"delete_{chat_id}", help="删除", use_container_width=True):
                     if st.session_state.chat_manager.delete_chat(chat_id):
                         st.rerun()
+        
+        if chat_count > len(recent_chats):
+            if st.button(f"⬇️ 加载更多 ({chat_count - len(recent_chats)})", use_container_width=True, key="load_more_chats"):
+                st.session_state.sidebar_limit += SIDEBAR_PAGE_SIZE
+                st.rerun()
     
     st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
     
@@ -1041,15 +1542,110 @@ with st.sidebar:
     
     # 系统状态
     with st.expander("📊 系统状态", expanded=True):
+        timings = st.session_state.get('interaction_timings', [])
+        page_timings = [t for t in timings if t['范围'] == "整页重跑"]
         col_stat1, col_stat2 = st.columns(2)
         with col_stat1:
             st.metric("内存使用", "65%", "12%", delta_color="off")
         with col_stat2:
-            st.metric("响应时间", "0.8s", "-0.2s")
+            st.metric("响应时间", f"{page_timings[-1]['耗时(ms)']:.0f}ms" if page_timings else "--")
         
         st.progress(85, text="场景加载进度")
+        
+        # 最近的交互耗时：整页重跑与片段局部重跑对比
+        if timings:
+            st.dataframe(list(reversed(timings)), hide_index=True, use_container_width=True)
+        
+        # 后台备份：最近一次失败晚于最近一次成功时显示错误
+        replicator = get_replicator()
+        if replicator is not None:
+            if replicator.last_error and (replicator.last_success or 0) < replicator.last_error_at:
+                st.error(f"💾 备份失败：{replicator.last_error}")
+            elif replicator.last_success:
+                st.caption(f"💾 最近一次备份：{datetime.fromtimestamp(replicator.last_success).strftime('%H:%M:%S')}")
+            else:
+                st.caption("💾 备份尚未完成")
+    
+    # 提示缓存命中情况
+    with st.expander("🧩 提示缓存", expanded=False):
+        calls = call_log.entries(st.session_state.current_chat.get('id'))
+        if calls:
+            hit_tokens = sum(c['cache_hit_tokens'] for c in calls)
+            prompt_tokens = sum(c['prompt_tokens'] for c in calls)
+            st.metric("缓存命中", f"{hit_tokens} tokens", f"{hit_tokens / max(prompt_tokens, 1):.0%}", delta_color="off")
+            st.dataframe(
+                [
+                    {
+                        '时间': c['time'],
+                        '调用': c['label'],
+                        '提示': c['prompt_tokens'],
+                        '命中': c['cache_hit_tokens'],
+                        '输出': c['completion_tokens'],
+                    }
+                    for c in reversed(calls)
+                ],
+                hide_index=True,
+                use_container_width=True
+            )
+        else:
+            st.caption("当前场景还没有模型调用")
+    
+    # 用量与预算
+    with st.expander("💰 用量与预算", expanded=False):
+        chat_id = st.session_state.current_chat.get('id')
+        chat_totals = usage_ledger.chat_totals(chat_id)
+        day_totals = usage_ledger.day_totals()
+        col_cost1, col_cost2 = st.columns(2)
+        with col_cost1:
+            st.metric("本场景花费", f"${chat_totals['cost']:.4f}", f"{chat_totals['calls']} 次调用", delta_color="off")
+        with col_cost2:
+            st.metric("今日总花费", f"${day_totals['cost']:.4f}", f"{day_totals['calls']} 次调用", delta_color="off")
+        
+        ratio = usage_ledger.budget_ratio(chat_id)
+        if usage_ledger.chat_budget > 0 or usage_ledger.daily_budget > 0:
+            st.progress(min(ratio, 1.0), text=f"预算已用 {ratio:.0%}")
+        decision = usage_ledger.check(chat_id)
+        if decision == 'refuse':
+            st.error("预算已用尽，新的生成请求会被拒绝")
+        elif decision == 'degrade':
+            st.warning("接近预算上限，生成时使用更短的上下文"
+                       + (f"并换用 {BUDGET_FALLBACK_MODEL}" if BUDGET_FALLBACK_MODEL else ""))
+        
+        agents = usage_ledger.agent_totals(chat_id)
+        if agents:
+            st.dataframe(
+                [
+                    {
+                        '调用': agent,
+                        '次数': totals['calls'],
+                        '提示': totals['prompt_tokens'],
+                        '命中': totals['cache_hit_tokens'],
+                        '输出': totals['completion_tokens'],
+                        '花费($)': round(totals['cost'], 4),
+                    }
+                    for agent, totals in sorted(agents.items(), key=lambda item: -item[1]['cost'])
+                ],
+                hide_index=True,
+                use_container_width=True
+            )
+        
+        # 预算保存在账本里，对所有会话和进程生效，0 表示不限；输入框每次重跑都显示账本里的最新值
+        st.session_state.chat_budget = float(usage_ledger.chat_budget)
+        st.session_state.daily_budget = float(usage_ledger.daily_budget)
+        st.number_input("单场景预算($):", min_value=0.0, step=0.1, key="chat_budget",
+                        on_change=update_budget, args=("chat_budget",))
+        st.number_input("每日预算($):", min_value=0.0, step=1.0, key="daily_budget",
+                        on_change=update_budget, args=("daily_budget",))
+
+
+profile_mark("侧边栏")
+
+with st.sidebar:
+    render_sidebar()
 
 # ================== 主界面 ==================
+profile_mark("主界面")
+
 animated_header()
 
 # 创建主容器
@@ -1070,6 +1666,26 @@ if st.session_state.editing_chat:
     
     st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
     
+    # 模板库
+    template_library = get_template_library()
+    with st.expander("📚 模板库", expanded=False):
+        col_tpl, col_apply, col_save = st.columns([2, 1, 1])
+        with col_tpl:
+            scene_template = st.selectbox(
+                "场景模板:",
+                options=template_library.scene_names(),
+                key="scene_template",
+                label_visibility="collapsed"
+            )
+        with col_apply:
+            if st.button("📥 套用模板", use_container_width=True, key="apply_template"):
+                if scene_template and template_library.apply_scene(scene_template, st.session_state.current_chat):
+                    st.rerun()
+        with col_save:
+            if st.button("📤 存为模板", use_container_width=True, key="save_template"):
+                template_library.save_scene(st.session_state.current_chat)
+                st.success("📚 已保存到模板库")
+    
     # 创建场景表单
     with st.container():
         col1, col2 = st.columns([2, 1])
@@ -1138,62 +1754,14 @@ if st.session_state.editing_chat:
     
     with col3:
         if st.button("🎲 随机角色", use_container_width=True, key="random_roles"):
-            random_roles = ["神秘巫师", "时空旅人", "AI助手", "未来战士", "古代贤者"]
-            for role in random_roles[:3]:
+            for role in template_library.random_agents(3):
                 if role not in st.session_state.current_chat['agents']:
-                    st.session_state.current_chat['agents'][role] = {
-                        'avatar': "👤",
-                        'system_prompt': ''
-                    }
+                    st.session_state.current_chat['agents'][role] = template_library.agent_data(role)
             st.success("✨ 已添加随机角色！")
     
     # 已添加角色展示
     agents = st.session_state.current_chat['agents']
-    if agents:
-        st.markdown(f'<h4 style="color: #ffffff; margin-top: 2rem;">已添加角色 ({len(agents)})</h4>', unsafe_allow_html=True)
-        
-        # 使用网格展示角色
-        cols_per_row = min(4, len(agents))
-        roles_list = list(agents.keys())
-        
-        rows = (len(roles_list) + cols_per_row - 1) // cols_per_row
-        for row in range(rows):
-            cols = st.columns(cols_per_row)
-            for col_idx in range(cols_per_row):
-                idx = row * cols_per_row + col_idx
-                if idx < len(roles_list):
-                    role = roles_list[idx]
-                    
-                    with cols[col_idx]:
-                        # 角色卡片
-                        st.markdown(role_card_display(role, agents[role]['avatar']), unsafe_allow_html=True)
-                        
-                        # 角色设置
-                        with st.expander("角色设置", expanded=False):
-                            # 头像选择
-                            avatar_options = ["👤", "🧙", "👑", "🦸", "🧚", "🤖", "👽", "🧝"]
-                            selected_avatar = st.selectbox(
-                                "选择头像:",
-                                options=avatar_options,
-                                index=avatar_options.index(agents[role]['avatar']) if agents[role]['avatar'] in avatar_options else 0,
-                                key=f"avatar_{role}"
-                            )
-                            agents[role]['avatar'] = selected_avatar
-                            
-                            # 个性描述
-                            personality = st.text_area(
-                                "角色个性:",
-                                value=agents[role].get('personality', ''),
-                                placeholder="描述角色的性格特点、说话风格等",
-                                key=f"personality_{role}",
-                                height=100
-                            )
-                            agents[role]['personality'] = personality
-                        
-                        # 删除按钮
-                        if st.button("移除", key=f"remove_{role}", use_container_width=True):
-                            del agents[role]
-                            st.rerun()
+    render_agent_editor()
     
     # 创建按钮
     st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
@@ -1235,12 +1803,11 @@ else:
         col_status = st.columns(4)
         with col_status[0]:
             st.markdown(f'<span class="badge badge-primary">🎭 {len(st.session_state.current_chat.get("agents", {}))} 角色</span>', unsafe_allow_html=True)
+        chat_stats = ensure_stats(st.session_state.current_chat)
         with col_status[1]:
-            public_count = len(st.session_state.current_chat.get('chat_history', []))
-            st.markdown(f'<span class="badge badge-success">💬 {public_count} 消息</span>', unsafe_allow_html=True)
+            st.markdown(f'<span class="badge badge-success">💬 {chat_stats["public"]} 消息</span>', unsafe_allow_html=True)
         with col_status[2]:
-            private_count = sum(len(h) for h in st.session_state.current_chat.get('private_history', {}).values())
-            st.markdown(f'<span class="badge badge-warning">🔒 {private_count} 私聊</span>', unsafe_allow_html=True)
+            st.markdown(f'<span class="badge badge-warning">🔒 {chat_stats["private"]} 私聊</span>', unsafe_allow_html=True)
         with col_status[3]:
             if st.session_state.current_chat.get('modified'):
                 mod_time = st.session_state.current_chat['modified']
@@ -1257,6 +1824,7 @@ else:
     tab1, tab2, tab3 = st.tabs(["💬 公共聊天", "🔒 私密聊天", "👥 角色档案"])
     
     # ================== 公共聊天标签页 ==================
+    profile_mark("主界面·公共聊天")
     with tab1:
         # 聊天指南
         with st.expander("📚 聊天指南", expanded=False):
@@ -1273,57 +1841,19 @@ else:
             </div>
             """, unsafe_allow_html=True)
         
-        # 聊天历史
-        chat_history = st.session_state.current_chat.get('chat_history', [])
+        # 分支
+        render_branches()
         
-        if chat_history:
-            for msg in chat_history:
-                if len(msg) >= 4:
-                    agent, avatar, message, timestamp = msg[:4]
-                    is_user = (agent == user_role)
-                    
-                    # 显示聊天消息
-                    st.markdown(chat_message_display(agent, avatar, message, timestamp, is_user), unsafe_allow_html=True)
-        else:
-            st.markdown("""
-            <div style="text-align: center; padding: 3rem; color: rgba(255,255,255,0.7);">
-                <div style="font-size: 4rem; margin-bottom: 1rem;">💭</div>
-                <h3>对话尚未开始</h3>
-                <p>点击下方的"开始介绍"按钮，让AI角色向你问好吧！</p>
-            </div>
-            """, unsafe_allow_html=True)
+        # 聊天历史
+        render_history(user_role)
+        if get_generation_worker().has_jobs(st.session_state.session_token):
+            poll_generations()
         
         # 聊天输入区域
-        st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
-        st.markdown('<h4 style="color: #ffffff; margin-bottom: 1rem;">🎤 发送消息</h4>', unsafe_allow_html=True)
-        
-        col_input, col_send = st.columns([4, 1])
-        
-        with col_input:
-            user_input = st.text_area(
-                "输入消息给所有AI角色:",
-                height=120,
-                placeholder=f"作为{user_role}，你想对大家说什么？",
-                key="public_input",
-                label_visibility="collapsed"
-            )
-        
-        with col_send:
-            st.write(" ")
-            if st.button("🚀 发送", type="primary", use_container_width=True, key="send_public"):
-                if user_input:
-                    timestamp = datetime.now().strftime("%H:%M")
-                    chat_history = st.session_state.current_chat.get('chat_history', [])
-                    chat_history.append([
-                        user_role,
-                        "👤",
-                        user_input,
-                        timestamp
-                    ])
-                    st.session_state.current_chat['chat_history'] = chat_history
-                    st.rerun()
+        render_composer(user_role)
     
     # ================== 私密聊天标签页 ==================
+    profile_mark("主界面·私密聊天")
     with tab2:
         agents = st.session_state.current_chat.get('agents', {})
         if agents:
@@ -1356,8 +1886,10 @@ else:
             glass_card("提示", "还没有AI参与者可以私聊，请先添加角色。", "🤷‍♂️")
     
     # ================== 角色档案标签页 ==================
+    profile_mark("主界面·角色档案")
     with tab3:
         agents = st.session_state.current_chat.get('agents', {})
+        speaker_stats = ensure_stats(st.session_state.current_chat)['speakers']
         if agents:
             st.markdown('<h4 style="color: #ffffff; margin-bottom: 1.5rem;">🎭 AI角色档案</h4>', unsafe_allow_html=True)
             
@@ -1375,48 +1907,36 @@ else:
                             st.markdown(f'<div style="color: rgba(255,255,255,0.8); margin-bottom: 1rem;">{data["personality"]}</div>', unsafe_allow_html=True)
                         
                         # 角色统计数据
+                        agent_stats = speaker_stats.get(agent_name, {})
+                        last_activity = agent_stats.get('last_activity')
                         col_stats = st.columns(3)
                         with col_stats[0]:
-                            st.metric("状态", "在线", "🟢", delta_color="off")
+                            st.metric("发言次数", agent_stats.get('messages', 0), "💬", delta_color="off")
                         with col_stats[1]:
-                            st.metric("响应速度", "快速", "⚡", delta_color="off")
+                            st.metric("Token 估算", agent_stats.get('tokens', 0), "🧮", delta_color="off")
                         with col_stats[2]:
-                            st.metric("友好度", "高", "😊", delta_color="off")
+                            st.metric(
+                                "最近活跃",
+                                datetime.fromisoformat(last_activity).strftime("%H:%M") if last_activity else "--:--",
+                                "🕐",
+                                delta_color="off"
+                            )
+                        
+                        with st.expander("角色设置", expanded=False):
+                            render_generation_settings(agent_name, data)
         else:
             glass_card("提示", "还没有AI角色档案，请先添加角色。", "🎭")
     
     # ================== 控制面板 ==================
-    st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
-    st.markdown('<h4 style="color: #ffffff; margin-bottom: 1rem;">⚙️ 控制面板</h4>', unsafe_allow_html=True)
-    
-    # 控制按钮
-    col_controls = st.columns(5)
-    
-    with col_controls[0]:
-        if st.button("👋 开始介绍", use_container_width=True, key="start_intro_btn"):
-            st.success("AI角色开始自我介绍...")
-    
-    with col_controls[1]:
-        if st.button("🎭 AI互动", use_container_width=True, key="ai_interact_btn"):
-            st.info("AI角色开始互动...")
-    
-    with col_controls[2]:
-        if st.button("💾 保存", use_container_width=True, key="save_btn"):
-            chat_id = st.session_state.chat_manager.save_chat(st.session_state.current_chat)
-            st.success(f"💾 场景已保存")
-    
-    with col_controls[3]:
-        if st.button("📥 导出", use_container_width=True, key="export_btn"):
-            st.info("导出功能开发中...")
-    
-    with col_controls[4]:
-        if st.button("🔄 刷新", use_container_width=True, key="refresh_btn"):
-            st.rerun()
+    profile_mark("主界面·控制面板")
+    render_control_panel()
 
 # 关闭主容器
 st.markdown('</div>', unsafe_allow_html=True)
 
 # ================== 页脚 ==================
+profile_mark("页脚")
+
 st.markdown("""
 <div style="text-align: center; color: rgba(255,255,255,0.6); padding: 2rem;">
     <p>🎭 AI角色扮演聊天室 | 沉浸式多角色对话体验 | 由 DeepSeek API 驱动</p>
@@ -1489,5 +2009,34 @@ animateParticles();
 </script>
 """, unsafe_allow_html=True)
 
+# ================== 性能剖析 ==================
+if profiler is not None:
+    profiler.finish()
+    trace_path = profiler.write_trace()
+    with st.expander("⏱️ 性能剖析", expanded=True):
+        st.caption(f"本次重跑 {profiler.total * 1000:.1f}ms，追踪文件已写入 {trace_path}（可用 chrome://tracing 或 Perfetto 打开）")
+        st.dataframe(profiler.breakdown(), hide_index=True, use_container_width=True)
+        if profiler.cprofile_report:
+            st.code(profiler.cprofile_report, language=None)
+        col_prof1, col_prof2 = st.columns(2)
+        with col_prof1:
+            st.button(
+                "🔬 下一次重跑捕获 cProfile",
+                key="capture_cprofile",
+                on_click=lambda: st.session_state.update(cprofile_next=True),
+                use_container_width=True
+            )
+        with col_prof2:
+            st.download_button(
+                "📥 下载追踪文件",
+                trace_path.read_bytes(),
+                file_name=trace_path.name,
+                mime="application/json",
+                key="download_trace",
+                use_container_width=True
+            )
+
+record_timing("整页重跑", _page_started)
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
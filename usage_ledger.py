@@ -0,0 +1,209 @@
+import json
+import os
+import threading
+import time
+from datetime import date
+
+
+# ================== 用量账本 ==================
+# 每次模型调用追加一行到 chat_data/.usage.jsonl，按聊天、角色和日期汇总。
+# 多个进程共用同一个账本文件，汇总时只读取上次之后追加的部分，自己写入的记录也从文件读回，不会重复计数。
+# 预算的修改也作为一行记录写进账本，所有进程和会话读到同一个最新的预算。
+LEDGER_NAME = ".usage.jsonl"
+
+# 每百万 token 的价格（美元），缓存命中的提示 token 按更低的价格计
+PRICES = {
+    "deepseek-chat": {'cache_hit': 0.07, 'cache_miss': 0.27, 'output': 1.10},
+    "deepseek-reasoner": {'cache_hit': 0.14, 'cache_miss': 0.55, 'output': 2.19},
+}
+DEFAULT_PRICE = PRICES["deepseek-chat"]
+
+# 花费达到预算的这个比例后降级：只带系统提示和最近的几条消息；
+# 设置了 BUDGET_FALLBACK_MODEL 时同时换用这个（更便宜的）模型，默认不换模型
+DEGRADE_RATIO = 0.8
+DEGRADED_MESSAGES = 10
+BUDGET_FALLBACK_MODEL = os.getenv("BUDGET_FALLBACK_MODEL") or None
+
+
+class BudgetExceeded(Exception):
+    """预算用尽，拒绝发起新的模型调用"""
+
+
+def call_cost(model, hit_tokens, miss_tokens, completion_tokens):
+    """按价格表估算一次调用的花费（美元）"""
+    price = PRICES.get(model, DEFAULT_PRICE)
+    return (hit_tokens * price['cache_hit'] + miss_tokens * price['cache_miss']
+            + completion_tokens * price['output']) / 1_000_000
+
+
+def degrade_messages(messages, keep=DEGRADED_MESSAGES):
+    """只保留开头的系统提示和最近的 keep 条消息"""
+    head = 0
+    while head < len(messages) and messages[head]['role'] == 'system':
+        head += 1
+    return messages[:head] + messages[head:][-keep:]
+
+
+def _new_totals():
+    return {'calls': 0, 'prompt_tokens': 0, 'cache_hit_tokens': 0, 'completion_tokens': 0, 'cost': 0.0}
+
+
+class UsageLedger:
+    """模型调用的 token 和花费账本，支持单个聊天的预算和每日总预算（0 表示不限）
+
+    构造时传入的预算是默认值，账本里有预算记录时以最后一条为准。
+    """
+
+    def __init__(self, path=None, chat_budget=0.0, daily_budget=0.0):
+        self.path = None
+        self._default_budgets = {'chat_budget': chat_budget, 'daily_budget': daily_budget}
+        self._lock = threading.Lock()
+        self._reset()
+        if path is not None:
+            self.open(path)
+
+    def _reset(self):
+        self._offset = 0
+        self._inode = None
+        self.chat_budget = self._default_budgets['chat_budget']
+        self.daily_budget = self._default_budgets['daily_budget']
+        self.by_chat = {}
+        self.by_agent = {}
+        self.by_day = {}
+
+    def open(self, path):
+        """指定账本文件并读入已有的记录"""
+        with self._lock:
+            self.path = path
+            self._reset()
+        self.sync()
+
+    def record(self, chat_id, agent, model, usage):
+        """记录一次调用的用量，usage 是接口响应里的 usage 对象"""
+        if self.path is None or usage is None:
+            return
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        hit_tokens = getattr(usage, 'prompt_cache_hit_tokens', 0) or 0
+        miss_tokens = getattr(usage, 'prompt_cache_miss_tokens', prompt_tokens - hit_tokens) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        entry = {
+            'time': time.time(),
+            'day': date.today().isoformat(),
+            'chat_id': chat_id,
+            'agent': agent,
+            'model': model,
+            'prompt_tokens': prompt_tokens,
+            'cache_hit_tokens': hit_tokens,
+            'completion_tokens': completion_tokens,
+            'cost': round(call_cost(model, hit_tokens, miss_tokens, completion_tokens), 8),
+        }
+        self._append(entry)
+
+    def set_budgets(self, chat_budget=None, daily_budget=None):
+        """修改预算并写进账本，没有指定的一项保持不变；还没有打开账本时只在本进程生效"""
+        self.sync()
+        budgets = {
+            'chat_budget': self.chat_budget if chat_budget is None else float(chat_budget),
+            'daily_budget': self.daily_budget if daily_budget is None else float(daily_budget),
+        }
+        if self.path is None:
+            self._default_budgets = budgets
+            self.chat_budget, self.daily_budget = budgets['chat_budget'], budgets['daily_budget']
+            return
+        self._append({'type': 'budget', 'time': time.time(), **budgets})
+        self.sync()
+
+    def _append(self, entry):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def sync(self):
+        """读入上次之后追加的记录"""
+        if self.path is None:
+            return
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._reset()
+                self._inode = stat.st_ino
+            if stat.st_size == self._offset:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                chunk = f.read(stat.st_size - self._offset)
+            # 只处理完整的行，写了一半的行留到下次
+            complete = chunk[:chunk.rfind(b"\n") + 1]
+            self._offset += len(complete)
+            for line in complete.decode('utf-8').splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self._add(entry)
+
+    def _add(self, entry):
+        if entry.get('type') == 'budget':
+            self.chat_budget = entry.get('chat_budget', self.chat_budget)
+            self.daily_budget = entry.get('daily_budget', self.daily_budget)
+            return
+        for totals in (
+            self.by_chat.setdefault(entry['chat_id'], _new_totals()),
+            self.by_agent.setdefault((entry['chat_id'], entry['agent']), _new_totals()),
+            self.by_day.setdefault(entry['day'], _new_totals()),
+        ):
+            totals['calls'] += 1
+            for key in ('prompt_tokens', 'cache_hit_tokens', 'completion_tokens', 'cost'):
+                totals[key] += entry.get(key, 0)
+
+    # ---------- 查询 ----------
+    def chat_totals(self, chat_id):
+        self.sync()
+        with self._lock:
+            return dict(self.by_chat.get(chat_id, _new_totals()))
+
+    def agent_totals(self, chat_id):
+        """某个聊天里每个角色（或批量调用）的用量"""
+        self.sync()
+        with self._lock:
+            return {agent: dict(totals) for (cid, agent), totals in self.by_agent.items() if cid == chat_id}
+
+    def day_totals(self, day=None):
+        self.sync()
+        with self._lock:
+            return dict(self.by_day.get(day or date.today().isoformat(), _new_totals()))
+
+    # ---------- 预算 ----------
+    def budget_ratio(self, chat_id):
+        """已用预算的比例，取单聊天预算和每日预算中更紧的一个；没有预算时为 0"""
+        self.sync()
+        ratios = [0.0]
+        if self.chat_budget > 0:
+            ratios.append(self.chat_totals(chat_id)['cost'] / self.chat_budget)
+        if self.daily_budget > 0:
+            ratios.append(self.day_totals()['cost'] / self.daily_budget)
+        return max(ratios)
+
+    def check(self, chat_id):
+        """返回 'ok'、'degrade' 或 'refuse'"""
+        ratio = self.budget_ratio(chat_id)
+        if ratio >= 1:
+            return 'refuse'
+        if ratio >= DEGRADE_RATIO:
+            return 'degrade'
+        return 'ok'
+
+
+def _env_budget(name):
+    try:
+        return float(os.getenv(name, "0") or 0)
+    except ValueError:
+        return 0.0
+
+
+usage_ledger = UsageLedger(
+    chat_budget=_env_budget("CHAT_BUDGET_USD"),
+    daily_budget=_env_budget("DAILY_BUDGET_USD"),
+)